@@ -0,0 +1,112 @@
+"""
+Benchmark: throughput of many concurrent large downloads.
+
+    python -m app.benchmarks.downloads --files 4 --file-size 134217728 --clients 1 8 32
+
+Uploads a few large files, then downloads them with every number of concurrent clients,
+whole and as 4MB ranges, and reports the aggregate MB/s.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import httpx
+
+from .server import run_server, percentile
+
+RANGE_SIZE = 4 * 1024 * 1024
+
+
+async def upload_file(client: httpx.AsyncClient, index: int, file_size: int):
+    """
+    Create one file of random content and return its id.
+    """
+
+    payload = os.urandom(file_size)
+    response = await client.post("/file-create", files={"file": (f"large-{index}.bin", payload)}, timeout=None)
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+async def download(client: httpx.AsyncClient, file_id: int, headers: dict | None = None):
+    """
+    Stream one download to nowhere and return the bytes received.
+    """
+
+    received = 0
+    async with client.stream("GET", f"/file/{file_id}/content", headers=headers) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_raw():
+            received += len(chunk)
+    return received
+
+
+async def run_clients(client: httpx.AsyncClient, file_ids: list[int], clients: int, requests: int, file_size: int,
+                      ranged: bool):
+    """
+    Run `requests` downloads through `clients` concurrent workers.
+
+    :return dict:
+    """
+
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+    latencies = []
+
+    async def worker():
+        rng = random.Random()
+        received = 0
+        while not queue.empty():
+            i = queue.get_nowait()
+            headers = None
+            if ranged:
+                start = rng.randrange(0, max(1, file_size - RANGE_SIZE))
+                headers = {"Range": f"bytes={start}-{start + RANGE_SIZE - 1}"}
+            started = time.perf_counter()
+            received += await download(client, file_ids[i % len(file_ids)], headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+        return received
+
+    started = time.perf_counter()
+    received = sum(await asyncio.gather(*[worker() for _ in range(clients)]))
+    seconds = time.perf_counter() - started
+
+    return {
+        "clients": clients,
+        "ranged": ranged,
+        "requests": requests,
+        "seconds": seconds,
+        "mb_per_second": received / seconds / 1024 / 1024,
+        "request_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+    }
+
+
+async def run(args):
+    results = []
+    with run_server() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+            file_ids = [await upload_file(client, i, args.file_size) for i in range(args.files)]
+
+            for clients in args.clients:
+                for ranged in (False, True):
+                    requests = max(clients, args.files) * (args.ranges_per_client if ranged else 1)
+                    results.append(await run_clients(client, file_ids, clients, requests, args.file_size, ranged))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=128 * 1024 * 1024, help="Bytes per file.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32], help="Concurrent downloads.")
+    parser.add_argument("--ranges-per-client", type=int, default=8)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark: name search latency on a large generated tree.
+
+    python -m app.benchmarks.name_search --names 1000000 --folders 1000
+
+Fills a temporary database with `--names` documents spread over `--folders` folders and
+reports p50/p95 latency of ranked searches, globally and scoped to one folder, through
+the trigram index and through a LIKE scan for comparison.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from ..internals.search import create_search_index, search_names, name_filter
+from ..models.database.folder_and_files import Folder, Document
+from .server import percentile
+
+WORDS = [
+    "invoice", "report", "draft", "photo", "scan", "contract", "budget", "notes", "summary", "backup",
+    "design", "review", "minutes", "receipt", "statement", "thesis", "slides", "export", "archive", "plan",
+]
+EXTENSIONS = ["pdf", "docx", "txt", "png", "jpg", "xlsx", "csv", "zip"]
+
+
+def fill_database(engine, names: int, folders: int, seed: int):
+    """
+    Insert `folders` top level folders and `names` documents spread over them.
+    """
+
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "INSERT INTO folder (id, name, parent_id, path) VALUES (?, ?, NULL, ?)",
+            [(i, f"{rng.choice(WORDS)} {i}", f"/{i}/") for i in range(1, folders + 1)]
+        )
+        batch = []
+        for i in range(1, names + 1):
+            name = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}-{i:07d}.{rng.choice(EXTENSIONS)}"
+            batch.append((i, name, f"uploads/{i}", rng.randint(1, folders)))
+            if len(batch) == 50000:
+                connection.exec_driver_sql(
+                    "INSERT INTO documents (id, name, file_url, folder_id) VALUES (?, ?, ?, ?)", batch
+                )
+                batch.clear()
+        if batch:
+            connection.exec_driver_sql("INSERT INTO documents (id, name, file_url, folder_id) VALUES (?, ?, ?, ?)", batch)
+
+
+def time_queries(queries: list[str], run, repeat: int):
+    """
+    Run every query `repeat` times and return the latencies in ms.
+    """
+
+    latencies = []
+    for _ in range(repeat):
+        for q in queries:
+            started = time.perf_counter()
+            run(q)
+            latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def run(args):
+    with tempfile.TemporaryDirectory(prefix="headache-bench-") as workdir:
+        engine = create_engine(f"sqlite:///{os.path.join(workdir, 'search.db')}")
+        SQLModel.metadata.create_all(engine)
+        with engine.begin() as connection:
+            create_search_index(connection)
+
+        started = time.perf_counter()
+        fill_database(engine, args.names, args.folders, args.seed)
+        fill_seconds = time.perf_counter() - started
+
+        rng = random.Random(args.seed + 1)
+        queries = {
+            # A handful of hits
+            "selective": [f"{rng.randint(1, args.names):07d}" for _ in range(args.queries)],
+            # Every ~400th name
+            "word_pair": [f"{rng.choice(WORDS)}-{rng.choice(WORDS)}-00" for _ in range(args.queries)],
+        }
+
+        results = {"names": args.names, "folders": args.folders, "fill_seconds": fill_seconds, "searches": []}
+        with Session(engine) as session:
+            scope = session.exec(select(Folder).where(Folder.id == 1)).one()
+
+            for kind, kind_queries in queries.items():
+                scenarios = {
+                    "indexed_global": lambda q: search_names(session, q, limit=args.limit),
+                    "indexed_scoped": lambda q: search_names(session, q, scope, limit=args.limit),
+                    "like_scan": lambda q: session.exec(
+                        select(Document).where(Document.name.ilike(f"%{q}%")).limit(args.limit)
+                    ).all(),
+                    "indexed_filter": lambda q: session.exec(
+                        select(Document).where(name_filter(session, Document, q)).limit(args.limit)
+                    ).all(),
+                }
+                for scenario, search in scenarios.items():
+                    latencies = time_queries(kind_queries, search, args.repeat)
+                    results["searches"].append({
+                        "queries": kind,
+                        "scenario": scenario,
+                        "p50_ms": percentile(latencies, 50),
+                        "p95_ms": percentile(latencies, 95),
+                    })
+
+        engine.dispose()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--names", type=int, default=1_000_000)
+    parser.add_argument("--folders", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=20, help="Distinct queries per kind.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=50, help="Page size.")
+    parser.add_argument("--seed", type=int, default=0)
+    print(json.dumps(run(parser.parse_args()), indent=2))
+
+
+if __name__ == "__main__":
+    main()
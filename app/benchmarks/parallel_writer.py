@@ -0,0 +1,88 @@
+"""
+Benchmark: throughput of the parallel upload writer with 1 vs N writers.
+
+    python -m app.benchmarks.parallel_writer --workers 1 4 8 --dir /mnt/nvme/tmp
+
+Writes two synthetic folders, many small files and a few large files, through
+ParallelFileWriter and reports MB/s for every writer count.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from ..internals.file_writer import StoredFile, ParallelFileWriter
+from ..internals.folder_upload import CHUNK_SIZE
+
+
+async def write_folder(directory: str, file_count: int, file_size: int, workers: int):
+    """
+    Write `file_count` files of `file_size` bytes the way an upload feeds the writer and
+    return the elapsed seconds.
+    """
+
+    payload = os.urandom(min(file_size, CHUNK_SIZE))
+    started = time.perf_counter()
+
+    async with ParallelFileWriter(workers=workers) as writer:
+        for i in range(file_count):
+            handle = await writer.open(StoredFile(filename=f"{i}.bin", file_path=os.path.join(directory, f"{i}.bin")))
+            remaining = file_size
+            while remaining > 0:
+                chunk = payload[:remaining]
+                await writer.write(handle, chunk)
+                remaining -= len(chunk)
+            await writer.end(handle)
+
+    # Include the time it takes for the data to reach the disk
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+
+    return time.perf_counter() - started
+
+
+async def run(args):
+    scenarios = {
+        "many_small_files": (args.small_count, args.small_size),
+        "few_large_files": (args.large_count, args.large_size),
+    }
+
+    results = []
+    for scenario, (file_count, file_size) in scenarios.items():
+        for workers in args.workers:
+            directory = tempfile.mkdtemp(dir=args.dir)
+            try:
+                seconds = await write_folder(directory, file_count, file_size, workers)
+            finally:
+                shutil.rmtree(directory)
+            total = file_count * file_size
+            results.append({
+                "scenario": scenario,
+                "workers": workers,
+                "files": file_count,
+                "bytes": total,
+                "seconds": seconds,
+                "mb_per_second": total / seconds / 1024 / 1024,
+            })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8], help="Writer counts to compare.")
+    parser.add_argument("--dir", default=None, help="Directory on the disk to benchmark.")
+    parser.add_argument("--small-count", type=int, default=2000)
+    parser.add_argument("--small-size", type=int, default=16 * 1024)
+    parser.add_argument("--large-count", type=int, default=4)
+    parser.add_argument("--large-size", type=int, default=128 * 1024 * 1024)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+
+
+def free_port():
+    """
+    Ask the OS for a free local TCP port.
+
+    :return int:
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def run_server(env: dict | None = None, workers: int = 1):
+    """
+    Run the app with uvicorn in a fresh working directory, so every benchmark starts with
+    an empty database and upload folder.
+
+    :param env: extra environment variables for the server process
+    :param workers:
+    :return Iterator[str]: base url of the server
+    """
+
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="headache-bench-") as workdir:
+        process_env = {**os.environ, "PYTHONPATH": REPO_ROOT, **(env or {})}
+
+        # Tables are created up front, so the server doesn't depend on startup hooks
+        subprocess.run(
+            [sys.executable, "-c", "import asyncio; from app.db import create_db_and_tables; "
+                                   "asyncio.run(create_db_and_tables())"],
+            cwd=workdir, env=process_env, check=True
+        )
+
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers),
+             "--log-level", "warning"],
+            cwd=workdir, env=process_env
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    httpx.get(base_url + "/")
+                    break
+                except httpx.TransportError:
+                    if time.monotonic() > deadline or server.poll() is not None:
+                        raise RuntimeError("Benchmark server didn't start")
+                    time.sleep(0.1)
+            yield base_url
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def percentile(values: list[float], percent: float):
+    """
+    Nearest-rank percentile of a list of samples.
+
+    :param values:
+    :param percent:
+    :return float:
+    """
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
@@ -0,0 +1,81 @@
+"""
+Benchmark: read throughput of the SQLite storage profiles while uploads write.
+
+    python -m app.benchmarks.sqlite_profile --profiles default production --readers 1 4 16
+
+For every profile and reader count, runs concurrent /folder-details readers for the
+length of a batch of folder uploads and reports reads per second, latency and the number
+of failed requests (e.g. "database is locked").
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from .server import run_server, percentile
+from .upload_concurrency import upload_folder
+
+
+async def read_until(client: httpx.AsyncClient, stop: asyncio.Event):
+    """
+    Hit the listing endpoint back to back until `stop` is set.
+
+    :return tuple[list[float], int]: latencies in ms and failed requests
+    """
+
+    latencies = []
+    errors = 0
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.get("/folder-details", params={"limit": 100})
+        if response.status_code != 200:
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, errors
+
+
+async def measure(base_url: str, readers: int, args):
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        stop = asyncio.Event()
+        reader_tasks = [asyncio.create_task(read_until(client, stop)) for _ in range(readers)]
+
+        started = time.perf_counter()
+        await asyncio.gather(*[upload_folder(client, i, args.files, args.file_size) for i in range(args.uploads)])
+        seconds = time.perf_counter() - started
+        stop.set()
+        results = await asyncio.gather(*reader_tasks)
+
+    latencies = [latency for reader_latencies, _ in results for latency in reader_latencies]
+    return {
+        "readers": readers,
+        "upload_seconds": seconds,
+        "reads_per_second": len(latencies) / seconds,
+        "read_errors": sum(errors for _, errors in results),
+        "read_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+    }
+
+
+async def run(args):
+    results = []
+    for profile in args.profiles:
+        for readers in args.readers:
+            with run_server(env={"DATABASE_PROFILE": profile}) as base_url:
+                results.append({"profile": profile, **await measure(base_url, readers, args)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=["default", "production"])
+    parser.add_argument("--readers", type=int, nargs="+", default=[1, 4, 16], help="Concurrent readers.")
+    parser.add_argument("--uploads", type=int, default=2, help="Concurrent folder uploads.")
+    parser.add_argument("--files", type=int, default=500, help="Files per upload.")
+    parser.add_argument("--file-size", type=int, default=16 * 1024, help="Bytes per file.")
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Load test: folder listing latency while folder uploads run concurrently.
+
+    python -m app.benchmarks.upload_concurrency --uploads 4 --files 500 --file-size 65536
+
+Reports p50/p99 latency of /folder-details on an idle server and while the uploads run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from .server import run_server, percentile
+
+
+async def list_until(client: httpx.AsyncClient, stop: asyncio.Event, interval: float):
+    """
+    Hit the listing endpoint until `stop` is set and return the latencies in ms.
+    """
+
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.get("/folder-details")
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def upload_folder(client: httpx.AsyncClient, index: int, file_count: int, file_size: int):
+    """
+    Upload one synthetic folder and return the wall time in seconds.
+    """
+
+    paths = [f"upload-{index}/dir-{i % 10}/file-{i}.bin" for i in range(file_count)]
+    files = [("files", (os.path.basename(path), os.urandom(file_size), "application/octet-stream"))
+             for path in paths]
+
+    started = time.perf_counter()
+    response = await client.post("/folder-upload", files=files, data={"paths": paths}, timeout=None)
+    response.raise_for_status()
+    assert json.loads(response.text.splitlines()[-1])["stage"] == "upload_complete"
+    return time.perf_counter() - started
+
+
+async def run(args):
+    with run_server() as base_url:
+        async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+
+            # Baseline on an idle server
+            stop = asyncio.Event()
+            lister = asyncio.create_task(list_until(client, stop, args.interval))
+            await asyncio.sleep(args.idle_seconds)
+            stop.set()
+            idle = await lister
+
+            # Same listing loop while uploads run
+            stop = asyncio.Event()
+            lister = asyncio.create_task(list_until(client, stop, args.interval))
+            upload_times = await asyncio.gather(*[
+                upload_folder(client, i, args.files, args.file_size) for i in range(args.uploads)
+            ])
+            stop.set()
+            loaded = await lister
+
+    return {
+        "uploads": args.uploads,
+        "files_per_upload": args.files,
+        "file_size": args.file_size,
+        "upload_seconds": upload_times,
+        "idle_list_ms": {"count": len(idle), "p50": percentile(idle, 50), "p99": percentile(idle, 99)},
+        "loaded_list_ms": {"count": len(loaded), "p50": percentile(loaded, 50), "p99": percentile(loaded, 99)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=4, help="Concurrent folder uploads.")
+    parser.add_argument("--files", type=int, default=500, help="Files per upload.")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="Bytes per file.")
+    parser.add_argument("--interval", type=float, default=0.01, help="Pause between listings in seconds.")
+    parser.add_argument("--idle-seconds", type=float, default=2.0, help="Length of the idle baseline.")
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
+
+
+if __name__ == "__main__":
+    main()
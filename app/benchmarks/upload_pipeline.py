@@ -0,0 +1,298 @@
+"""
+Benchmark suite: the upload pipeline and the listing endpoints on synthetic folder trees.
+
+    python -m app.benchmarks.upload_pipeline --trees wide deep balanced collisions --output after.json
+    python -m app.benchmarks.upload_pipeline --trees custom --width 8 --depth 3 --files 5000 --file-size 4096
+    python -m app.benchmarks.upload_pipeline --compare before.json after.json
+
+Runs the app in process on a fresh SQLite database in a temporary directory and drives
+it over HTTP through httpx's ASGI transport, one request at a time, so the SQL queries of
+every request can be counted. Every tree is uploaded with /folder-upload `repeat` times
+into the root, where the "collisions" tree makes every upload after the first rename its
+top-level folder. The folders of the last upload are then listed with /folder-details
+and /folder-tree.
+
+Per tree and operation it reports requests, throughput, p50/p99 latency in ms, queries
+per request and the peak RSS of the process, client included, after the operation. The
+listing cache is off unless --listing-cache is passed, so listings measure the database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy import event
+
+from .server import REPO_ROOT, percentile
+
+# width: subfolders per folder, depth: folder levels below the top-level folder,
+# files: files spread over all folders, repeat: uploads of the tree into the root
+TREES = {
+    "wide": {"width": 200, "depth": 1, "files": 2000, "repeat": 2},
+    "deep": {"width": 1, "depth": 100, "files": 500, "repeat": 2},
+    "balanced": {"width": 6, "depth": 3, "files": 2000, "repeat": 2},
+    "collisions": {"width": 2, "depth": 1, "files": 20, "repeat": 200},
+}
+
+
+def generate_tree(width: int, depth: int, files: int, prefix: str = "tree"):
+    """
+    Relative paths of a synthetic folder tree below one top-level folder, `width`
+    subfolders per folder over `depth` levels, with the files spread round robin over
+    all folders.
+
+    :param width:
+    :param depth:
+    :param files:
+    :param prefix: name of the top-level folder
+    :return tuple[list[str], list[str]]: file paths and folder paths
+    """
+
+    folders = [prefix]
+    level = [prefix]
+    for _ in range(depth):
+        level = [f"{parent}/dir-{i}" for parent in level for i in range(width)]
+        folders.extend(level)
+    return [f"{folders[i % len(folders)]}/file-{i}.bin" for i in range(files)], folders
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far.
+
+    :return float:
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+class QueryCounter:
+    """
+    Count the statements the app's engines execute.
+    """
+
+    def __init__(self, engines: list):
+        self.count = 0
+        for engine in {id(engine): engine for engine in engines}.values():
+            event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def summarize(tree: str, operation: str, latencies: list[float], queries: list[int], units: dict | None = None):
+    """
+    One result row of an operation.
+
+    :param tree:
+    :param operation:
+    :param latencies: seconds per request
+    :param queries: queries per request
+    :param units: totals per unit, e.g. files and bytes, reported per second as well
+    :return dict:
+    """
+
+    seconds = sum(latencies)
+    row = {
+        "tree": tree,
+        "operation": operation,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries_per_request": sum(queries) / len(queries) if queries else 0.0,
+        "max_queries": max(queries, default=0),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    for unit, total in (units or {}).items():
+        row[f"{unit}_per_second"] = total / seconds if seconds else 0.0
+    return row
+
+
+async def timed(client: httpx.AsyncClient, counter: QueryCounter, method: str, url: str, **kwargs):
+    """
+    Send one request and return its response, latency in seconds and query count.
+    """
+
+    queries = counter.count
+    started = time.perf_counter()
+    response = await client.request(method, url, **kwargs)
+    latency = time.perf_counter() - started
+    response.raise_for_status()
+    return response, latency, counter.count - queries
+
+
+async def bench_tree(client: httpx.AsyncClient, counter: QueryCounter, name: str, spec: dict, args):
+    """
+    Upload one tree `repeat` times and list the folders of the last upload.
+
+    :return list[dict]: result rows
+    """
+
+    paths, _ = generate_tree(spec["width"], spec["depth"], spec["files"], prefix=name)
+    upload_latencies, upload_queries = [], []
+    for _ in range(spec["repeat"]):
+        files = [("files", (os.path.basename(path), os.urandom(args.file_size), "application/octet-stream"))
+                 for path in paths]
+        response, latency, queries = await timed(
+            client, counter, "POST", "/folder-upload", files=files, data={"paths": paths}
+        )
+        last_event = json.loads(response.text.splitlines()[-1])
+        if last_event["stage"] != "upload_complete":
+            raise RuntimeError(f"Upload of {name} failed: {last_event}")
+        upload_latencies.append(latency)
+        upload_queries.append(queries)
+
+    results = [summarize(name, "folder_upload", upload_latencies, upload_queries, {
+        "files": len(paths) * spec["repeat"], "megabytes": len(paths) * spec["repeat"] * args.file_size / 1e6
+    })]
+
+    # Folders of the last upload, its top-level folder is the newest one with the name
+    listing = (await client.get("/folder-details", params={"q": name, "order_by": "id", "limit": 1000})).json()
+    top_folder = max((folder for folder in listing["folders"] if folder["name"].startswith(name)), key=lambda f: f["id"])
+    tree = (await client.get(f"/folder-tree/{top_folder['id']}", params={"limit": 10000})).json()
+    folder_ids = [top_folder["id"]] + [folder["id"] for folder in tree["folders"]]
+
+    sample = random.Random(0)
+    latencies, queries = [], []
+    for _ in range(args.reads):
+        _, latency, count = await timed(
+            client, counter, "GET", f"/folder-details/{sample.choice(folder_ids)}", params={"limit": args.page_size}
+        )
+        latencies.append(latency)
+        queries.append(count)
+    results.append(summarize(name, "folder_details", latencies, queries))
+
+    latencies, queries = [], []
+    for _ in range(max(1, args.reads // 10)):
+        _, latency, count = await timed(client, counter, "GET", f"/folder-tree/{top_folder['id']}", params={"limit": 1000})
+        latencies.append(latency)
+        queries.append(count)
+    results.append(summarize(name, "folder_tree", latencies, queries))
+
+    return results
+
+
+async def run(args, trees: dict):
+    # The app keeps its database and uploads relative to the working directory
+    os.environ.setdefault("LISTING_CACHE_SIZE", "1024" if args.listing_cache else "0")
+    os.chdir(args.workdir)
+    from ..db import create_db_and_tables, engine, read_engine
+    from ..main import app
+
+    await create_db_and_tables()
+    counter = QueryCounter([engine, read_engine])
+
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, spec in trees.items():
+            results.extend(await bench_tree(client, counter, name, spec, args))
+    return results
+
+
+def run_metadata(args, trees: dict):
+    """
+    What a run measured and where, so results of different runs can be told apart.
+
+    :return dict:
+    """
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "database_profile": os.environ.get("DATABASE_PROFILE", "default"),
+        "listing_cache": args.listing_cache,
+        "file_size": args.file_size,
+        "reads": args.reads,
+        "page_size": args.page_size,
+        "trees": trees,
+    }
+
+
+def compare_runs(before: dict, after: dict):
+    """
+    Ratios after / before of the latencies and query counts of every operation both
+    runs measured, below 1 is an improvement.
+
+    :param before: run as written by --output
+    :param after:
+    :return list[dict]:
+    """
+
+    previous = {(row["tree"], row["operation"]): row for row in before["results"]}
+    comparison = []
+    for row in after["results"]:
+        old = previous.get((row["tree"], row["operation"]))
+        if old is None:
+            continue
+        comparison.append({
+            "tree": row["tree"],
+            "operation": row["operation"],
+            **{
+                f"{key}_ratio": row[key] / old[key] if old[key] else None
+                for key in ("p50_ms", "p99_ms", "queries_per_request", "peak_rss_mb")
+            },
+        })
+    return {"before": before["meta"].get("commit"), "after": after["meta"].get("commit"), "results": comparison}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trees", nargs="+", default=list(TREES), choices=[*TREES, "custom"])
+    parser.add_argument("--width", type=int, default=4, help="Subfolders per folder of the custom tree.")
+    parser.add_argument("--depth", type=int, default=3, help="Folder levels of the custom tree.")
+    parser.add_argument("--files", type=int, default=1000, help="Files in the custom tree.")
+    parser.add_argument("--repeat", type=int, default=1, help="Uploads of the custom tree.")
+    parser.add_argument("--file-size", type=int, default=1024, help="Bytes per file.")
+    parser.add_argument("--reads", type=int, default=500, help="Listings per tree.")
+    parser.add_argument("--page-size", type=int, default=100, help="Page size of the listings.")
+    parser.add_argument("--listing-cache", action="store_true", help="Keep the listing cache on.")
+    parser.add_argument("--output", help="Write the results to this JSON file as well.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files.")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            print(json.dumps(compare_runs(json.load(before), json.load(after)), indent=2))
+        return
+
+    trees = {name: TREES[name] for name in args.trees if name != "custom"}
+    if "custom" in args.trees:
+        trees["custom"] = {"width": args.width, "depth": args.depth, "files": args.files, "repeat": args.repeat}
+
+    output = os.path.abspath(args.output) if args.output else None
+    meta = run_metadata(args, trees)
+    with tempfile.TemporaryDirectory(prefix="headache-bench-") as workdir:
+        args.workdir = workdir
+        results = asyncio.run(run(args, trees))
+        os.chdir(REPO_ROOT)
+
+    report = {"meta": meta, "results": results}
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
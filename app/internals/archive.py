@@ -0,0 +1,170 @@
+import logging
+import os
+import time
+import zipfile
+
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document
+from .hierarchy import subtree_filter, ancestor_ids
+
+logger = logging.getLogger(__name__)
+
+# Read size while adding a file to an archive
+ARCHIVE_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# ZIP timestamps start in 1980, a day in so no timezone pushes it back into 1979
+MIN_ZIP_TIMESTAMP = 315619200
+
+# Formats that are compressed already, deflating them again costs CPU for nothing
+STORED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".aac", ".ogg", ".opus", ".flac", ".m4a",
+    ".mp4", ".m4v", ".mov", ".mkv", ".webm", ".avi",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub", ".jar", ".apk",
+    ".pdf", ".woff", ".woff2",
+}
+
+
+def safe_name(name: str | None):
+    """
+    Archive path component for a folder or document name.
+
+    :param name:
+    :return str:
+    """
+
+    name = (name or "").replace("/", "_").replace("\\", "_").strip()
+    return name if name not in ("", ".", "..") else "_"
+
+
+def compression_for(name: str):
+    """
+    Store files that are compressed already, deflate everything else.
+
+    :param name:
+    :return int: zipfile compression constant
+    """
+
+    return zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def _unique(arcname: str, used: set):
+    """
+    Make an archive path unique the way duplicate uploads are named, "name (n).ext".
+    """
+
+    if arcname not in used:
+        used.add(arcname)
+        return arcname
+
+    stem, extension = os.path.splitext(arcname)
+    counter = 1
+    while f"{stem} ({counter}){extension}" in used:
+        counter += 1
+    arcname = f"{stem} ({counter}){extension}"
+    used.add(arcname)
+    return arcname
+
+
+def plan_archive(session, folder: Folder):
+    """
+    Archive entries rebuilding a folder's subtree below a directory named after it, with
+    two range queries. Folders come first so empty ones are kept as directory entries.
+
+    :param session:
+    :param folder:
+    :return list[tuple[str, str | None]]: archive path and file path, None for directories
+    """
+
+    folders = session.exec(select(Folder.id, Folder.name, Folder.path).where(subtree_filter(folder.path))).all()
+
+    # Parents before children, so every folder's directory builds on its parent's
+    used = set()
+    directories = {}
+    for folder_id, name, path in sorted(folders, key=lambda row: len(row[2])):
+        parent = directories.get(ancestor_ids(path)[-2]) if folder_id != folder.id else None
+        directories[folder_id] = _unique(f"{parent}/{safe_name(name)}" if parent else safe_name(name), used)
+
+    entries = [(f"{directories[folder_id]}/", None) for folder_id, _, _ in folders]
+
+    documents = session.exec(
+        select(Document.name, Document.folder_id, Document.file_url)
+        .join(Folder, Folder.id == Document.folder_id)
+        .where(subtree_filter(folder.path))
+        .order_by(Document.folder_id, Document.name, Document.id)
+    ).all()
+    for name, folder_id, file_url in documents:
+        entries.append((_unique(f"{directories[folder_id]}/{safe_name(name)}", used), file_url))
+
+    return entries
+
+
+class _ArchiveBuffer:
+    """
+    Write-only, unseekable file object collecting what zipfile writes until it's taken.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries: list[tuple[str, str | None]], chunk_size: int = ARCHIVE_CHUNK_SIZE):
+    """
+    Build a ZIP archive on the fly, yielding it piece by piece. Files are read in chunks
+    and their data descriptors written after them, so neither the archive nor a file is
+    ever held in memory or on disk. Files missing from disk are skipped.
+
+    :param entries: archive path and file path, None for directories
+    :param chunk_size:
+    :return Iterator[bytes]:
+    """
+
+    buffer = _ArchiveBuffer()
+    with zipfile.ZipFile(buffer, mode="w", allowZip64=True) as archive:
+        for arcname, path in entries:
+            if path is None:
+                archive.writestr(zipfile.ZipInfo(arcname), b"")
+                continue
+
+            try:
+                file = open(path, "rb")
+            except FileNotFoundError:
+                logger.warning("Skipping %s in archive, %s is missing", arcname, path)
+                continue
+
+            with file:
+                stat_result = os.fstat(file.fileno())
+                info = zipfile.ZipInfo(arcname, date_time=time.localtime(max(stat_result.st_mtime, MIN_ZIP_TIMESTAMP))[:6])
+                info.compress_type = compression_for(arcname)
+                info.file_size = stat_result.st_size  # lets zipfile decide on zip64 up front
+
+                with archive.open(info, mode="w") as entry:
+                    while chunk := file.read(chunk_size):
+                        entry.write(chunk)
+                        if data := buffer.take():
+                            yield data
+
+        if data := buffer.take():
+            yield data
+
+    # Central directory, written on close
+    yield buffer.take()
@@ -0,0 +1,310 @@
+from collections import Counter
+
+from fastapi import HTTPException
+from sqlalchemy import update, delete, case, literal, func
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document
+from .blob_store import release_blob_counts
+from .hierarchy import ancestor_ids, subtree_filter, delete_subtree, claim_folders, check_folder_paths
+
+# Ids per UPDATE / DELETE statement
+BATCH_STATEMENT_SIZE = 500
+
+
+class _Cycle(Exception):
+    """
+    A folder was reached again while working out its final path.
+    """
+
+    def __init__(self, folder_id: int):
+        super().__init__(folder_id)
+        self.folder_id = folder_id
+
+
+class BatchPlan:
+    """
+    Validated operations of a batch, grouped the way they are applied.
+    """
+
+    def __init__(self):
+        self.renames = {"folder": {}, "file": {}}  # id -> new name
+        self.folder_moves = {}  # folder id -> new parent id
+        self.file_moves = {}  # document id -> new folder id
+        self.folder_deletes = set()
+        self.file_deletes = set()
+
+        # Current state of the folders and documents the batch touches
+        self.folders = {}  # id -> (parent id, path)
+        self.documents = {}  # id -> (folder id, blob digest, file url)
+
+        # Paths once the moves are applied, filled in by final_path
+        self.final_paths = {}
+
+    def final_path(self, folder_id: int | None, visiting: set | None = None):
+        """
+        Path a folder ends up at once the moves of the batch are applied. Only the paths
+        of folders the batch touches are known, which is enough: a folder not moved
+        itself keeps its path below its lowest moved ancestor.
+
+        :param folder_id: None for the root
+        :param visiting: folders whose path is being worked out
+        :return str:
+        :raise _Cycle: when the moves put a folder below itself
+        """
+
+        if folder_id is None:
+            return "/"
+        if folder_id in self.final_paths:
+            return self.final_paths[folder_id]
+
+        visiting = visiting if visiting is not None else set()
+        if folder_id in visiting:
+            raise _Cycle(folder_id)
+        visiting.add(folder_id)
+
+        if folder_id in self.folder_moves:
+            path = self.final_path(self.folder_moves[folder_id], visiting) + f"{folder_id}/"
+        else:
+            path = self.folders[folder_id][1]
+            chain = ancestor_ids(path)
+            for position in range(len(chain) - 2, -1, -1):
+                if chain[position] in self.folder_moves:
+                    below = "".join(f"{ancestor_id}/" for ancestor_id in chain[position + 1:])
+                    path = self.final_path(chain[position], visiting) + below
+                    break
+
+        visiting.discard(folder_id)
+        self.final_paths[folder_id] = path
+        return path
+
+    def touched_folder_ids(self):
+        """
+        Folders whose listings change: old and new parents of everything the batch touches.
+
+        :return set[int | None]:
+        """
+
+        touched = set(self.folder_moves.values()) | set(self.file_moves.values())
+        for folder_id in set(self.renames["folder"]) | set(self.folder_moves) | self.folder_deletes:
+            touched.add(self.folders[folder_id][0])
+        for document_id in set(self.renames["file"]) | set(self.file_moves) | self.file_deletes:
+            touched.add(self.documents[document_id][0])
+        return touched | self.folder_deletes
+
+
+def _resolve_moves(plan: BatchPlan, errors: dict, move_indexes: dict):
+    """
+    Reject the folder moves that would put a folder below itself, directly or through
+    other moves of the batch, until the remaining moves form a tree.
+    """
+
+    while True:
+        plan.final_paths = {}
+        cyclic = []
+        for folder_id in plan.folder_moves:
+            try:
+                plan.final_path(folder_id)
+            except _Cycle as cycle:
+                if cycle.folder_id == folder_id:
+                    cyclic.append(folder_id)
+        if not cyclic:
+            return
+
+        for folder_id in cyclic:
+            errors[move_indexes[folder_id]] = "Can't move folder into its own subfolder"
+            del plan.folder_moves[folder_id]
+
+
+def plan_batch(session, operations: list):
+    """
+    Validate every operation of a batch up front, with one query for the folders and one
+    for the documents involved. Moves are checked against the tree the whole batch
+    produces, so no combination of moves can create a cycle, and deletes apply to that
+    tree too.
+
+    :param session:
+    :param operations: BatchOperation list
+    :return tuple[BatchPlan, dict[int, str]]: the valid operations and the error of each
+    invalid one by index
+    """
+
+    plan = BatchPlan()
+    errors = {}
+
+    folder_ids = {op.id for op in operations if op.type == "folder"}
+    folder_ids |= {op.parent_id for op in operations if op.op == "move" and op.parent_id is not None}
+    document_ids = {op.id for op in operations if op.type == "file"}
+
+    if folder_ids:
+        plan.folders = {
+            folder_id: (parent_id, path) for folder_id, parent_id, path in session.exec(
+                select(Folder.id, Folder.parent_id, Folder.path).where(Folder.id.in_(folder_ids))
+            ).all()
+        }
+    if document_ids:
+        plan.documents = {
+            document_id: (folder_id, digest, file_url) for document_id, folder_id, digest, file_url in session.exec(
+                select(Document.id, Document.folder_id, Document.blob_digest, Document.file_url)
+                .where(Document.id.in_(document_ids))
+            ).all()
+        }
+
+    seen = set()
+    deleted = set()
+    touched = set()
+    move_indexes = {}
+    for index, op in enumerate(operations):
+        item = (op.type, op.id)
+        exists = op.id in (plan.folders if op.type == "folder" else plan.documents)
+
+        if not exists:
+            errors[index] = "Folder not found" if op.type == "folder" else "File not found"
+        elif (op.op, *item) in seen:
+            errors[index] = f"Item is already {op.op}d in this batch"
+        elif item in deleted or (op.op == "delete" and item in touched):
+            errors[index] = "Item is deleted in this batch"
+        elif op.op == "rename" and not op.name:
+            errors[index] = "Name is required"
+        elif op.op == "move" and op.parent_id is not None and op.parent_id not in plan.folders:
+            errors[index] = "Target folder not found"
+        elif op.op == "move" and op.type == "folder" and op.parent_id == op.id:
+            errors[index] = "Can't reference folder itself!"
+        if index in errors:
+            continue
+
+        seen.add((op.op, *item))
+        if op.op == "delete":
+            deleted.add(item)
+            (plan.folder_deletes if op.type == "folder" else plan.file_deletes).add(op.id)
+            continue
+
+        touched.add(item)
+        if op.op == "rename":
+            plan.renames[op.type][op.id] = op.name
+        elif op.type == "folder":
+            plan.folder_moves[op.id] = op.parent_id
+            move_indexes[op.id] = index
+        else:
+            plan.file_moves[op.id] = op.parent_id
+
+    _resolve_moves(plan, errors, move_indexes)
+
+    # Moving into a folder the batch deletes would delete the item instead. Dropping a
+    # move changes the final paths of others, so check again until nothing changes.
+    deleted_ids = set(plan.folder_deletes)
+    while deleted_ids:
+        plan.final_paths = {}
+        rejected = [
+            (index, op) for index, op in enumerate(operations)
+            if index not in errors and op.op == "move" and op.parent_id is not None
+            and deleted_ids & set(ancestor_ids(plan.final_path(op.parent_id)))
+        ]
+        if not rejected:
+            break
+        for index, op in rejected:
+            errors[index] = "Target folder is deleted in this batch"
+            del (plan.folder_moves if op.type == "folder" else plan.file_moves)[op.id]
+
+    plan.final_paths = {}
+    return plan, errors
+
+
+def _update_in_batches(session, model, ids: list[int], values: dict):
+    for start in range(0, len(ids), BATCH_STATEMENT_SIZE):
+        session.execute(
+            update(model)
+            .where(model.id.in_(ids[start:start + BATCH_STATEMENT_SIZE]))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _rename(session, model, names: dict[int, str]):
+    ids = list(names)
+    for start in range(0, len(ids), BATCH_STATEMENT_SIZE):
+        batch = ids[start:start + BATCH_STATEMENT_SIZE]
+        session.execute(
+            update(model)
+            .where(model.id.in_(batch))
+            .values(name=case({item_id: names[item_id] for item_id in batch}, value=model.id))
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _group_by_target(moves: dict):
+    targets = {}
+    for item_id, target_id in moves.items():
+        targets.setdefault(target_id, []).append(item_id)
+    return targets
+
+
+def apply_batch(session, plan: BatchPlan):
+    """
+    Apply a validated batch with set-based statements, without committing: renames with
+    one UPDATE per batch of ids, moves with one UPDATE per target folder plus one path
+    range UPDATE per moved folder, and deletes on the resulting tree.
+
+    :param session:
+    :param plan:
+    :return tuple[int, int, list[str]]: deleted folders, deleted documents and files of
+    documents stored without a blob
+    :raise HTTPException: 409 when a folder of the batch was moved or deleted since the
+    batch was planned
+    """
+
+    # The plan holds only for the tree it was made on. Folders the batch changes are
+    # claimed first, which takes the write lock, then every folder it relies on is checked
+    # to still be where it was planned.
+    changed = set(plan.renames["folder"]) | set(plan.folder_moves) | plan.folder_deletes
+    relied_on = changed | {target_id for target_id in plan.folder_moves.values() if target_id is not None} \
+        | {target_id for target_id in plan.file_moves.values() if target_id is not None}
+    if not claim_folders(session, {folder_id: (plan.folders[folder_id][1], None) for folder_id in changed}) \
+            or not check_folder_paths(session, {folder_id: plan.folders[folder_id][1] for folder_id in relied_on}):
+        raise HTTPException(409, "Folders of the batch were changed meanwhile, send it again")
+
+    _rename(session, Folder, plan.renames["folder"])
+    _rename(session, Document, plan.renames["file"])
+
+    for target_id, folder_ids in _group_by_target(plan.folder_moves).items():
+        _update_in_batches(session, Folder, folder_ids, {"parent_id": target_id})
+
+    # Deepest first, each subtree is rewritten to its final path at once, and rewriting
+    # an ancestor afterwards leaves paths that already changed alone
+    for folder_id in sorted(plan.folder_moves, key=lambda i: len(plan.folders[i][1]), reverse=True):
+        old_path, new_path = plan.folders[folder_id][1], plan.final_path(folder_id)
+        session.execute(
+            update(Folder)
+            .where(subtree_filter(old_path))
+            .values(path=literal(new_path) + func.substr(Folder.path, len(old_path) + 1), version=Folder.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+    for target_id, document_ids in _group_by_target(plan.file_moves).items():
+        _update_in_batches(session, Document, document_ids, {"folder_id": target_id})
+
+    # Documents first, so none is released twice when its folder is deleted too
+    document_ids = list(plan.file_deletes)
+    counts = Counter(plan.documents[i][1] for i in document_ids if plan.documents[i][1])
+    legacy_files = [plan.documents[i][2] for i in document_ids if not plan.documents[i][1]]
+    release_blob_counts(session, counts)
+    documents_deleted = 0
+    for start in range(0, len(document_ids), BATCH_STATEMENT_SIZE):
+        documents_deleted += session.execute(
+            delete(Document)
+            .where(Document.id.in_(document_ids[start:start + BATCH_STATEMENT_SIZE]))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    # Folders below another deleted folder go with it
+    folders_deleted = 0
+    deleted_paths = {folder_id: plan.final_path(folder_id) for folder_id in plan.folder_deletes}
+    for folder_id, path in deleted_paths.items():
+        if any(path != other and path.startswith(other) for other in deleted_paths.values()):
+            continue
+        folders, documents, files = delete_subtree(session, Folder(id=folder_id, path=path))
+        folders_deleted += folders
+        documents_deleted += documents
+        legacy_files.extend(files)
+
+    return folders_deleted, documents_deleted, legacy_files
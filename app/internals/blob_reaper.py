@@ -0,0 +1,99 @@
+import logging
+import threading
+
+from sqlmodel import Session
+
+from ..db import engine
+from .blob_store import purge_blobs, purge_discarded_files
+
+logger = logging.getLogger(__name__)
+
+# Blobs removed per transaction
+REAP_BATCH_SIZE = 500
+
+# Seconds between sweeps when nobody wakes the reaper up
+REAP_INTERVAL = 60
+
+
+class BlobReaper:
+    """
+    Background thread removing unreferenced blobs in batches. Deletes only drop blob
+    references and wake the reaper, so they return without touching the disk. The blob
+    rows left at ref_count 0 are the reaper's durable queue, whatever is left after a
+    restart is picked up by the first sweep.
+
+    Files of documents stored before blobs existed have no blob row, they are queued as
+    DiscardedFile rows through `blob_store.discard_files` instead.
+    """
+
+    def __init__(self, batch_size: int = REAP_BATCH_SIZE, interval: float = REAP_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the reaper thread.
+
+        :return None:
+        """
+
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="blob-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the reaper thread after its current batch.
+
+        :return None:
+        """
+
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        """
+        Ask for a sweep as soon as possible.
+
+        :return None:
+        """
+
+        self._wake.set()
+
+    def reap(self):
+        """
+        Sweep until no unreferenced blob and no queued file is left.
+
+        :return int: number of blobs and files removed
+        """
+
+        removed = 0
+        with Session(engine) as session:
+            for purge in (purge_blobs, purge_discarded_files):
+                while not self._stop.is_set():
+                    purged = purge(session, limit=self.batch_size)
+                    removed += purged
+                    if purged < self.batch_size:
+                        break
+
+        return removed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Blob reaper sweep failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+blob_reaper = BlobReaper()
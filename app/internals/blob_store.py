@@ -0,0 +1,267 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from sqlalchemy import delete, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Blob, DiscardedFile
+from .metrics import metrics, record_disk_write
+
+UPLOAD_DIR = "uploads"
+
+# Blobs live under their digest, files being received are kept in TMP_DIR until their
+# digest is known and their rows are committed.
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")
+os.makedirs(BLOB_DIR, exist_ok=True)
+os.makedirs(TMP_DIR, exist_ok=True)
+
+# Block size used when hashing and copying a file object
+COPY_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Digests per UPDATE when releasing references
+RELEASE_BATCH_SIZE = 500
+
+# Serializes "does the blob file exist" decisions against removing blob files, see
+# place_blob and purge_blobs.
+_blob_files_lock = threading.Lock()
+
+
+def new_hasher():
+    """
+    Hash used for content addresses.
+
+    :return hashlib._Hash:
+    """
+
+    return hashlib.sha256()
+
+
+def blob_path(digest: str):
+    """
+    Location of a blob on disk, fanned out over two directory levels.
+
+    :param digest:
+    :return str:
+    """
+
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def new_temp_path():
+    """
+    Fresh location for a file whose digest isn't known yet.
+
+    :return str:
+    """
+
+    return os.path.join(TMP_DIR, uuid.uuid4().hex)
+
+
+def store_temp_file(fileobj):
+    """
+    Copy a file object to a temporary file in fixed size chunks, hashing it on the way.
+
+    :param fileobj:
+    :return tuple[str, str, int]: temporary path, digest and size
+    """
+
+    temp_path = new_temp_path()
+    hasher = new_hasher()
+    size = 0
+
+    with open(temp_path, "wb") as buffer:
+        while chunk := fileobj.read(COPY_CHUNK_SIZE):
+            hasher.update(chunk)
+            started = time.perf_counter() if metrics.enabled else None
+            buffer.write(chunk)
+            if started is not None:
+                record_disk_write(len(chunk), started)
+            size += len(chunk)
+
+    return temp_path, hasher.hexdigest(), size
+
+
+def place_blob(temp_path: str, digest: str):
+    """
+    Move a committed temporary file to its blob location, or drop it when the blob is
+    already stored. Must only be called once the rows referencing the blob are committed.
+
+    :param temp_path:
+    :param digest:
+    :return None:
+    """
+
+    path = blob_path(digest)
+    with _blob_files_lock:
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+
+
+def blob_file_exists(digest: str):
+    """
+    Check whether the blob file is on disk.
+
+    :param digest:
+    :return bool:
+    """
+
+    with _blob_files_lock:
+        return os.path.exists(blob_path(digest))
+
+
+def _dialect_insert(session):
+    """
+    INSERT construct supporting ON CONFLICT for the session's database.
+    """
+
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+def acquire_blobs(session, blobs: list[tuple[str, int]]):
+    """
+    Take one reference per (digest, size) pair, creating missing blob rows. Repeated
+    digests take several references.
+
+    :param session:
+    :param blobs:
+    :return None:
+    """
+
+    counts = Counter(digest for digest, _ in blobs)
+    sizes = dict(blobs)
+    if not counts:
+        return
+
+    rows = [
+        {"digest": digest, "size": sizes[digest], "file_url": blob_path(digest), "ref_count": count}
+        for digest, count in counts.items()
+    ]
+    statement = _dialect_insert(session)(Blob).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Blob.digest],
+        set_={"ref_count": Blob.ref_count + statement.excluded.ref_count}
+    )
+    session.execute(statement)
+
+
+def release_blobs(session, digests: list[str]):
+    """
+    Drop one reference per digest.
+
+    :param session:
+    :param digests:
+    :return None:
+    """
+
+    release_blob_counts(session, Counter(digest for digest in digests if digest))
+
+
+def release_blob_counts(session, counts: dict[str, int]):
+    """
+    Drop the given number of references per digest, with one UPDATE per distinct number
+    of references and batch of digests.
+
+    :param session:
+    :param counts:
+    :return None:
+    """
+
+    by_count = {}
+    for digest, count in counts.items():
+        if digest:
+            by_count.setdefault(count, []).append(digest)
+
+    for count, grouped_digests in by_count.items():
+        for start in range(0, len(grouped_digests), RELEASE_BATCH_SIZE):
+            batch = grouped_digests[start:start + RELEASE_BATCH_SIZE]
+            session.execute(update(Blob).where(Blob.digest.in_(batch)).values(ref_count=Blob.ref_count - count))
+
+
+def purge_blobs(session, digests: list[str] | None = None, limit: int | None = None):
+    """
+    Remove unreferenced blobs, optionally restricted to the given digests or to a batch
+    of `limit` blobs. Rows are deleted and committed first, files are only removed if no
+    upload re-created the row meanwhile.
+
+    :param session:
+    :param digests:
+    :param limit:
+    :return int: number of blob rows purged
+    """
+
+    candidates = select(Blob.digest).where(Blob.ref_count <= 0)
+    if digests is not None:
+        candidates = candidates.where(Blob.digest.in_([digest for digest in digests if digest]))
+    if limit is not None:
+        candidates = candidates.limit(limit)
+
+    statement = delete(Blob).where(Blob.digest.in_(candidates)).returning(Blob.digest)
+    purged = list(session.execute(statement).scalars().all())
+    session.commit()
+    if not purged:
+        return 0
+
+    with _blob_files_lock:
+        revived = set(session.exec(select(Blob.digest).where(Blob.digest.in_(purged))).all())
+        for digest in purged:
+            if digest in revived:
+                continue
+            try:
+                os.remove(blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    return len(purged)
+
+
+def discard_files(session, paths: list[str]):
+    """
+    Queue plain files for the blob reaper, as part of the session's transaction, so they
+    are only removed once the documents pointing at them are deleted for good.
+
+    :param session:
+    :param paths:
+    :return None:
+    """
+
+    paths = [path for path in paths if path]
+    if paths:
+        session.execute(insert(DiscardedFile), [{"path": path} for path in paths])
+
+
+def purge_discarded_files(session, limit: int | None = None):
+    """
+    Remove queued plain files, optionally a batch of `limit` of them. Files go before
+    their rows, so a crash in between only leaves rows of files that are gone already.
+
+    :param session:
+    :param limit:
+    :return int: number of queued files handled
+    """
+
+    statement = select(DiscardedFile.id, DiscardedFile.path).order_by(DiscardedFile.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    queued = session.exec(statement).all()
+    if not queued:
+        return 0
+
+    for _, path in queued:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    session.execute(delete(DiscardedFile).where(DiscardedFile.id.in_([file_id for file_id, _ in queued])))
+    session.commit()
+    return len(queued)
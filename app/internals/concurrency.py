@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import anyio
+
+# Threads reserved for blocking upload work, i.e. disk writes and bulk inserts. They are
+# kept apart from the threadpool FastAPI runs sync endpoints in, so a few large uploads
+# can't starve regular requests such as folder listings.
+UPLOAD_THREADS = int(os.getenv("UPLOAD_THREADS", "4"))
+
+
+async def _wait_for_thread(future):
+    """
+    Await the result of an executor future. A cancelled caller still waits for the thread
+    to finish before the cancellation goes on, a thread can't be stopped and the caller's
+    cleanup must not run alongside it, e.g. a rollback while the thread inserts rows.
+
+    :param future:
+    :return Any:
+    """
+
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        with anyio.CancelScope(shield=True):
+            await asyncio.wait([future])
+        raise
+
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_THREADS, thread_name_prefix="upload")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking callable on the upload executor and wait for it without blocking the
+    event loop. It runs in a copy of the caller's context, like FastAPI's threadpool, and
+    is waited for even when the caller is cancelled.
+
+    :param func:
+    :param args:
+    :param kwargs:
+    :return Any:
+    """
+
+    loop = asyncio.get_running_loop()
+    return await _wait_for_thread(
+        loop.run_in_executor(upload_executor, partial(contextvars.copy_context().run, func, *args, **kwargs))
+    )
+
+
+# Threads shared by the parallel file writers of all uploads, each upload is further
+# limited by its own number of writers.
+WRITE_THREADS = int(os.getenv("UPLOAD_WRITE_THREADS", "16"))
+
+write_executor = ThreadPoolExecutor(max_workers=WRITE_THREADS, thread_name_prefix="upload-write")
+
+
+async def run_write(func, *args, **kwargs):
+    """
+    Run a blocking file operation on the write executor.
+
+    :param func:
+    :param args:
+    :param kwargs:
+    :return Any:
+    """
+
+    loop = asyncio.get_running_loop()
+    return await _wait_for_thread(
+        loop.run_in_executor(write_executor, partial(contextvars.copy_context().run, func, *args, **kwargs))
+    )
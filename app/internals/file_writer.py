@@ -0,0 +1,251 @@
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from .concurrency import run_write
+from .blob_store import new_hasher
+from .metrics import metrics, record_disk_write
+
+# Writers working on one upload at the same time
+WRITE_WORKERS = int(os.getenv("UPLOAD_WRITE_WORKERS", "4"))
+
+# Chunks allowed to wait for a free writer before the producer is made to wait
+MAX_BUFFERED_CHUNKS = 16
+
+# Chunks from this size on are hashed off the event loop
+HASH_OFFLOAD_SIZE = 64 * 1024  # 64KB
+
+
+@dataclass
+class StoredFile:
+    """
+    A file part of a folder upload written to `file_path`, a temporary location until
+    its blob is placed, together with the digest of its content. Files linked to a blob
+    that is stored already have no `file_path`.
+    """
+
+    filename: str
+    file_path: str | None
+    size: int = 0
+    error: str | None = None
+    digest: str | None = None
+
+
+def remove_stored_file(file: StoredFile):
+    """
+    Remove a stored file from disk, ignoring files that were never created.
+
+    :param file:
+    :return None:
+    """
+
+    if file.file_path is None:
+        return
+    try:
+        os.remove(file.file_path)
+    except FileNotFoundError:
+        pass
+
+
+def discard_stored_files(files: list[StoredFile]):
+    """
+    Remove whatever is left of stored files at their temporary location, files whose blobs
+    were placed are already gone from there.
+
+    :param files:
+    :return None:
+    """
+
+    for file in files:
+        remove_stored_file(file)
+
+
+class FileHandle:
+    """
+    Writer side state of one file: its descriptor, the offset of the next chunk, the
+    chunks still waiting to be written and the running hash of its content.
+    """
+
+    def __init__(self, file: StoredFile):
+        self.file = file
+        self.hasher = new_hasher()
+        self.fd = None
+        self.offset = 0
+        self.pending = 0
+        self.ended = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+def write_at(handle: FileHandle, data: bytes, offset: int):
+    """
+    Write the whole chunk at the given offset. Uses pwrite where available so chunks of
+    the same file can be written by several threads at once.
+
+    :param handle:
+    :param data:
+    :param offset:
+    :return None:
+    """
+
+    started = time.perf_counter() if metrics.enabled else None
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(handle.fd, view, offset)
+        else:
+            with handle.lock:
+                os.lseek(handle.fd, offset, os.SEEK_SET)
+                written = os.write(handle.fd, view)
+        view = view[written:]
+        offset += written
+
+    if started is not None:
+        record_disk_write(len(data), started)
+
+
+class ParallelFileWriter:
+    """
+    Writes the files of an upload through a pool of writers. Every chunk carries its own
+    offset, so chunks of many small files as well as chunks of one large file are written
+    concurrently. At most `max_buffered` chunks wait in memory, producers wait for room
+    beyond that. A failing file gets its `error` set and is removed, the others go on.
+    Chunks are hashed in the order they are queued, so every file ends with its digest.
+
+        async with ParallelFileWriter(workers=4) as writer:
+            handle = await writer.open(file)
+            await writer.write(handle, chunk)
+            await writer.end(handle)
+    """
+
+    def __init__(self, workers: int = WRITE_WORKERS, max_buffered: int = MAX_BUFFERED_CHUNKS):
+        self.workers = max(1, workers)
+        self.max_buffered = max(1, max_buffered)
+        self.handles: list[FileHandle] = []
+        self._queue = None
+        self._tasks = []
+
+    async def __aenter__(self):
+        self._queue = asyncio.Queue(maxsize=self.max_buffered)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.finish()
+        else:
+            await self.abort()
+
+    async def open(self, file: StoredFile):
+        """
+        Create the file on disk and return its handle.
+
+        :param file:
+        :return FileHandle:
+        """
+
+        handle = FileHandle(file)
+        self.handles.append(handle)
+        try:
+            handle.fd = await run_write(os.open, file.file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        except OSError as e:
+            file.error = str(e)
+        return handle
+
+    async def write(self, handle: FileHandle, data: bytes):
+        """
+        Queue the next chunk of a file, waiting while the buffer is full.
+
+        :param handle:
+        :param data:
+        :return None:
+        """
+
+        if handle.file.error:
+            return
+
+        if len(data) >= HASH_OFFLOAD_SIZE:
+            await run_write(handle.hasher.update, data)
+        else:
+            handle.hasher.update(data)
+
+        offset = handle.offset
+        handle.offset += len(data)
+        handle.pending += 1
+        await self._queue.put((handle, data, offset))
+
+    async def end(self, handle: FileHandle):
+        """
+        Mark a file as complete, it's closed as soon as its queued chunks are written.
+
+        :param handle:
+        :return None:
+        """
+
+        handle.ended = True
+        handle.file.digest = handle.hasher.hexdigest()
+        if handle.pending == 0:
+            await self._close(handle)
+
+    async def finish(self):
+        """
+        Wait for every queued chunk to be written and stop the writers.
+
+        :return None:
+        """
+
+        await self._queue.join()
+        self._stop()
+        for handle in self.handles:
+            await self._close(handle)
+
+    async def abort(self):
+        """
+        Stop the writers and remove every file written so far.
+
+        :return None:
+        """
+
+        # Let chunks already being written finish before closing their descriptors, the
+        # queued ones are skipped once their file is marked as failed.
+        for handle in self.handles:
+            handle.file.error = handle.file.error or "Upload aborted"
+        await self._queue.join()
+        self._stop()
+
+        for handle in self.handles:
+            await self._close(handle)
+            await run_write(remove_stored_file, handle.file)
+
+    def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            handle, data, offset = await self._queue.get()
+            try:
+                if not handle.file.error:
+                    try:
+                        await run_write(write_at, handle, data, offset)
+                        handle.file.size += len(data)
+                    except OSError as e:
+                        handle.file.error = str(e)
+                handle.pending -= 1
+                if handle.ended and handle.pending == 0:
+                    await self._close(handle)
+            finally:
+                self._queue.task_done()
+
+    async def _close(self, handle: FileHandle):
+        if handle.closed:
+            return
+        handle.closed = True
+
+        if handle.fd is not None:
+            await run_write(os.close, handle.fd)
+        if handle.file.error:
+            await run_write(remove_stored_file, handle.file)
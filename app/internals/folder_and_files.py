@@ -1,15 +1,20 @@
-import asyncio
 import json
 import os
-import shutil
-import uuid
+import time
+from collections import Counter
+
+import anyio
+from sqlalchemy import insert, or_, and_
 from sqlmodel import select
 
 from ..models.database.folder_and_files import Folder, Document
-from fastapi import UploadFile
-
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+from .folder_upload import StoredFile
+from .file_writer import discard_stored_files
+from .blob_store import blob_path, acquire_blobs, place_blob, release_blob_counts
+from .hierarchy import fill_folder_paths
+from .concurrency import run_blocking
+from .listing_cache import listing_cache
+from .metrics import StageSpans
 
 STAGES = {
     'VALIDATION': 'file_validation',
@@ -20,35 +25,77 @@ STAGES = {
     'COMPLETE': 'upload_complete'
 }
 
+# Rows per multi-row INSERT statement while materializing an upload
+BATCH_SIZE = 500
 
-# Helper function to create a document
-async def create_document(file: UploadFile, session):
-    """
-    Helper function to create a document
+# Documents inserted between intermediate commits, None commits the upload once
+COMMIT_EVERY = None
 
-    :param file:
-    :param session:
-    :return DocumentPublic:
+# Default cap on per-file progress events when a request doesn't choose its own policy
+PROGRESS_MAX_RATE = 10  # events per second
+
+
+class ProgressThrottle:
+    """
+    Coalesces per-file progress events. An event is let through once `every_n_files` files
+    passed since the last one, or once `1 / max_per_second` seconds elapsed, whichever comes
+    first. The first and last file of a stage always get an event.
     """
 
-    # Generating a unique filename to avoid conflicts
-    base_file_name = os.path.basename(file.filename)
-    unique_filename = f"{uuid.uuid4()}_{base_file_name}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
+    def __init__(self, every_n_files: int | None = None, max_per_second: float | None = None):
+        if every_n_files is None and max_per_second is None:
+            max_per_second = PROGRESS_MAX_RATE
 
-    # Reading file contents as bytes to directly write in disk
-    file_content = await file.read()
-    with open(file_path, "wb") as buffer:
-        buffer.write(file_content)
+        self.every_n_files = every_n_files
+        self.min_interval = 1 / max_per_second if max_per_second else None
+        self._last_count = 0
+        self._last_time = None
 
-    new_file = Document(name=base_file_name, file_url=file_path)
+    def should_emit(self, count: int, total: int):
+        """
+        Check whether the event for the `count`-th of `total` files should be sent.
 
-    # Commit into db
-    session.add(new_file)
-    session.commit()
-    session.refresh(new_file)
+        :param count:
+        :param total:
+        :return bool:
+        """
+
+        now = time.monotonic()
+        emit = (
+            self._last_time is None
+            or count >= total
+            or (self.every_n_files is not None and count - self._last_count >= self.every_n_files)
+            or (self.min_interval is not None and now - self._last_time >= self.min_interval)
+        )
+
+        if emit:
+            self._last_count = count
+            self._last_time = now
+
+        return emit
+
+
+# Helper function to build a document row
+def build_document(file: StoredFile, folder_id: int | None = None):
+    """
+    Helper function to build a document row for a file already streamed to disk, pointing
+    at the blob of its content
+
+    :param file:
+    :param folder_id:
+    :return dict:
+    """
+
+    # Files that failed while streaming to disk have nothing to point at
+    if file.error:
+        raise OSError(file.error)
 
-    return new_file
+    return {
+        "name": os.path.basename(file.filename),
+        "file_url": blob_path(file.digest),
+        "folder_id": folder_id,
+        "blob_digest": file.digest
+    }
 
 
 # Get folder by name and parent
@@ -69,16 +116,37 @@ async def get_folder_by_name(session, name: str, parent_folder: int | None = Non
     return result.first()
 
 
-# Generate a unique folder name if one already exists
-async def get_unique_folder_name(session, name: str, parent_folder: int | None = None):
+# Existing sibling folder names that can collide with a name
+def get_colliding_folder_names(session, name: str, parent_folder: int | None = None):
     """
-    Helper function to generate a unique folder name if one already exists appending 
-    counter at the end of the folder name.
+    Fetch the names of all folders under the parent that are either the name itself or one
+    of its numbered variants ("name (1)", "name (2)", ...) with a single range query.
 
     :param session:
     :param name:
     :param parent_folder:
-    :return str:
+    :return set[str]:
+    """
+
+    # "name (" <= candidate < "name )" covers every suffixed variant and stays index friendly
+    prefix = f"{name} ("
+    statement = select(Folder.name).where(
+        Folder.parent_id == parent_folder,
+        or_(Folder.name == name, and_(Folder.name >= prefix, Folder.name < f"{name} )"))
+    )
+
+    return set(session.exec(statement).all())
+
+
+# Pick the first free name given the names already taken
+def pick_unique_folder_name(name: str, taken_names: set[str]):
+    """
+    Helper function to pick the first of "name", "name (1)", "name (2)", ... that isn't
+    taken, without touching the db.
+
+    :param name:
+    :param taken_names:
+    :return tuple[str, bool]:
     """
 
     # Base name and counter for unique name
@@ -87,79 +155,402 @@ async def get_unique_folder_name(session, name: str, parent_folder: int | None =
     current_name = base_name
 
     # Loop until a unique name is found
-    while await get_folder_by_name(session, current_name, parent_folder) is not None:
+    while current_name in taken_names:
         counter += 1
         current_name = f"{base_name} ({counter})"
 
     return current_name, (counter > 0)
 
 
+# Generate a unique folder name if one already exists
+async def get_unique_folder_name(session, name: str, parent_folder: int | None = None):
+    """
+    Helper function to generate a unique folder name if one already exists appending 
+    counter at the end of the folder name.
+
+    :param session:
+    :param name:
+    :param parent_folder:
+    :return str:
+    """
+
+    taken_names = await run_blocking(get_colliding_folder_names, session, name, parent_folder)
+    return pick_unique_folder_name(name, taken_names)
+
+
+# Paths of an upload as seen from the folder it is uploaded into
+def normalize_upload_paths(paths: list[str], root_folder_path: str = ""):
+    """
+    Normalize the relative paths of an upload, prefixed with the name of the target
+    folder when there is one, which is how the target folder is found in the plan.
+
+    :param paths:
+    :param root_folder_path: normalized name of the target folder
+    :return list[str]:
+    """
+
+    return [
+        os.path.normpath(f"{root_folder_path}/{path}") if root_folder_path else os.path.normpath(path)
+        for path in paths
+    ]
+
+
+# Work out the folder hierarchy described by the upload paths
+def plan_folder_tree(normalized_paths: list[str]):
+    """
+    Compute the whole directory tree of an upload in memory, without touching the db.
+
+    The last component of every path is the file, all others are folders, whatever their
+    names look like. Directories are kept in a prefix tree keyed by their path, so a file
+    whose directory is known costs one lookup and every directory is added exactly once,
+    after its missing ancestors. Planning is linear in the number of path components.
+
+    :param normalized_paths:
+    :return tuple[list[list[tuple[str, str, str | None]]], dict[str, str | None]]:
+        folders grouped by depth as (full path, name, parent path), and the parent folder
+        path of every file path.
+    """
+
+    levels = []
+    depths = {}  # planned folder path -> depth
+    file_parents = {}
+
+    for full_path in normalized_paths:
+        parent_path = full_path.rpartition(os.sep)[0] or None
+        file_parents[full_path] = parent_path
+
+        # Directories of the file not planned yet, deepest first
+        missing = []
+        folder_path = parent_path
+        while folder_path and folder_path not in depths:
+            missing.append(folder_path)
+            folder_path = folder_path.rpartition(os.sep)[0]
+
+        for folder_path in reversed(missing):
+            folder_parent, _, name = folder_path.rpartition(os.sep)
+            folder_parent = folder_parent or None
+            depth = depths[folder_parent] + 1 if folder_parent else 0
+            depths[folder_path] = depth
+            if len(levels) <= depth:
+                levels.append([])
+            levels[depth].append((folder_path, name, folder_parent))
+
+    return levels, file_parents
+
+
+def supports_copy(session):
+    """
+    Check whether the session's connection can bulk load with COPY (Postgres via psycopg).
+
+    :param session:
+    :return bool:
+    """
+
+    dialect = session.get_bind().dialect
+    return dialect.name == "postgresql" and dialect.driver == "psycopg"
+
+
+def copy_rows(session, model, rows: list[dict]):
+    """
+    Stream rows into the model's table with COPY FROM STDIN, on the session's connection
+    and transaction.
+
+    :param session:
+    :param model:
+    :param rows: dicts with the same keys
+    :return None:
+    """
+
+    table = model.__table__
+    quote = session.get_bind().dialect.identifier_preparer.quote
+    columns = list(rows[0])
+
+    cursor = session.connection().connection.cursor()
+    try:
+        with cursor.copy(f"COPY {quote(table.name)} ({', '.join(quote(column) for column in columns)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row([row[column] for column in columns])
+    finally:
+        cursor.close()
+
+
+# Insert rows with COPY on Postgres when nothing has to come back, otherwise in batches of
+# multi-row INSERT statements, with RETURNING when the ids of the rows are needed
+def bulk_insert(session, model, rows: list[dict], batch_size: int = BATCH_SIZE, returning=None):
+    """
+    Insert rows with one multi-row INSERT per batch instead of one statement per row.
+
+    :param session:
+    :param model:
+    :param rows:
+    :param batch_size:
+    :param returning: column to return for every row, in the order of rows
+    :return list:
+    """
+
+    # Postgres loads rows fastest through COPY, when nothing has to come back
+    if returning is None and rows and supports_copy(session):
+        copy_rows(session, model, rows)
+        return []
+
+    returned = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if returning is not None:
+            # "insertmanyvalues" renders multi-row VALUES and keeps RETURNING in row order
+            statement = insert(model).returning(returning, sort_by_parameter_order=True)
+            returned.extend(session.execute(statement, batch).scalars().all())
+        else:
+            session.execute(insert(model).values(batch))
+
+    return returned
+
+
+# Insert one level of the planned folder tree
+def create_folder_level(
+    session,
+    level: list[tuple[str, str, str | None]],
+    folder_mapper: dict,
+    sibling_names: dict,
+    created_folder_ids: set,
+    renamed_folders: list,
+    batch_size: int = BATCH_SIZE
+):
+    """
+    Resolve unique names for one depth level of planned folders and insert them with
+    multi-row INSERTs, registering the new folders in `folder_mapper`. Their paths are
+    filled in from the previous level's.
+
+    :param session:
+    :param level: planned folders as (full path, name, parent path)
+    :param folder_mapper: normalized path to folder, updated in place
+    :param sibling_names: names handed out per parent id during the upload, updated in place
+    :param created_folder_ids: ids of folders created by the upload, updated in place
+    :param renamed_folders: renamed folder reports, updated in place
+    :param batch_size:
+    :return None:
+    """
+
+    folder_rows = []
+    folder_paths = []
+
+    for current_full_path, current, parent_path in level:
+        if current_full_path in folder_mapper:
+            continue
+        parent_folder = folder_mapper.get(parent_path)
+        parent_id = parent_folder.id if parent_folder else None
+
+        # Ensure unique folder names. Folders created by this upload have no siblings
+        # in the db yet, only the names this upload already gave out under them.
+        taken_names = sibling_names.setdefault(parent_id, set())
+        if parent_id not in created_folder_ids:
+            taken_names = taken_names | get_colliding_folder_names(session, current, parent_id)
+        unique_name, was_renamed = pick_unique_folder_name(current, taken_names)
+        sibling_names[parent_id].add(unique_name)
+
+        if was_renamed:
+            renamed_folders.append({
+                'original_path': current_full_path,
+                'new_name': unique_name,
+                'parent_folder': parent_folder.name if parent_folder else None
+            })
+
+        folder_rows.append({"name": unique_name, "parent_id": parent_id})
+        folder_paths.append(current_full_path)
+
+    folder_ids = bulk_insert(session, Folder, folder_rows, batch_size, returning=Folder.id)
+    fill_folder_paths(session, folder_ids)
+    for current_full_path, row, new_id in zip(folder_paths, folder_rows, folder_ids):
+        folder_mapper[current_full_path] = Folder(id=new_id, **row)
+        created_folder_ids.add(new_id)
+
+
+# Insert document rows and commit them
+def insert_documents(
+    session,
+    documents: list[tuple[dict, StoredFile]],
+    batch_size: int = BATCH_SIZE,
+    commit_every: int | None = None,
+    before_commit=None
+):
+    """
+    Insert documents in batches together with the references on their blobs, committing
+    every `commit_every` rows if asked to and once at the end otherwise. Blobs of the
+    committed documents are placed after each commit.
+
+    :param session:
+    :param documents: document rows with the stored file they point at
+    :param batch_size:
+    :param commit_every:
+    :param before_commit: called with the session right before the final commit, to make
+    more changes part of it
+    :return None:
+    """
+
+    uncommitted = []
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        acquire_blobs(session, [(file.digest, file.size) for _, file in batch])
+        bulk_insert(session, Document, [row for row, _ in batch], batch_size)
+        uncommitted.extend(file for _, file in batch)
+        if commit_every and len(uncommitted) >= commit_every:
+            session.commit()
+            place_stored_files(uncommitted)
+            uncommitted = []
+    if before_commit:
+        before_commit(session)
+    session.commit()
+    place_stored_files(uncommitted)
+
+
+# Move committed files to their blobs
+def place_stored_files(files: list[StoredFile]):
+    """
+    Place the blobs of stored files whose documents are committed.
+
+    :param files:
+    :return None:
+    """
+
+    for file in files:
+        # Linked files point at a blob that is stored already
+        if file.file_path is not None:
+            place_blob(file.file_path, file.digest)
+
+
+# Point existing documents at new content
+def replace_document_contents(session, replacements: list[tuple[int, StoredFile]]):
+    """
+    Swap the blobs of existing documents, taking references on the new blobs and dropping
+    those on the old ones in the same transaction. Documents whose content is unchanged
+    are left alone.
+
+    :param session:
+    :param replacements: document id with the stored file holding its new content
+    :return tuple[int, list[int]]: documents replaced, and the ids of documents that are gone
+    """
+
+    documents = {
+        document.id: document
+        for document in session.exec(select(Document).where(Document.id.in_([i for i, _ in replacements]))).all()
+    } if replacements else {}
+
+    changed, gone = [], []
+    for document_id, file in replacements:
+        document = documents.get(document_id)
+        if document is None:
+            gone.append(document_id)
+        elif document.blob_digest != file.digest:
+            changed.append((document, file))
+
+    # Blob rows first, the documents reference them
+    used = [file for _, file in changed]
+    acquire_blobs(session, [(file.digest, file.size) for file in used])
+    release_blob_counts(session, Counter(document.blob_digest for document, _ in changed if document.blob_digest))
+    for document, file in changed:
+        document.blob_digest = file.digest
+        document.file_url = blob_path(file.digest)
+        session.add(document)
+    folder_ids = {document.folder_id for document, _ in changed}
+    session.commit()
+    listing_cache.invalidate(*folder_ids)
+    place_stored_files(used)
+    return len(used), gone
+
+
 # Streaming function for file upload and folder structure creation
-async def stream_progress(paths: list[str], files: list[UploadFile], session, folder_id: int | None = None):
+async def stream_progress(
+    paths: list[str],
+    files: list[StoredFile],
+    session,
+    folder_id: int | None = None,
+    batch_size: int = BATCH_SIZE,
+    commit_every: int | None = COMMIT_EVERY,
+    progress: ProgressThrottle | None = None,
+    existing_folders: dict | None = None,
+    before_commit=None,
+    discard_on_error: bool = True
+):
     """
     Main algorithm for file upload and folder structure creation preserving parent child
     relationship.
 
+    The folder tree is planned in memory, folders are inserted level by level and documents
+    in batches, all inside one transaction unless `commit_every` asks for intermediate
+    commits every that many documents.
+
     :param paths:
     :param files:
     :param session:
     :param folder_id:
+    :param batch_size:
+    :param commit_every:
+    :param progress: policy for coalescing per-file progress events
+    :param existing_folders: normalized path to existing folder, reused instead of creating
+    a renamed one
+    :param before_commit: called with the session right before the documents are committed
+    :param discard_on_error: remove the stored files when the upload fails, off when the
+    caller decides whether they are still needed
     :return StreamingResponse:
     """
 
+    progress = progress or ProgressThrottle()
+    spans = StageSpans()
+
     try:
         # Initial required variables
         all_files = files
         all_paths = paths
-        folder_mapper = {}
-        documents_to_update = []
+        folder_mapper = dict(existing_folders or {})
         renamed_folders = []
 
+        # Sibling names handed out per parent id during this upload
+        sibling_names = {}
+        created_folder_ids = set()
+
         # Determine root folder stage
+        spans.enter(STAGES['FOLDER_STRUCTURE'])
         yield json.dumps({"stage": STAGES['FOLDER_STRUCTURE'], "message": "Determining root folder"}) + "\n"
-        await asyncio.sleep(0.1)
 
         # Set root folder path if folder_id is given
         root_folder_path = ""
         if folder_id:
-            root_folder = session.get(Folder, folder_id)
+            root_folder = await run_blocking(session.get, Folder, folder_id)
             if not root_folder:
+                if discard_on_error:
+                    await run_blocking(discard_stored_files, files)
                 yield json.dumps({"stage": STAGES['ERROR'], "message": "Parent folder not found"}) + "\n"
                 return
             root_folder_path = os.path.normpath(root_folder.name)
             folder_mapper[root_folder_path] = root_folder
 
         # Normalize paths 
-        normalized_paths = [
-            os.path.normpath(f"{root_folder_path}/{path}") if root_folder_path else os.path.normpath(path)
-            for path in all_paths
-        ]
+        normalized_paths = normalize_upload_paths(all_paths, root_folder_path)
 
         # Create documents stage
+        spans.enter(STAGES['DOCUMENT_CREATION'])
         yield json.dumps({"stage": STAGES['DOCUMENT_CREATION'], "message": "Creating documents"}) + "\n"
-        await asyncio.sleep(0.1)
 
         created_count = 0
         failed_files = []
         documents = []
 
-        # Create documents and stream progress by yielding progress
-        for file in all_files:
+        # Build document rows and stream progress by yielding progress, rows are inserted
+        # once their folders exist.
+        for file, path in zip(all_files, normalized_paths):
             base_file_name = os.path.basename(file.filename)
             try:
-                document = await create_document(file, session)
-                documents.append(document)
+                documents.append((path, build_document(file), file))
                 created_count += 1
 
-                # Yield progress
-                yield json.dumps({
-                    "stage": STAGES['DOCUMENT_CREATION'],
-                    "message": f"Successfully created document: {base_file_name}",
-                    "created_count": created_count,
-                    "valid_files_count": len(all_files)
-                }) + "\n"
-
-                await asyncio.sleep(0.1)
+                # Yield progress, coalesced by the throttle
+                if progress.should_emit(created_count + len(failed_files), len(all_files)):
+                    yield json.dumps({
+                        "stage": STAGES['DOCUMENT_CREATION'],
+                        "message": f"Successfully created document: {base_file_name}",
+                        "created_count": created_count,
+                        "valid_files_count": len(all_files)
+                    }) + "\n"
 
             except Exception as e:
                 failed_files.append(base_file_name)
@@ -168,77 +559,75 @@ async def stream_progress(paths: list[str], files: list[UploadFile], session, fo
                     "message": f"Failed to create document: {base_file_name}",
                     "error": str(e)
                 }) + "\n"
-                await asyncio.sleep(0.1)
-
-        # Document mapper to get documents by their relative paths inside the main algorithm.
-        document_mapper = {path: doc for doc, path in zip(documents, normalized_paths)}
 
         # Create folder structure stage.
+        spans.enter(STAGES['FOLDER_STRUCTURE'])
         yield json.dumps({"stage": STAGES['FOLDER_STRUCTURE'], "message": "Creating folder structure"}) + "\n"
 
-        # Main algorithm to create folder structure and update documents relation with the folder structure.
-        for full_path in normalized_paths:
-
-            path_parts = []
-            current_path = full_path
-
-            while True:
-                current_path, part = os.path.split(current_path)
-                if part:
-                    path_parts.append(part)
-                elif current_path:
-                    path_parts.append(current_path)
-                    break
-                else:
-                    break
-
-            path_parts = list(reversed(path_parts))
-
-            for i in range(len(path_parts)):
-                current = path_parts[i]
-                current_full_path = os.path.normpath('/'.join(path_parts[:i + 1]))
-                parent_path = os.path.normpath('/'.join(path_parts[:i])) if i > 0 else None
-
-                if "." in current:  # It's a file
-                    document = document_mapper.get(full_path)
-                    if document:
-                        parent_folder = folder_mapper.get(parent_path)
-                        document.folder_id = parent_folder.id if parent_folder else None
-                        documents_to_update.append(document)
-                else:  # It's a folder
-                    if current_full_path not in folder_mapper:
-                        parent_folder = folder_mapper.get(parent_path)
-
-                        # Ensure unique folder names
-                        unique_name, was_renamed = await get_unique_folder_name(session, current, parent_folder.id if parent_folder else None)
-
-                        if was_renamed:
-                            renamed_folders.append({
-                                'original_path': current_full_path,
-                                'new_name': unique_name,
-                                'parent_folder': parent_folder.name if parent_folder else None
-                            })
-
-                        folder = Folder(name=unique_name, parent_id=parent_folder.id if parent_folder else None)
-                        session.add(folder)
-                        session.commit()
-                        session.refresh(folder)
-
-                        folder_mapper[current_full_path] = folder
+        levels, file_parents = await run_blocking(plan_folder_tree, normalized_paths)
+
+        # Insert the planned folders level by level, so parents always have their ids
+        # before their children are inserted.
+        for level in levels:
+            await run_blocking(
+                create_folder_level, session, level, folder_mapper, sibling_names, created_folder_ids,
+                renamed_folders, batch_size
+            )
 
         # Update document-folder relationships stage
+        spans.enter(STAGES['RELATION_UPDATE'])
         yield json.dumps({"stage": STAGES['RELATION_UPDATE'], "message": "Updating document relationships"}) + "\n"
-        for doc in documents_to_update:
-            session.merge(doc)
-        session.commit()
+
+        document_rows = []
+        for path, row, file in documents:
+            parent_folder = folder_mapper.get(file_parents.get(path))
+            row["folder_id"] = parent_folder.id if parent_folder else None
+            document_rows.append((row, file))
+
+        # Existing folders that get children, new ones can't have cached listings. Read
+        # before the commit expires the folders.
+        touched_folder_ids = {row["folder_id"] for row, _ in document_rows} | {
+            folder.parent_id for folder in folder_mapper.values() if folder.id in created_folder_ids
+        }
+
+        await run_blocking(insert_documents, session, document_rows, batch_size, commit_every, before_commit)
+        listing_cache.invalidate(*(touched_folder_ids - created_folder_ids))
+        spans.enter(None)
 
         # Final response
         yield json.dumps({
             "stage": STAGES['COMPLETE'],
             "message": "Upload complete",
             "total_files": len(all_files),
-            "total_folders": len(folder_mapper) - (1 if folder_id else 0)
+            "total_folders": len(created_folder_ids)
         }) + "\n"
 
     except Exception as e:
+        await run_blocking(session.rollback)
+        if discard_on_error:
+            await run_blocking(discard_stored_files, files)
         yield json.dumps({"stage": STAGES['ERROR'], "message": str(e)}) + "\n"
+
+
+async def discard_on_disconnect(events, session, files: list[StoredFile]):
+    """
+    Pass a progress stream through, rolling back and removing the stored files when the
+    client disconnects half way. The stream is then cancelled or closed, which is no
+    Exception, so the cleanup of stream_progress doesn't run. It is shielded from the
+    cancellation it runs in.
+
+    :param events: progress stream
+    :param session:
+    :param files:
+    :return AsyncIterator[str]:
+    """
+
+    try:
+        async for event in events:
+            yield event
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await events.aclose()
+            await run_blocking(session.rollback)
+            await run_blocking(discard_stored_files, files)
+        raise
@@ -0,0 +1,179 @@
+from fastapi import Request, HTTPException
+from fastapi.exceptions import RequestValidationError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import ClientDisconnect
+
+from .file_writer import StoredFile, ParallelFileWriter, FileHandle, remove_stored_file, WRITE_WORKERS
+from .blob_store import new_temp_path
+
+# Files are handed to the writers in blocks of this size, so a request never holds more
+# than the writer's buffered blocks (plus one network chunk) of file data in memory.
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Upper bound for plain form fields such as a single relative path.
+MAX_FIELD_SIZE = 64 * 1024  # 64KB
+
+
+class FolderUploadParser:
+    """
+    Streaming multipart parser for folder uploads. File parts are handed to a parallel
+    writer in fixed size chunks and hashed on the way, instead of being spooled in memory.
+    They stay in the upload temp dir until their blobs are placed, form fields are
+    collected as strings.
+    """
+
+    def __init__(self, request: Request, writers: int = WRITE_WORKERS):
+        self.request = request
+        self.writers = writers
+        self.fields: dict[str, list[str]] = {}
+        self.files: list[StoredFile] = []
+
+        # Current part state, filled by the parser callbacks
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._field_data = bytearray()
+        self._field_name = ""
+        self._file: StoredFile | None = None
+        self._buffer = bytearray()
+
+        # Work queued by the (sync) callbacks, handed to the writer after each network chunk
+        self._pending: list[tuple[str, StoredFile, bytes]] = []
+        self._handles: dict[int, FileHandle] = {}
+
+    # Parser callbacks
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._field_data = bytearray()
+        self._field_name = ""
+        self._file = None
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        self._field_name = options.get(b"name", b"").decode("utf-8", "replace")
+
+        if b"filename" in options:
+            filename = options[b"filename"].decode("utf-8", "replace")
+            self._file = StoredFile(filename=filename, file_path=new_temp_path())
+            self.files.append(self._file)
+            self._pending.append(("open", self._file, b""))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._file is None:
+            if len(self._field_data) + end - start > MAX_FIELD_SIZE:
+                raise HTTPException(413, f"Form field '{self._field_name}' is too large.")
+            self._field_data.extend(data[start:end])
+            return
+
+        self._buffer.extend(data[start:end])
+        if len(self._buffer) >= CHUNK_SIZE:
+            self._pending.append(("write", self._file, bytes(self._buffer)))
+            self._buffer.clear()
+
+    def on_part_end(self):
+        if self._file is None:
+            value = self._field_data.decode("utf-8", "replace")
+            self.fields.setdefault(self._field_name, []).append(value)
+            return
+
+        if self._buffer:
+            self._pending.append(("write", self._file, bytes(self._buffer)))
+            self._buffer.clear()
+        self._pending.append(("end", self._file, b""))
+
+    # Disk I/O
+
+    async def _flush(self, writer: ParallelFileWriter):
+        """
+        Hand the work queued by the callbacks to the writer, in order.
+        """
+
+        for action, file, chunk in self._pending:
+            if action == "open":
+                self._handles[id(file)] = await writer.open(file)
+            elif action == "write":
+                await writer.write(self._handles[id(file)], chunk)
+            else:
+                await writer.end(self._handles.pop(id(file)))
+        self._pending.clear()
+
+    async def parse(self):
+        """
+        Consume the request body, writing every file part to disk as it arrives.
+
+        :return tuple[dict[str, list[str]], list[StoredFile]]:
+        """
+
+        content_type, params = parse_options_header(self.request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            return self.fields, self.files
+
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+
+        try:
+            # The writer removes everything it wrote if parsing fails half way
+            async with ParallelFileWriter(workers=self.writers) as writer:
+                async for chunk in self.request.stream():
+                    parser.write(chunk)
+                    await self._flush(writer)
+                parser.finalize()
+                await self._flush(writer)
+        except ClientDisconnect:
+            raise HTTPException(400, "Client disconnected during upload.")
+
+        return self.fields, self.files
+
+
+async def receive_folder_upload(request: Request, writers: int = WRITE_WORKERS):
+    """
+    Stream a folder upload request to disk and return the relative paths together with
+    the stored files, ordered same as they were sent.
+
+    :param request:
+    :param writers: files written concurrently
+    :return tuple[list[str], list[StoredFile]]:
+    """
+
+    fields, files = await FolderUploadParser(request, writers).parse()
+    paths = fields.get("paths", [])
+
+    # Mirror FastAPI's validation error for missing form fields
+    errors = []
+    if not paths:
+        errors.append({"type": "missing", "loc": ("body", "paths"), "msg": "Field required", "input": None})
+    if not files:
+        errors.append({"type": "missing", "loc": ("body", "files"), "msg": "Field required", "input": None})
+
+    # Every file needs its path, files without one would never be placed
+    if paths and files and len(paths) != len(files):
+        errors.append({
+            "type": "value_error", "loc": ("body", "paths"),
+            "msg": f"Got {len(paths)} paths for {len(files)} files", "input": None
+        })
+    if errors:
+        for file in files:
+            remove_stored_file(file)
+        raise RequestValidationError(errors)
+
+    return paths, files
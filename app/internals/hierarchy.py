@@ -0,0 +1,342 @@
+from sqlalchemy import literal, null, union_all, update, delete, func, cast, String, or_
+from sqlalchemy.orm import aliased
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document
+from .blob_store import release_blob_counts
+
+# Hard cap on recursion, so a damaged hierarchy can't make a recursive query run forever
+MAX_TREE_DEPTH = 1000
+
+# Folder ids updated per statement when filling paths
+PATH_BATCH_SIZE = 500
+
+
+def path_upper_bound(path: str):
+    """
+    Smallest string sorting after every path that starts with `path`. Paths end with "/"
+    and "0" is the character right after it, so [path, upper bound) is the subtree.
+
+    :param path:
+    :return str:
+    """
+
+    return path[:-1] + "0"
+
+
+def subtree_filter(path: str, include_self: bool = True):
+    """
+    Range condition on Folder.path matching a folder's subtree.
+
+    :param path:
+    :param include_self:
+    :return ColumnElement:
+    """
+
+    lower = Folder.path >= path if include_self else Folder.path > path
+    return lower & (Folder.path < path_upper_bound(path))
+
+
+def ancestor_ids(path: str):
+    """
+    Ids of the folders on a materialized path, root first, the folder itself last.
+
+    :param path:
+    :return list[int]:
+    """
+
+    return [int(part) for part in path.strip("/").split("/") if part]
+
+
+def is_ancestor(ancestor: Folder, folder: Folder):
+    """
+    Check whether `ancestor` is `folder` itself or one of its ancestors.
+
+    :param ancestor:
+    :param folder:
+    :return bool:
+    """
+
+    return folder.path.startswith(ancestor.path)
+
+
+def get_descendant_folders(session, folder: Folder):
+    """
+    All folders below a folder with one indexed range scan.
+
+    :param session:
+    :param folder:
+    :return list[Folder]:
+    """
+
+    return session.exec(select(Folder).where(subtree_filter(folder.path, include_self=False))).all()
+
+
+def get_ancestor_folders(session, folder: Folder):
+    """
+    Ancestors of a folder, root first, with one primary key lookup.
+
+    :param session:
+    :param folder:
+    :return list[Folder]:
+    """
+
+    ids = ancestor_ids(folder.path)[:-1]
+    ancestors = {ancestor.id: ancestor for ancestor in session.exec(select(Folder).where(Folder.id.in_(ids))).all()}
+    return [ancestors[ancestor_id] for ancestor_id in ids if ancestor_id in ancestors]
+
+
+def fill_folder_paths(session, folder_ids: list[int]):
+    """
+    Set the path of freshly inserted folders from their parent's path, one UPDATE per
+    batch. Parents must already have their paths.
+
+    :param session:
+    :param folder_ids:
+    :return None:
+    """
+
+    parent = aliased(Folder)
+    parent_path = select(parent.path).where(parent.id == Folder.parent_id).scalar_subquery()
+
+    for start in range(0, len(folder_ids), PATH_BATCH_SIZE):
+        batch = folder_ids[start:start + PATH_BATCH_SIZE]
+        session.execute(
+            update(Folder)
+            .where(Folder.id.in_(batch))
+            .values(path=func.coalesce(parent_path, "/") + cast(Folder.id, String) + "/")
+            .execution_options(synchronize_session=False)
+        )
+
+
+def move_folder_paths(session, folder: Folder, new_parent: Folder | None):
+    """
+    Rewrite the paths of a folder and its whole subtree for a move, with one UPDATE
+    over the subtree's path range. Versions of the subtree change with their paths.
+
+    :param session:
+    :param folder:
+    :param new_parent: None for the root
+    :return None:
+    """
+
+    old_path = folder.path
+    new_path = (new_parent.path if new_parent else "/") + f"{folder.id}/"
+
+    session.execute(
+        update(Folder)
+        .where(subtree_filter(old_path))
+        .values(path=literal(new_path) + func.substr(Folder.path, len(old_path) + 1), version=Folder.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def claim_folders(session, folders: dict[int, tuple[str | None, int | None]]):
+    """
+    Bump the versions of folders about to be changed, if each still has the path it was
+    read with and, when given, the expected version. The UPDATE takes the write lock on
+    the rows (on the database with SQLite), so the checks that follow see the latest
+    committed tree until the commit.
+
+    :param session:
+    :param folders: folder id to (path read, expected version or None)
+    :return bool: False when a folder was moved, changed or deleted meanwhile
+    """
+
+    ids = list(folders)
+    for start in range(0, len(ids), PATH_BATCH_SIZE):
+        batch = ids[start:start + PATH_BATCH_SIZE]
+        claimed = session.execute(
+            update(Folder)
+            .where(Folder.id.in_(batch))
+            .values(version=Folder.version + 1)
+            .returning(Folder.id, Folder.path, Folder.version)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if len(claimed) != len(batch):
+            return False
+        for folder_id, path, version in claimed:
+            read_path, expected_version = folders[folder_id]
+            if path != read_path or (expected_version is not None and version != expected_version + 1):
+                return False
+    return True
+
+
+def check_folder_paths(session, paths: dict[int, str | None]):
+    """
+    Whether folders still exist at the paths they were read with, locking their rows
+    against concurrent moves on databases with row locks. One query per batch of ids.
+
+    :param session:
+    :param paths: folder id to path read
+    :return bool:
+    """
+
+    ids = list(paths)
+    for start in range(0, len(ids), PATH_BATCH_SIZE):
+        batch = ids[start:start + PATH_BATCH_SIZE]
+        current = dict(session.exec(select(Folder.id, Folder.path).where(Folder.id.in_(batch)).with_for_update()).all())
+        if any(current.get(folder_id, False) != paths[folder_id] for folder_id in batch):
+            return False
+    return True
+
+
+def delete_subtree(session, folder: Folder):
+    """
+    Delete a folder with all its subfolders and documents using set-based statements over
+    the subtree's path range, releasing the blobs they referenced. Nothing is committed
+    and no file is touched, unreferenced blobs are left to the blob reaper.
+
+    :param session:
+    :param folder:
+    :return tuple[int, int, list[str]]: deleted folders, deleted documents and files of
+    documents stored without a blob
+    """
+
+    if folder.path:
+        subtree = select(Folder.id).where(subtree_filter(folder.path))
+    else:
+        subtree = select(Folder.id).where(Folder.id == folder.id)
+    in_subtree = Document.folder_id.in_(subtree)
+
+    # References held by the subtree, per blob
+    counts = dict(session.exec(
+        select(Document.blob_digest, func.count())
+        .where(in_subtree, Document.blob_digest.is_not(None))
+        .group_by(Document.blob_digest)
+    ).all())
+    legacy_files = list(session.exec(
+        select(Document.file_url).where(in_subtree, Document.blob_digest.is_(None))
+    ).all())
+
+    release_blob_counts(session, counts)
+    documents = session.execute(
+        delete(Document).where(in_subtree).execution_options(synchronize_session=False)
+    ).rowcount
+    folders = session.execute(
+        delete(Folder).where(Folder.id.in_(subtree)).execution_options(synchronize_session=False)
+    ).rowcount
+
+    return folders, documents, legacy_files
+
+
+def backfill_folder_paths(session):
+    """
+    One-off backfill of the paths of folders created before paths existed, computed for
+    the whole hierarchy with one recursive query. Folders whose parent is gone count as
+    top level folders.
+
+    :param session:
+    :return int: number of folders without a path before the backfill
+    """
+
+    missing = session.exec(select(func.count()).select_from(Folder).where(Folder.path.is_(None))).one()
+    if not missing:
+        return 0
+
+    parent = aliased(Folder)
+    orphaned = ~select(parent.id).where(parent.id == Folder.parent_id).exists()
+
+    paths = (
+        select(Folder.id, ("/" + cast(Folder.id, String) + "/").label("path"))
+        .where(or_(Folder.parent_id.is_(None), orphaned))
+        .cte("paths", recursive=True)
+    )
+    paths = paths.union_all(
+        select(Folder.id, (paths.c.path + cast(Folder.id, String) + "/").label("path"))
+        .join(paths, Folder.parent_id == paths.c.id)
+    )
+
+    session.execute(
+        update(Folder)
+        .where(Folder.path.is_(None))
+        .values(path=select(paths.c.path).where(paths.c.id == Folder.id).scalar_subquery())
+        .add_cte(paths)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+    return missing
+
+
+def split_item_rows(rows):
+    """
+    Split (kind, id, parent id, name, file url, blob digest, ...) rows of a combined
+    folder and document query into folder and document dicts.
+
+    :param rows:
+    :return tuple[list[dict], list[dict]]:
+    """
+
+    folders = []
+    documents = []
+    for kind, item_id, parent_id, name, file_url, blob_digest, *_ in rows:
+        if kind == "folder":
+            folders.append({"id": item_id, "parent_id": parent_id, "name": name})
+        else:
+            documents.append({
+                "id": item_id, "folder_id": parent_id, "name": name, "file_url": file_url, "blob_digest": blob_digest
+            })
+
+    return folders, documents
+
+
+# Subtree of a folder in one round trip
+def get_subtree(session, folder_id: int | None, max_depth: int | None = None, limit: int = 1000, offset: int = 0):
+    """
+    Fetch folders and documents below a folder (or below the root) with one recursive
+    query. Rows come breadth first, folders before documents on the same depth, ordered
+    by name.
+
+    :param session:
+    :param folder_id: None for the whole tree
+    :param max_depth: levels below the folder to include, 1 only includes its children
+    :param limit:
+    :param offset:
+    :return tuple[list[dict], list[dict], int | None]: folders, documents, next offset
+    """
+
+    max_depth = min(max_depth or MAX_TREE_DEPTH, MAX_TREE_DEPTH)
+
+    # Anchor: the children of the folder on depth 1
+    tree = (
+        select(Folder.id, Folder.parent_id, Folder.name, literal(1).label("depth"))
+        .where(Folder.parent_id == folder_id)
+        .cte("tree", recursive=True)
+    )
+    tree = tree.union_all(
+        select(Folder.id, Folder.parent_id, Folder.name, (tree.c.depth + 1).label("depth"))
+        .join(tree, Folder.parent_id == tree.c.id)
+        .where(tree.c.depth < max_depth)
+    )
+
+    folder_rows = select(
+        literal("folder").label("kind"), tree.c.id, tree.c.parent_id, tree.c.name,
+        null().label("file_url"), null().label("blob_digest"), tree.c.depth
+    )
+    # Documents sit one level below their folder, the folder's own documents on depth 1
+    nested_document_rows = (
+        select(
+            literal("document"), Document.id, Document.folder_id, Document.name,
+            Document.file_url, Document.blob_digest, (tree.c.depth + 1)
+        )
+        .join(tree, Document.folder_id == tree.c.id)
+        .where(tree.c.depth < max_depth)
+    )
+    direct_document_rows = select(
+        literal("document"), Document.id, Document.folder_id, Document.name,
+        Document.file_url, Document.blob_digest, literal(1)
+    ).where(Document.folder_id == folder_id)
+
+    rows = union_all(folder_rows, nested_document_rows, direct_document_rows).subquery()
+    statement = (
+        select(rows)
+        .order_by(rows.c.depth, rows.c.kind.desc(), rows.c.name, rows.c.id)
+        .limit(limit + 1)
+        .offset(offset)
+    )
+    result = session.execute(statement).all()
+
+    folders, documents = split_item_rows(result[:limit])
+    next_offset = offset + limit if len(result) > limit else None
+    return folders, documents, next_offset
@@ -0,0 +1,545 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import timedelta
+from functools import partial
+
+from sqlalchemy import delete, update, or_, and_
+from sqlmodel import Session, select
+
+from ..db import engine
+from ..models.database.ingest_job import IngestJob, IngestJobFile
+from .concurrency import run_blocking
+from .file_writer import StoredFile, discard_stored_files
+from .folder_and_files import stream_progress, bulk_insert, ProgressThrottle, STAGES
+from .upload_sessions import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Jobs materialized at the same time by one process
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+# Runs of a job before it is given up, a job that keeps taking the process down fails
+MAX_JOB_ATTEMPTS = 3
+
+# Finished jobs can be polled for this many seconds
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", 24 * 3600))
+
+# Seconds between two reads of a job that runs in another process
+JOB_POLL_INTERVAL = 1.0
+
+# Seconds a job stays with the process that queued or runs it, renewed every third of it
+# while the job runs. Other processes take the job over once its lease expired.
+JOB_LEASE = int(os.getenv("JOB_LEASE", 60))
+
+# Owner of the jobs queued and run by this process
+PROCESS_ID = uuid.uuid4().hex
+
+FINISHED = ("complete", "failed")
+
+
+def update_job(session, job_id: str, attempt: int | None = None, **values):
+    """
+    Change columns of a job without committing, optionally only while the given run
+    holds it.
+
+    :param session:
+    :param job_id:
+    :param attempt: attempt number of the run
+    :param values:
+    :return bool: whether the job was changed
+    """
+
+    statement = update(IngestJob).where(IngestJob.id == job_id)
+    if attempt is not None:
+        statement = statement.where(IngestJob.attempts == attempt)
+    return bool(session.execute(statement.values(updated_at=utcnow(), **values)).rowcount)
+
+
+def purge_finished_jobs(session):
+    """
+    Remove jobs finished longer than JOB_RETENTION ago.
+
+    :param session:
+    :return None:
+    """
+
+    expired = select(IngestJob.id).where(
+        IngestJob.status.in_(FINISHED), IngestJob.updated_at < utcnow() - timedelta(seconds=JOB_RETENTION)
+    )
+    session.execute(delete(IngestJobFile).where(IngestJobFile.job_id.in_(expired)))
+    session.execute(delete(IngestJob).where(IngestJob.id.in_(expired)))
+
+
+def create_ingest_job(session, folder_id: int | None, paths: list[str], files: list[StoredFile],
+                      progress_every: int | None = None, progress_rate: float | None = None):
+    """
+    Queue the materialization of a folder upload whose files are streamed to disk already.
+    The files are recorded with the job so it can be run again after a restart.
+
+    :param session:
+    :param folder_id:
+    :param paths:
+    :param files:
+    :param progress_every:
+    :param progress_rate:
+    :return IngestJob:
+    """
+
+    purge_finished_jobs(session)
+
+    now = utcnow()
+    job = IngestJob(
+        id=uuid.uuid4().hex, folder_id=folder_id, total_files=len(files), stage=STAGES['VALIDATION'],
+        message="Queued", progress_every=progress_every, progress_rate=progress_rate, created_at=now, updated_at=now,
+        owner=PROCESS_ID, lease_expires_at=now + timedelta(seconds=JOB_LEASE)
+    )
+    session.add(job)
+    session.flush()
+    bulk_insert(session, IngestJobFile, [
+        {
+            "job_id": job.id, "index": index, "path": path, "filename": file.filename, "file_path": file.file_path,
+            "size": file.size, "digest": file.digest, "error": file.error
+        }
+        for index, (path, file) in enumerate(zip(paths, files))
+    ])
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def finish_job(session, job_id: str, attempt: int, last_event: dict | None, failed: bool):
+    """
+    Record the outcome of a run and forget the job's files, unless another run claimed
+    the job meanwhile.
+
+    :param session:
+    :param job_id:
+    :param attempt: attempt number of the run
+    :param last_event:
+    :param failed:
+    :return bool: whether the outcome was recorded
+    """
+
+    values = {"status": "failed" if failed else "complete", "result": json.dumps(last_event) if last_event else None}
+    if last_event:
+        values.update(stage=last_event.get("stage"), message=last_event.get("message"))
+    finished = update_job(session, job_id, attempt, lease_expires_at=None, **values)
+    if finished:
+        session.execute(delete(IngestJobFile).where(IngestJobFile.job_id == job_id))
+    session.commit()
+    return finished
+
+
+def is_claimable(job: IngestJob, now):
+    """
+    Whether this process may run a job, i.e. nobody holds its lease or this process
+    queued it.
+
+    :param job:
+    :param now:
+    :return bool:
+    """
+
+    if job.lease_expires_at is None or job.lease_expires_at < now:
+        return True
+    return job.owner == PROCESS_ID and job.status == "queued"
+
+
+def claim_job(session, job_id: str):
+    """
+    Mark a queued job, or one that was running when the process stopped, as running.
+
+    :param session:
+    :param job_id:
+    :return tuple | None: folder id, attempt number, paths, stored files and progress
+    throttle of the job, None when there is nothing to run
+    """
+
+    job = session.get(IngestJob, job_id)
+    now = utcnow()
+    if job is None or job.status in FINISHED or not is_claimable(job, now):
+        return None
+
+    job_files = session.exec(
+        select(IngestJobFile).where(IngestJobFile.job_id == job_id).order_by(IngestJobFile.index)
+    ).all()
+    paths = [file.path for file in job_files]
+    files = [
+        StoredFile(filename=file.filename, file_path=file.file_path, size=file.size, digest=file.digest, error=file.error)
+        for file in job_files
+    ]
+    folder_id, attempts = job.folder_id, job.attempts
+    throttle = ProgressThrottle(job.progress_every, job.progress_rate)
+
+    # A run that never finished committed nothing, its files are still waiting on disk
+    message = None
+    if attempts >= MAX_JOB_ATTEMPTS:
+        message = "Job failed too many times"
+    elif any(file.file_path and not file.error and not os.path.exists(file.file_path) for file in files):
+        message = "Files of the job are gone"
+    if message:
+        if finish_job(session, job_id, attempts, {"stage": STAGES['ERROR'], "message": message}, failed=True):
+            discard_stored_files(files)
+        return None
+
+    # Conditional, so of several processes starting at once only one resumes the job, and
+    # never one whose lease another process renewed meanwhile
+    claimed = session.execute(
+        update(IngestJob)
+        .where(
+            IngestJob.id == job_id, IngestJob.status.in_(("queued", "running")), IngestJob.attempts == attempts,
+            or_(
+                IngestJob.lease_expires_at.is_(None), IngestJob.lease_expires_at < now,
+                and_(IngestJob.owner == PROCESS_ID, IngestJob.status == "queued")
+            )
+        )
+        .values(
+            status="running", attempts=attempts + 1, message="Running", updated_at=now,
+            owner=PROCESS_ID, lease_expires_at=now + timedelta(seconds=JOB_LEASE)
+        )
+    ).rowcount
+    session.commit()
+    if not claimed:
+        return None
+    return folder_id, attempts + 1, paths, files, throttle
+
+
+def renew_lease(job_id: str, attempt: int):
+    """
+    Extend the lease of a running job, in a transaction of its own.
+
+    :param job_id:
+    :param attempt: attempt number of the run
+    :return bool: whether the run still holds the job
+    """
+
+    with Session(engine) as session:
+        renewed = session.execute(
+            update(IngestJob)
+            .where(IngestJob.id == job_id, IngestJob.attempts == attempt, IngestJob.status == "running")
+            .values(lease_expires_at=utcnow() + timedelta(seconds=JOB_LEASE))
+        ).rowcount
+        session.commit()
+    return bool(renewed)
+
+
+async def keep_lease(job_id: str, attempt: int):
+    """
+    Renew the lease of a running job until cancelled.
+
+    :param job_id:
+    :param attempt:
+    :return None:
+    """
+
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        try:
+            # Not on the upload executor, the renewal may wait for the writer the job holds
+            await asyncio.to_thread(renew_lease, job_id, attempt)
+        except Exception:
+            logger.warning("Lease of ingest job %s could not be renewed", job_id, exc_info=True)
+
+
+def complete_job(session, job_id: str, attempt: int):
+    """
+    Mark a job complete as part of the transaction committing its documents, unless
+    another run claimed it meanwhile.
+
+    :param session:
+    :param job_id:
+    :param attempt: attempt number of the run
+    :return None:
+    :raise RuntimeError: when the job was claimed again
+    """
+
+    completed = session.execute(
+        update(IngestJob)
+        .where(IngestJob.id == job_id, IngestJob.attempts == attempt)
+        .values(status="complete", updated_at=utcnow())
+    ).rowcount
+    if not completed:
+        raise RuntimeError("Job was claimed by another run")
+
+
+class JobProgress:
+    """
+    Events of the jobs running in this process. The job table is only written around a
+    run, since its documents are inserted in one transaction that holds the single
+    SQLite writer, so live progress is served from memory.
+    """
+
+    def __init__(self):
+        self._events = {}
+        self._changed = {}
+
+    def start(self, job_id: str):
+        self._events[job_id] = []
+        self._changed[job_id] = asyncio.Event()
+
+    def publish(self, job_id: str, event: dict):
+        self._events[job_id].append(event)
+        self._changed.pop(job_id).set()
+        self._changed[job_id] = asyncio.Event()
+
+    def finish(self, job_id: str):
+        self._events.pop(job_id, None)
+        changed = self._changed.pop(job_id, None)
+        if changed:
+            changed.set()
+
+    def events(self, job_id: str):
+        """
+        Events of a job so far, None when it doesn't run in this process.
+
+        :param job_id:
+        :return list[dict] | None:
+        """
+
+        return self._events.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float):
+        """
+        Wait for the next event of a job.
+
+        :param job_id:
+        :param timeout:
+        :return bool: whether something happened before the timeout
+        """
+
+        changed = self._changed.get(job_id)
+        if changed is None:
+            return True
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+async def run_ingest_job(job_id: str, progress: JobProgress):
+    """
+    Materialize a job with the same pipeline as a streamed folder upload. The job is
+    marked complete right before its documents are committed, as part of that commit.
+    A run that lost the job to another one records nothing and leaves the files alone.
+
+    :param job_id:
+    :param progress:
+    :return None:
+    """
+
+    with Session(engine) as session:
+        claimed = await run_blocking(claim_job, session, job_id)
+        if claimed is None:
+            return
+        folder_id, attempt, paths, files, throttle = claimed
+
+        progress.start(job_id)
+        renewal = asyncio.create_task(keep_lease(job_id, attempt))
+        last_event = None
+        failed = False
+        try:
+            try:
+                async for line in stream_progress(
+                    paths, files, session, folder_id, progress=throttle,
+                    before_commit=partial(complete_job, job_id=job_id, attempt=attempt), discard_on_error=False
+                ):
+                    last_event = json.loads(line)
+                    failed = failed or last_event["stage"] == STAGES['ERROR']
+                    progress.publish(job_id, last_event)
+            except Exception as e:
+                logger.exception("Ingest job %s failed", job_id)
+                await run_blocking(session.rollback)
+                last_event, failed = {"stage": STAGES['ERROR'], "message": str(e)}, True
+
+            # The files of a failed job are only removed by the run holding it
+            if await run_blocking(finish_job, session, job_id, attempt, last_event, failed) and failed:
+                await run_blocking(discard_stored_files, files)
+        finally:
+            renewal.cancel()
+            progress.finish(job_id)
+
+
+def unfinished_jobs(session, expired_only: bool = False):
+    """
+    Ids of the jobs still to be run, oldest first.
+
+    :param session:
+    :param expired_only: only jobs whose lease expired, i.e. whose process is gone
+    :return list[str]:
+    """
+
+    statement = select(IngestJob.id).where(IngestJob.status.in_(("queued", "running")))
+    if expired_only:
+        statement = statement.where(IngestJob.lease_expires_at < utcnow())
+    return session.exec(statement.order_by(IngestJob.created_at)).all()
+
+
+def release_leases(session):
+    """
+    Give up the leases of the unfinished jobs of this process, so another process can
+    take them over right away.
+
+    :param session:
+    :return None:
+    """
+
+    session.execute(
+        update(IngestJob)
+        .where(IngestJob.owner == PROCESS_ID, IngestJob.status.in_(("queued", "running")))
+        .values(lease_expires_at=None)
+    )
+    session.commit()
+
+
+class IngestQueue:
+    """
+    In-process queue of ingest jobs and the workers running them. Jobs live in the
+    database, the queue only holds their ids, so jobs left queued or running by an
+    earlier process are queued again on start, and jobs of processes that stopped
+    meanwhile once their lease expired.
+    """
+
+    def __init__(self, workers: int = INGEST_WORKERS):
+        self.workers = workers
+        self.progress = JobProgress()
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        """
+        Start the workers and queue the unfinished jobs.
+
+        :return None:
+        """
+
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._watch_leases()))
+
+        # Jobs another live process holds are skipped when claimed
+        with Session(engine) as session:
+            pending = await run_blocking(unfinished_jobs, session)
+        for job_id in pending:
+            self.enqueue(job_id)
+
+    async def stop(self):
+        """
+        Stop the workers. Jobs interrupted half way are run again on the next start.
+
+        :return None:
+        """
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+        with Session(engine) as session:
+            await run_blocking(release_leases, session)
+
+    def enqueue(self, job_id: str):
+        """
+        Queue a job, it waits in the database until the next start when no worker runs.
+
+        :param job_id:
+        :return None:
+        """
+
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await run_ingest_job(job_id, self.progress)
+            except Exception:
+                logger.exception("Ingest job %s could not be run", job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _watch_leases(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE)
+            try:
+                with Session(engine) as session:
+                    expired = await run_blocking(unfinished_jobs, session, expired_only=True)
+            except Exception:
+                logger.exception("Ingest jobs with expired leases could not be read")
+                continue
+            for job_id in expired:
+                self.enqueue(job_id)
+
+
+ingest_queue = IngestQueue()
+
+
+def read_job(session, job_id: str):
+    """
+    Current state of a job, read in a fresh transaction.
+
+    :param session:
+    :param job_id:
+    :return IngestJob | None:
+    """
+
+    session.close()
+    return session.get(IngestJob, job_id)
+
+
+def job_public(job: IngestJob):
+    """
+    Public view of a job, with its latest event.
+
+    :param job:
+    :return dict:
+    """
+
+    events = ingest_queue.progress.events(job.id)
+    last_event = events[-1] if events else (json.loads(job.result) if job.result else None)
+    return {**job.model_dump(exclude={"owner", "lease_expires_at"}), "last_event": last_event}
+
+
+async def job_event_stream(session, job_id: str, last_event_id: int = 0, keep_alive: float = 15.0):
+    """
+    Server-sent events of a job until it is finished. Events of a job running in this
+    process are sent as they happen, numbered so a reconnecting client can pass
+    Last-Event-ID. For jobs running elsewhere, state changes are polled from the table.
+    The stream ends with a "complete" or "failed" event holding the job's last event.
+
+    :param session:
+    :param job_id:
+    :param last_event_id:
+    :param keep_alive: seconds between keep-alive comments
+    :return AsyncIterator[str]:
+    """
+
+    sent = last_event_id
+    polled = None
+    while True:
+        events = ingest_queue.progress.events(job_id)
+        if events is not None:
+            for number, event in enumerate(events[sent:], start=sent + 1):
+                yield f"id: {number}\ndata: {json.dumps(event)}\n\n"
+            sent = max(sent, len(events))
+            if not await ingest_queue.progress.wait(job_id, keep_alive):
+                yield ": keep-alive\n\n"
+            continue
+
+        job = await run_blocking(read_job, session, job_id)
+        if job is None:
+            return
+        if job.status in FINISHED:
+            yield f"event: {job.status}\ndata: {job.result or '{}'}\n\n"
+            return
+
+        state = {"status": job.status, "stage": job.stage, "message": job.message}
+        if state != polled:
+            polled = state
+            yield f"data: {json.dumps(state)}\n\n"
+        await asyncio.sleep(JOB_POLL_INTERVAL)
@@ -0,0 +1,120 @@
+import base64
+import binascii
+import json
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_, or_, and_
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document
+from .search import name_filter
+
+# Orders a listing can be paginated by, both backed by (parent, key) indexes
+LISTING_ORDERS = ("name", "id")
+
+
+def encode_cursor(kind: str, key, item_id: int):
+    """
+    Opaque cursor pointing right after an item of a listing.
+
+    :param kind: "folder" or "document"
+    :param key: value of the order column
+    :param item_id:
+    :return str:
+    """
+
+    raw = json.dumps([kind, key, item_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    Read a cursor made by encode_cursor.
+
+    :param cursor:
+    :return tuple[str, Any, int]: kind, key and id
+    """
+
+    try:
+        kind, key, item_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if kind not in ("folder", "document") or not isinstance(item_id, int):
+            raise ValueError
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(400, "Invalid cursor.")
+
+    return kind, key, item_id
+
+
+def _after(model, order_by: str, key, item_id: int):
+    """
+    Keyset condition for the rows after (key, id), NULL names sorting first.
+    """
+
+    if order_by == "id":
+        return model.id > item_id
+    if key is None:
+        return or_(and_(model.name.is_(None), model.id > item_id), model.name.is_not(None))
+    return tuple_(model.name, model.id) > tuple_(key, item_id)
+
+
+def _page(session, model, parent_column, parent_id: int | None, order_by: str, limit: int, q: str | None, after=None):
+    """
+    Up to `limit` + 1 rows of one kind below a folder, starting after the given keyset.
+    """
+
+    statement = select(model).where(parent_column == parent_id)
+    if q:
+        statement = statement.where(name_filter(session, model, q))
+    if after:
+        statement = statement.where(_after(model, order_by, *after))
+
+    if order_by == "id":
+        statement = statement.order_by(model.id)
+    else:
+        statement = statement.order_by(model.name.asc().nulls_first(), model.id)
+
+    return session.exec(statement.limit(limit + 1)).all()
+
+
+def list_folder(session, folder_id: int | None, order_by: str = "name", limit: int = 1000, cursor: str | None = None,
+                q: str | None = None):
+    """
+    One page of a folder's children, folders first then documents, with keyset pagination
+    so every page is an index range scan, however deep into the listing it is.
+
+    :param session:
+    :param folder_id: None for the root
+    :param order_by: "name" or "id"
+    :param limit:
+    :param cursor: next_cursor of the previous page
+    :param q: name filter
+    :return tuple[list[Folder], list[Document], str | None]: folders, documents, next cursor
+    """
+
+    kind, key, item_id = decode_cursor(cursor) if cursor else ("folder", None, None)
+    folders = []
+
+    # Folders come first, skip them once the cursor points into the documents
+    if kind == "folder":
+        after = (key, item_id) if cursor else None
+        folders = _page(session, Folder, Folder.parent_id, folder_id, order_by, limit, q, after)
+        if len(folders) > limit:
+            folders = folders[:limit]
+            last = folders[-1]
+            return folders, [], encode_cursor("folder", getattr(last, order_by), last.id)
+
+    after = (key, item_id) if kind == "document" else None
+    remaining = limit - len(folders)
+    documents = _page(session, Document, Document.folder_id, folder_id, order_by, remaining, q, after) if remaining else []
+
+    next_cursor = None
+    if len(documents) > remaining:
+        documents = documents[:remaining]
+        last = documents[-1]
+        next_cursor = encode_cursor("document", getattr(last, order_by), last.id)
+    elif not remaining:
+        # The page is full of folders, documents may still follow
+        last = folders[-1]
+        next_cursor = encode_cursor("folder", getattr(last, order_by), last.id)
+
+    return folders, documents, next_cursor
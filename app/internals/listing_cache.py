@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Listing pages kept, 0 disables the cache
+LISTING_CACHE_SIZE = int(os.getenv("LISTING_CACHE_SIZE", 1024))
+
+# Folders and documents kept over all pages, so a few huge pages can't take all memory
+LISTING_CACHE_MAX_ITEMS = int(os.getenv("LISTING_CACHE_MAX_ITEMS", 200_000))
+
+# Seconds a page is served. Writes invalidate pages of this process right away, the TTL
+# bounds how stale a page gets when another process wrote.
+LISTING_CACHE_TTL = float(os.getenv("LISTING_CACHE_TTL", 10))
+
+# Seconds the time of a write to a folder is remembered, longer than any listing query runs
+WRITE_LOG_SECONDS = 300
+
+
+class ListingCache:
+    """
+    LRU cache of serialized folder listing pages, keyed by folder id first so every write
+    can drop exactly the pages of the folders it changed.
+
+    A page is only stored if no write to its folder happened since the caller started
+    reading it from the database. Otherwise a read that raced a write could put a page
+    back that the write just invalidated.
+    """
+
+    def __init__(self, max_entries: int = LISTING_CACHE_SIZE, max_items: int = LISTING_CACHE_MAX_ITEMS,
+                 ttl: float = LISTING_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_items = max_items
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, body, items)
+        self._keys = {}  # folder id -> keys of its cached pages
+        self._paths = {}  # folder id -> materialized path, for subtree invalidation
+        self._written = {}  # folder id -> monotonic time of its last write
+        self._subtrees_written = []  # (path, monotonic time) of deleted and moved subtrees
+        self._items = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def begin_read(self):
+        """
+        Token to pass to put, to be taken before reading a page from the database.
+
+        :return float:
+        """
+
+        return time.monotonic()
+
+    def get(self, key: tuple):
+        """
+        Cached page, None on a miss.
+
+        :param key: (folder id, *listing parameters)
+        :return bytes | None:
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, body: bytes, items: int, read_started: float, path: str | None = None):
+        """
+        Store a page unless its folder was written since the read started.
+
+        :param key: (folder id, *listing parameters)
+        :param body: serialized page
+        :param items: folders and documents in the page
+        :param read_started: token from begin_read
+        :param path: materialized path of the folder
+        :return None:
+        """
+
+        if self.max_entries <= 0 or items > self.max_items:
+            return
+
+        folder_id = key[0]
+        with self._lock:
+            if self._written.get(folder_id, float("-inf")) >= read_started:
+                return
+            if path and any(written >= read_started and path.startswith(subtree) for subtree, written in self._subtrees_written):
+                return
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self.ttl, body, items)
+            self._keys.setdefault(folder_id, set()).add(key)
+            if path:
+                self._paths[folder_id] = path
+            self._items += items
+
+            while len(self._entries) > self.max_entries or self._items > self.max_items:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *folder_ids: int | None):
+        """
+        Drop the pages of folders whose children changed.
+
+        :param folder_ids: None for the root
+        :return None:
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            for folder_id in set(folder_ids):
+                self._written[folder_id] = now
+                for key in list(self._keys.get(folder_id, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+            # Reads that started before a forgotten write are long finished
+            if len(self._written) > max(self.max_entries, 1024) * 4:
+                self._written = {
+                    folder_id: written for folder_id, written in self._written.items()
+                    if written > now - WRITE_LOG_SECONDS
+                }
+
+    def invalidate_subtree(self, path: str):
+        """
+        Drop the pages of a folder and all its descendants, when they are deleted or moved.
+
+        :param path: materialized path of the folder
+        :return None:
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._subtrees_written = [
+                (subtree, written) for subtree, written in self._subtrees_written if written > now - WRITE_LOG_SECONDS
+            ]
+            self._subtrees_written.append((path, now))
+            folder_ids = [folder_id for folder_id, cached_path in self._paths.items() if cached_path.startswith(path)]
+        self.invalidate(*folder_ids)
+
+    def clear(self):
+        """
+        Drop every page.
+
+        :return None:
+        """
+
+        with self._lock:
+            folder_ids = list(self._keys)
+        self.invalidate(*folder_ids)
+
+    def stats(self):
+        """
+        Hit and miss counters and the current size.
+
+        :return dict:
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "items": self._items,
+                "max_entries": self.max_entries,
+                "max_items": self.max_items,
+                "ttl": self.ttl,
+            }
+
+    def _remove(self, key: tuple):
+        _, _, items = self._entries.pop(key)
+        self._items -= items
+        keys = self._keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+                self._paths.pop(key[0], None)
+
+
+listing_cache = ListingCache()
@@ -0,0 +1,278 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Instrumentation is off unless enabled, then every query, upload stage and disk write is
+# timed. Off, the only cost left is a flag check per request, stage and write.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+
+# Add the query count and time of a request to its response headers. Headers go out
+# before a streamed body, so streamed responses report the work done until they start.
+METRICS_HEADERS = os.getenv("METRICS_HEADERS", "0") == "1"
+
+METRIC_PREFIX = "headache_"
+
+
+class RequestMetrics:
+    """
+    Queries of one request, collected through a context variable, so queries run on the
+    upload executors count for the request that started them.
+    """
+
+    __slots__ = ("queries", "query_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+class Metrics:
+    """
+    Process wide counters and summaries, rendered in the Prometheus text format.
+    Summaries keep a count and a sum per label set, enough for rates and averages.
+    """
+
+    def __init__(self, headers: bool = METRICS_HEADERS):
+        self.enabled = False
+        self.headers = headers
+        self._counters = {}  # (name, labels) -> value
+        self._summaries = {}  # (name, labels) -> [count, sum]
+        self._help = {}
+        self._engines = []
+        self._lock = threading.Lock()
+
+    def enable(self, *engines):
+        """
+        Start collecting and time the queries of the engines.
+
+        :param engines:
+        :return None:
+        """
+
+        self.enabled = True
+        for engine in {id(engine): engine for engine in engines}.values():
+            if any(engine is known for known in self._engines):
+                continue
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+            self._engines.append(engine)
+
+    def disable(self):
+        """
+        Stop collecting and remove the query hooks. Collected values are kept.
+
+        :return None:
+        """
+
+        self.enabled = False
+        for engine in self._engines:
+            event.remove(engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(engine, "after_cursor_execute", _after_cursor_execute)
+        self._engines = []
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+
+    def reset(self):
+        """
+        Forget every collected value.
+
+        :return None:
+        """
+
+        with self._lock:
+            self._counters = {}
+            self._summaries = {}
+
+    def render(self, gauges: dict | None = None):
+        """
+        Collected values in the Prometheus text exposition format.
+
+        :param gauges: current values to report along, name to value
+        :return str:
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            summaries = {key: list(value) for key, value in self._summaries.items()}
+
+        lines = []
+        for kind, names in (("counter", {name for name, _ in counters}), ("summary", {name for name, _ in summaries})):
+            for name in sorted(names):
+                full_name = METRIC_PREFIX + name
+                if name in self._help:
+                    lines.append(f"# HELP {full_name} {self._help[name]}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                if kind == "counter":
+                    for (metric, labels), value in sorted(counters.items()):
+                        if metric == name:
+                            lines.append(f"{full_name}{_labels(labels)} {_number(value)}")
+                else:
+                    for (metric, labels), (count, total) in sorted(summaries.items()):
+                        if metric == name:
+                            lines.append(f"{full_name}_count{_labels(labels)} {count}")
+                            lines.append(f"{full_name}_sum{_labels(labels)} {_number(total)}")
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} gauge")
+            lines.append(f"{METRIC_PREFIX}{name} {_number(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: tuple):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value: float):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+metrics.describe("http_requests_total", "Requests served, by route and status.")
+metrics.describe("http_request_seconds", "Time until the response was sent, streamed bodies included.")
+metrics.describe("http_request_queries", "SQL queries per request.")
+metrics.describe("db_queries_total", "SQL queries executed, requests and background work.")
+metrics.describe("db_query_seconds_total", "Time spent executing SQL queries.")
+metrics.describe("upload_stage_seconds", "Time spent in the stages of folder uploads.")
+metrics.describe("disk_write_bytes_total", "Bytes of uploaded files written to disk.")
+metrics.describe("disk_write_seconds", "Time of the disk writes of uploaded files, per chunk.")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("query_started")
+    if not started:
+        return  # hooks were added while the query ran
+    seconds = time.perf_counter() - started.pop()
+    metrics.inc("db_queries_total")
+    metrics.inc("db_query_seconds_total", seconds)
+
+    request = current_request.get()
+    if request is not None:
+        request.queries += 1
+        request.query_seconds += seconds
+
+
+class StageSpans:
+    """
+    Times consecutive stages of an upload, each stage ends when the next one is entered.
+    """
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self):
+        self.stage = None
+        self.started = 0.0
+
+    def enter(self, stage: str | None):
+        """
+        End the current stage and start timing the given one, None only ends it.
+
+        :param stage: a STAGES value
+        :return None:
+        """
+
+        if not metrics.enabled:
+            return
+        now = time.perf_counter()
+        if self.stage is not None:
+            metrics.observe("upload_stage_seconds", now - self.started, stage=self.stage)
+        self.stage, self.started = stage, now
+
+
+@contextmanager
+def stage_span(stage: str):
+    """
+    Time a block as one upload stage.
+
+    :param stage: a STAGES value
+    """
+
+    spans = StageSpans()
+    spans.enter(stage)
+    try:
+        yield
+    finally:
+        spans.enter(None)
+
+
+def record_disk_write(size: int, started: float):
+    """
+    Count a chunk written to disk.
+
+    :param size: bytes written
+    :param started: perf_counter value taken before the write
+    :return None:
+    """
+
+    metrics.inc("disk_write_bytes_total", size)
+    metrics.observe("disk_write_seconds", time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting the requests, their duration and their queries per route,
+    and optionally adding the query count and time to the response headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestMetrics()
+        token = current_request.set(request)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if metrics.headers:
+                    message.setdefault("headers", [])
+                    message["headers"] = [
+                        *message["headers"],
+                        (b"x-query-count", str(request.queries).encode()),
+                        (b"x-query-time-ms", f"{request.query_seconds * 1000:.3f}".encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_request.reset(token)
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": getattr(route, "path", "unmatched")}
+            metrics.inc("http_requests_total", **labels, status=status)
+            metrics.observe("http_request_seconds", time.perf_counter() - started, **labels)
+            metrics.observe("http_request_queries", request.queries, **labels)
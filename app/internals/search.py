@@ -0,0 +1,219 @@
+import logging
+from functools import cache
+
+from sqlalchemy import inspect, literal, null, union_all, text, table, column, func
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document
+from .hierarchy import subtree_filter, split_item_rows
+
+logger = logging.getLogger(__name__)
+
+# Trigram index needs at least this many characters, shorter queries fall back to LIKE
+MIN_INDEXED_QUERY = 3
+
+# Name index per table. The indexes are FTS5 tables with external content, they only hold
+# the trigram index and read names from the table itself, triggers keep them in sync.
+SEARCH_INDEXES = {
+    Folder.__tablename__: "folder_name_index",
+    Document.__tablename__: "document_name_index",
+}
+
+
+def create_search_index(connection):
+    """
+    Create the trigram name indexes and their sync triggers, filling the indexes from
+    existing rows when they are new. Postgres gets pg_trgm indexes instead, which serve
+    the ILIKE filters directly, other databases keep scanning.
+
+    :param connection:
+    :return bool: whether the indexes exist
+    """
+
+    if connection.dialect.name == "postgresql":
+        return create_trigram_indexes(connection)
+    if connection.dialect.name != "sqlite":
+        return False
+
+    for table_name, index_name in SEARCH_INDEXES.items():
+        exists = inspect(connection).has_table(index_name)
+        try:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {index_name} "
+                f"USING fts5(name, content='{table_name}', content_rowid='id', tokenize='trigram')"
+            ))
+        except OperationalError:
+            logger.warning("SQLite has no FTS5 trigram tokenizer, name search falls back to LIKE")
+            return False
+
+        # Renames and deletes remove the old name from the index before adding the new one
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {index_name}_insert AFTER INSERT ON {table_name} BEGIN "
+            f"INSERT INTO {index_name}(rowid, name) VALUES (new.id, new.name); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {index_name}_delete AFTER DELETE ON {table_name} BEGIN "
+            f"INSERT INTO {index_name}({index_name}, rowid, name) VALUES ('delete', old.id, old.name); END"
+        ))
+        connection.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {index_name}_update AFTER UPDATE OF name ON {table_name} BEGIN "
+            f"INSERT INTO {index_name}({index_name}, rowid, name) VALUES ('delete', old.id, old.name); "
+            f"INSERT INTO {index_name}(rowid, name) VALUES (new.id, new.name); END"
+        ))
+
+        if not exists:
+            connection.execute(text(f"INSERT INTO {index_name}({index_name}) VALUES ('rebuild')"))
+
+    return True
+
+
+def create_trigram_indexes(connection):
+    """
+    pg_trgm GIN indexes on the name columns, for Postgres.
+
+    :param connection:
+    :return bool: whether the indexes exist
+    """
+
+    try:
+        # A failed statement aborts the whole transaction on Postgres, hence the savepoint
+        with connection.begin_nested():
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError:
+        logger.warning("pg_trgm is not available, name search scans the tables")
+        return False
+
+    for table_name in SEARCH_INDEXES:
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_{table_name}_name_trgm ON {table_name} USING gin (name gin_trgm_ops)"
+        ))
+
+    return True
+
+
+@cache
+def has_search_index(engine):
+    """
+    Check once per engine whether the name indexes exist, FTS5 tables on SQLite and the
+    pg_trgm extension on Postgres.
+
+    :param engine:
+    :return bool:
+    """
+
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            return connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+    if engine.dialect.name != "sqlite":
+        return False
+
+    inspector = inspect(engine)
+    return all(inspector.has_table(index_name) for index_name in SEARCH_INDEXES.values())
+
+
+def match_phrase(q: str):
+    """
+    FTS5 phrase matching `q` as a plain substring, whatever characters it holds.
+
+    :param q:
+    :return str:
+    """
+
+    return '"' + q.replace('"', '""') + '"'
+
+
+def _uses_index(session, q: str):
+    bind = session.get_bind()
+    return bind.dialect.name == "sqlite" and len(q) >= MIN_INDEXED_QUERY and has_search_index(bind)
+
+
+def _index_table(model):
+    index_name = SEARCH_INDEXES[model.__tablename__]
+    return table(index_name, column("rowid"), column("rank"), column(index_name))
+
+
+def _matching_rows(session, model, q: str, indexed: bool):
+    """
+    SELECT over `model` restricted to names containing `q`, with the relevance to order
+    by (bm25 rank or negated trigram similarity, lower is better).
+    """
+
+    if not indexed:
+        statement = select(model.id).where(model.name.ilike(f"%{q}%"))
+        bind = session.get_bind()
+        if bind.dialect.name == "postgresql" and has_search_index(bind):
+            return statement, -func.similarity(model.name, q)
+        return statement, literal(0.0)
+
+    index = _index_table(model)
+    statement = (
+        select(model.id)
+        .select_from(index)
+        .join(model, model.id == index.c.rowid)
+        .where(index.c[index.name].op("MATCH")(match_phrase(q)))
+    )
+    return statement, index.c.rank
+
+
+def name_filter(session, model, q: str):
+    """
+    Condition matching rows of `model` whose name contains `q`, case insensitive. Uses the
+    trigram index when possible instead of scanning the table.
+
+    :param session:
+    :param model: Folder or Document
+    :param q:
+    :return ColumnElement:
+    """
+
+    if not _uses_index(session, q):
+        return model.name.ilike(f"%{q}%")
+
+    index = _index_table(model)
+    return model.id.in_(select(index.c.rowid).where(index.c[index.name].op("MATCH")(match_phrase(q))))
+
+
+def search_names(session, q: str, folder: Folder | None = None, limit: int = 50, offset: int = 0):
+    """
+    Search folders and documents by name, in the whole tree or below a folder. Results
+    are ranked by relevance, shorter names with more matches first, and paginated.
+
+    :param session:
+    :param q:
+    :param folder: None to search everything
+    :param limit:
+    :param offset:
+    :return tuple[list[dict], list[dict], int | None]: folders, documents, next offset
+    """
+
+    indexed = _uses_index(session, q)
+    folder_hits, folder_rank = _matching_rows(session, Folder, q, indexed)
+    document_hits, document_rank = _matching_rows(session, Document, q, indexed)
+
+    folder_rows = folder_hits.with_only_columns(
+        literal("folder").label("kind"), Folder.id, Folder.parent_id, Folder.name,
+        null().label("file_url"), null().label("blob_digest"), folder_rank.label("rank")
+    )
+    document_rows = document_hits.with_only_columns(
+        literal("document"), Document.id, Document.folder_id, Document.name,
+        Document.file_url, Document.blob_digest, document_rank
+    )
+
+    # Subtree scope, the folder itself isn't part of its own search results
+    if folder:
+        folder_rows = folder_rows.where(subtree_filter(folder.path, include_self=False))
+        document_rows = document_rows.join(Folder, Folder.id == Document.folder_id).where(subtree_filter(folder.path))
+
+    rows = union_all(folder_rows, document_rows).subquery()
+    statement = (
+        select(rows)
+        .order_by(rows.c.rank, rows.c.kind.desc(), rows.c.name, rows.c.id)
+        .limit(limit + 1)
+        .offset(offset)
+    )
+    result = session.execute(statement).all()
+
+    folders, documents = split_item_rows(result[:limit])
+    next_offset = offset + limit if len(result) > limit else None
+    return folders, documents, next_offset
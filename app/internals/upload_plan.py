@@ -0,0 +1,282 @@
+import os
+from collections import Counter
+
+from fastapi import HTTPException
+from sqlalchemy import or_
+from sqlmodel import select
+
+from ..models.database.folder_and_files import Folder, Document, Blob
+from .blob_store import acquire_blobs, release_blob_counts, blob_file_exists
+from .folder_and_files import plan_folder_tree, normalize_upload_paths, get_colliding_folder_names, \
+    pick_unique_folder_name, BATCH_SIZE
+
+
+def _parent_filter(column, parent_ids: set):
+    """
+    Match a set of parent ids, None standing for the root.
+    """
+
+    ids = [parent_id for parent_id in parent_ids if parent_id is not None]
+    conditions = [column.in_(ids)] if ids else []
+    if None in parent_ids:
+        conditions.append(column.is_(None))
+    return or_(*conditions)
+
+
+def get_upload_root(session, folder_id: int | None):
+    """
+    Target folder of an upload, registered under its name the way uploads address it.
+
+    :param session:
+    :param folder_id:
+    :return tuple[str, dict]: normalized root path and the folder mapper holding the root
+    """
+
+    if not folder_id:
+        return "", {}
+
+    root_folder = session.get(Folder, folder_id)
+    if not root_folder:
+        raise HTTPException(404, "Parent folder not found")
+    root_folder_path = os.path.normpath(root_folder.name)
+    return root_folder_path, {root_folder_path: root_folder}
+
+
+def find_existing_folders(session, levels: list, folder_mapper: dict, batch_size: int = BATCH_SIZE):
+    """
+    Match planned folders with the folders already at their paths, with one query per
+    depth level and batch. Only folders whose parent exists can exist themselves.
+
+    :param session:
+    :param levels: planned folders grouped by depth as (full path, name, parent path)
+    :param folder_mapper: normalized path to folder, updated in place
+    :param batch_size:
+    :return None:
+    """
+
+    for level in levels:
+        wanted = {}
+        for full_path, name, parent_path in level:
+            if full_path in folder_mapper or (parent_path is not None and parent_path not in folder_mapper):
+                continue
+            parent_folder = folder_mapper.get(parent_path)
+            wanted[(parent_folder.id if parent_folder else None, name)] = full_path
+
+        keys = list(wanted)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            statement = select(Folder).where(
+                _parent_filter(Folder.parent_id, {parent_id for parent_id, _ in batch}),
+                Folder.name.in_({name for _, name in batch})
+            ).order_by(Folder.id)
+
+            # Lowest id wins when a name exists twice
+            for folder in session.exec(statement).all():
+                full_path = wanted.get((folder.parent_id, folder.name))
+                if full_path is not None and full_path not in folder_mapper:
+                    folder_mapper[full_path] = folder
+
+
+def find_existing_documents(session, paths: list[str], folder_mapper: dict, batch_size: int = BATCH_SIZE):
+    """
+    Documents already stored at the normalized paths of an upload.
+
+    :param session:
+    :param paths:
+    :param folder_mapper: normalized path to existing folder
+    :param batch_size:
+    :return dict[str, tuple[int, str | None]]: path to document id and blob digest
+    """
+
+    wanted = {}
+    for path in paths:
+        parent_path = os.path.dirname(path) or None
+        if parent_path is not None and parent_path not in folder_mapper:
+            continue
+        parent_folder = folder_mapper.get(parent_path)
+        wanted[(parent_folder.id if parent_folder else None, os.path.basename(path))] = path
+
+    existing = {}
+    keys = list(wanted)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        statement = select(Document.id, Document.folder_id, Document.name, Document.blob_digest).where(
+            _parent_filter(Document.folder_id, {parent_id for parent_id, _ in batch}),
+            Document.name.in_({name for _, name in batch})
+        ).order_by(Document.id)
+        for document_id, folder_id, name, digest in session.exec(statement).all():
+            path = wanted.get((folder_id, name))
+            if path is not None:
+                existing.setdefault(path, (document_id, digest))
+
+    return existing
+
+
+def find_stored_digests(session, digests: list[str], batch_size: int = BATCH_SIZE):
+    """
+    Digests among the given ones whose blob is stored and referenced.
+
+    :param session:
+    :param digests:
+    :param batch_size:
+    :return set[str]:
+    """
+
+    digests = list(set(digests))
+    stored = set()
+    for start in range(0, len(digests), batch_size):
+        statement = select(Blob.digest).where(Blob.digest.in_(digests[start:start + batch_size]), Blob.ref_count > 0)
+        stored.update(session.exec(statement).all())
+    return stored
+
+
+def plan_folder_names(session, levels: list, folder_mapper: dict, root_folder_path: str = ""):
+    """
+    Names the planned folders will get, resolving collisions the way the upload does
+    when it creates them. Folders in `folder_mapper` are kept as they are.
+
+    :param session:
+    :param levels: planned folders grouped by depth as (full path, name, parent path)
+    :param folder_mapper: normalized path to existing folder
+    :param root_folder_path: normalized path of the target folder, left out of the plan
+    :return tuple[list[dict], list[dict]]: planned folders and renamed folder reports
+    """
+
+    folders = []
+    renamed_folders = []
+
+    # Names handed out per existing parent id, new parents have no siblings to collide with
+    sibling_names = {}
+
+    for level in levels:
+        for full_path, name, parent_path in level:
+            if full_path == root_folder_path:
+                continue
+            relative_path = os.path.relpath(full_path, root_folder_path) if root_folder_path else full_path
+
+            existing_folder = folder_mapper.get(full_path)
+            if existing_folder is not None:
+                folders.append({"path": relative_path, "name": existing_folder.name, "id": existing_folder.id})
+                continue
+
+            unique_name = name
+            if parent_path is None or parent_path in folder_mapper:
+                parent_folder = folder_mapper.get(parent_path)
+                parent_id = parent_folder.id if parent_folder else None
+                taken_names = sibling_names.setdefault(parent_id, set())
+                unique_name, was_renamed = pick_unique_folder_name(
+                    name, taken_names | get_colliding_folder_names(session, name, parent_id)
+                )
+                taken_names.add(unique_name)
+                if was_renamed:
+                    renamed_folders.append({
+                        'original_path': full_path,
+                        'new_name': unique_name,
+                        'parent_folder': parent_folder.name if parent_folder else None
+                    })
+
+            folders.append({"path": relative_path, "name": unique_name, "id": None})
+
+    return folders, renamed_folders
+
+
+def plan_upload(session, folder_id: int | None, entries: list, merge: bool = False):
+    """
+    Plan an upload from its manifest before any byte is sent: the folders it creates or
+    reuses, and per file whether its content has to be uploaded, can be linked to a
+    stored blob, or is already in place.
+
+    Without `merge` every top-level folder is new and gets a unique name. With it,
+    folders at existing paths are reused, files matching the digest of the document at
+    their path are skipped and other files replace that document's content.
+
+    :param session:
+    :param folder_id:
+    :param entries: manifest entries with path, size and optional digest
+    :param merge:
+    :return tuple[list[dict], list[dict], list[dict]]: session file rows, planned folders
+    and renamed folder reports
+    """
+
+    root_folder_path, folder_mapper = get_upload_root(session, folder_id)
+    paths = normalize_upload_paths([entry.path for entry in entries], root_folder_path)
+    levels, _ = plan_folder_tree(paths)
+
+    existing_documents = {}
+    if merge:
+        find_existing_folders(session, levels, folder_mapper)
+        existing_documents = find_existing_documents(session, paths, folder_mapper)
+    folders, renamed_folders = plan_folder_names(session, levels, folder_mapper, root_folder_path)
+
+    stored_digests = find_stored_digests(session, [entry.digest for entry in entries if entry.digest])
+
+    files = []
+    for entry, path in zip(entries, paths):
+        document_id, current_digest = existing_documents.get(path, (None, None))
+        if entry.digest and document_id and entry.digest == current_digest:
+            action = "skip"
+        elif entry.digest in stored_digests:
+            action = "link"
+        else:
+            action = "upload"
+        files.append({
+            "path": entry.path, "size": entry.size, "digest": entry.digest,
+            "action": action, "document_id": document_id
+        })
+
+    return files, folders, renamed_folders
+
+
+def find_merge_folders(session, folder_id: int | None, paths: list[str]):
+    """
+    Existing folders an upload merges into, looked up again when it is materialized.
+
+    :param session:
+    :param folder_id:
+    :param paths: relative paths of the files to create
+    :return dict: normalized path to existing folder, the target folder included
+    """
+
+    root_folder_path, folder_mapper = get_upload_root(session, folder_id)
+    levels, _ = plan_folder_tree(normalize_upload_paths(paths, root_folder_path))
+    find_existing_folders(session, levels, folder_mapper)
+    return folder_mapper
+
+
+def pin_blobs(session, blobs: list[tuple[str, int]]):
+    """
+    Take a reference on each blob a session links to and commit it, so the reaper keeps
+    the blob until the documents pointing at it are committed. Blobs whose file was
+    purged meanwhile are released again.
+
+    :param session:
+    :param blobs: digest and size pairs
+    :return tuple[list[str], list[str]]: pinned digests, and digests that can't be linked
+    """
+
+    digests = dict(blobs)
+    if not digests:
+        return [], []
+
+    acquire_blobs(session, list(digests.items()))
+    session.commit()
+
+    missing = [digest for digest in digests if not blob_file_exists(digest)]
+    if missing:
+        release_blob_counts(session, Counter(missing))
+        session.commit()
+    return [digest for digest in digests if digest not in missing], missing
+
+
+def unpin_blobs(session, digests: list[str]):
+    """
+    Drop the references taken by pin_blobs.
+
+    :param session:
+    :param digests:
+    :return None:
+    """
+
+    if digests:
+        release_blob_counts(session, Counter(digests))
+        session.commit()
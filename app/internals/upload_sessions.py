@@ -0,0 +1,375 @@
+import asyncio
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException, Request
+from sqlalchemy import delete, update, or_, and_
+from sqlmodel import select
+from starlette.requests import ClientDisconnect
+
+from ..models.database.upload_session import UploadSession, UploadSessionFile, UploadChunk
+from .blob_store import TMP_DIR, new_hasher, COPY_CHUNK_SIZE
+from .concurrency import run_blocking, run_write
+from .file_writer import StoredFile, FileHandle, write_at
+from .folder_upload import CHUNK_SIZE
+from .folder_and_files import bulk_insert
+
+# Partial uploads live here, one directory per session and one file per manifest entry
+SESSION_DIR = os.path.join(TMP_DIR, "sessions")
+
+# Sessions not finalized within this many seconds are removed with their data
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 3600))
+
+# A finalize started right before the expiry may still run, finalizing sessions are only
+# removed once they expired this many seconds ago
+FINALIZING_GRACE = UPLOAD_SESSION_TTL
+
+# Upper bound of the declared size of one session, i.e. of the disk space it can take
+UPLOAD_SESSION_MAX_SIZE = int(os.getenv("UPLOAD_SESSION_MAX_SIZE", 100 * 1024 ** 3))  # 100GB
+
+# Chunk size suggested to clients, and the largest chunk accepted in one request
+SESSION_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+MAX_SESSION_CHUNK_SIZE = 64 * 1024 * 1024  # 64MB
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def session_file_path(session_id: str, index: int):
+    """
+    Location of the partial file of a manifest entry.
+
+    :param session_id:
+    :param index:
+    :return str:
+    """
+
+    return os.path.join(SESSION_DIR, session_id, str(index))
+
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping and adjacent [start, end) ranges.
+
+    :param ranges:
+    :return list[tuple[int, int]]: sorted, disjoint ranges
+    """
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def is_complete(received: list[tuple[int, int]], size: int):
+    return size == 0 or received == [(0, size)]
+
+
+def create_upload_session(session, folder_id: int | None, files: list[dict], merge: bool = False):
+    """
+    Register an upload session for a manifest of files, each a dict with the relative
+    path and size and optionally the planned action, digest and replaced document id.
+
+    :param session:
+    :param folder_id: folder the upload is materialized in, None for the root
+    :param files:
+    :param merge: reuse existing folders when materializing
+    :return UploadSession:
+    """
+
+    # Only the bytes that are actually sent take disk space
+    total_size = sum(file["size"] for file in files if file.get("action", "upload") == "upload")
+    if total_size > UPLOAD_SESSION_MAX_SIZE:
+        raise HTTPException(413, f"Upload sessions are limited to {UPLOAD_SESSION_MAX_SIZE} bytes.")
+
+    now = utcnow()
+    upload = UploadSession(
+        id=uuid.uuid4().hex, folder_id=folder_id, total_size=total_size, merge=merge,
+        created_at=now, expires_at=now + timedelta(seconds=UPLOAD_SESSION_TTL)
+    )
+    session.add(upload)
+    session.flush()
+    bulk_insert(session, UploadSessionFile, [
+        {"action": "upload", "digest": None, "document_id": None, **file, "session_id": upload.id, "index": index}
+        for index, file in enumerate(files)
+    ])
+    session.commit()
+    session.refresh(upload)
+
+    os.makedirs(os.path.join(SESSION_DIR, upload.id), exist_ok=True)
+    return upload
+
+
+def get_open_upload_session(session, session_id: str):
+    """
+    Fetch a session that still accepts chunks.
+
+    :param session:
+    :param session_id:
+    :return UploadSession:
+    """
+
+    upload = session.get(UploadSession, session_id)
+    if not upload or upload.expires_at < utcnow():
+        raise HTTPException(404, "Upload session not found")
+    if upload.status != "open":
+        raise HTTPException(409, "Upload session is being finalized")
+    return upload
+
+
+def get_received_ranges(session, session_id: str, file_index: int | None = None):
+    """
+    Merged byte ranges on disk, per file of a session.
+
+    :param session:
+    :param session_id:
+    :param file_index: only this file
+    :return dict[int, list[tuple[int, int]]]:
+    """
+
+    statement = select(UploadChunk.file_index, UploadChunk.start, UploadChunk.end).where(
+        UploadChunk.session_id == session_id
+    )
+    if file_index is not None:
+        statement = statement.where(UploadChunk.file_index == file_index)
+
+    chunks = {}
+    for index, start, end in session.exec(statement).all():
+        chunks.setdefault(index, []).append((start, end))
+    return {index: merge_ranges(ranges) for index, ranges in chunks.items()}
+
+
+def record_chunk(session, session_id: str, file_index: int, start: int, end: int):
+    """
+    Remember that [start, end) of a file is on disk.
+
+    :return list[tuple[int, int]]: received ranges of the file
+    """
+
+    session.add(UploadChunk(session_id=session_id, file_index=file_index, start=start, end=end))
+    session.commit()
+    return get_received_ranges(session, session_id, file_index).get(file_index, [])
+
+
+async def receive_chunk(request: Request, file_path: str, offset: int, max_length: int):
+    """
+    Write a request body to a file at an offset, buffered in blocks of CHUNK_SIZE so a
+    chunk never takes more memory than that.
+
+    :param request:
+    :param file_path:
+    :param offset:
+    :param max_length: bytes allowed from the offset on
+    :return int: bytes written, also when the client disconnected half way
+    """
+
+    handle = FileHandle(StoredFile(filename=os.path.basename(file_path), file_path=file_path))
+    handle.fd = await run_write(os.open, file_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    written = 0
+    buffer = bytearray()
+    try:
+        try:
+            async for data in request.stream():
+                if written + len(buffer) + len(data) > max_length:
+                    raise HTTPException(413, "Chunk goes past the end of the file.")
+                buffer.extend(data)
+                if len(buffer) >= CHUNK_SIZE:
+                    await run_write(write_at, handle, bytes(buffer), offset + written)
+                    written += len(buffer)
+                    buffer.clear()
+        except ClientDisconnect:
+            pass
+        if buffer:
+            await run_write(write_at, handle, bytes(buffer), offset + written)
+            written += len(buffer)
+    finally:
+        await run_write(os.close, handle.fd)
+
+    return written
+
+
+def touch(path: str):
+    """
+    Create an empty file unless it exists.
+
+    :param path:
+    :return None:
+    """
+
+    open(path, "ab").close()
+
+
+def hash_file(path: str):
+    """
+    Digest and size of a file on disk, read in chunks.
+
+    :param path:
+    :return tuple[str, int]:
+    """
+
+    hasher = new_hasher()
+    size = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(COPY_CHUNK_SIZE):
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def start_finalizing(session, session_id: str):
+    """
+    Move a complete session from open to finalizing, so no chunk can change it anymore.
+
+    :param session:
+    :param session_id:
+    :return tuple[int | None, bool, list[dict]]: target folder id, whether to merge, and
+    the index, path, size, action, digest and replaced document id of every file
+    """
+
+    claimed = session.execute(
+        update(UploadSession)
+        .where(UploadSession.id == session_id, UploadSession.status == "open", UploadSession.expires_at >= utcnow())
+        .values(status="finalizing")
+    ).rowcount
+    if not claimed:
+        session.rollback()
+        upload = session.get(UploadSession, session_id)
+        if not upload or upload.expires_at < utcnow():
+            raise HTTPException(404, "Upload session not found")
+        raise HTTPException(409, "Upload session is already being finalized")
+
+    files = session.exec(
+        select(UploadSessionFile).where(UploadSessionFile.session_id == session_id).order_by(UploadSessionFile.index)
+    ).all()
+    received = get_received_ranges(session, session_id)
+    missing = [
+        file.index for file in files
+        if file.action == "upload" and not is_complete(received.get(file.index, []), file.size)
+    ]
+    if missing:
+        session.rollback()
+        raise HTTPException(409, {"message": "Upload is incomplete", "incomplete_files": missing[:100]})
+
+    upload = session.get(UploadSession, session_id)
+    folder_id, merge = upload.folder_id, upload.merge
+    manifest = [
+        {
+            "index": file.index, "path": file.path, "size": file.size, "action": file.action,
+            "digest": file.digest, "document_id": file.document_id
+        }
+        for file in files
+    ]
+    session.commit()
+    return folder_id, merge, manifest
+
+
+def reopen_upload_session(session, session_id: str, indexes: list[int]):
+    """
+    Give a finalizing session back to the client with the given files to be uploaded
+    again, from scratch.
+
+    :param session:
+    :param session_id:
+    :param indexes:
+    :return None:
+    """
+
+    session.execute(
+        update(UploadSessionFile)
+        .where(UploadSessionFile.session_id == session_id, UploadSessionFile.index.in_(indexes))
+        .values(action="upload")
+    )
+    session.execute(
+        delete(UploadChunk).where(UploadChunk.session_id == session_id, UploadChunk.file_index.in_(indexes))
+    )
+    session.execute(update(UploadSession).where(UploadSession.id == session_id).values(status="open"))
+    session.commit()
+    for index in indexes:
+        try:
+            os.remove(session_file_path(session_id, index))
+        except FileNotFoundError:
+            pass
+
+
+def release_upload_session(session, session_id: str, manifest: list[dict]):
+    """
+    Give a session whose finalizing failed back to the client, with the files the failed
+    run took off the disk to be uploaded again.
+
+    :param session:
+    :param session_id:
+    :param manifest: files as returned by start_finalizing
+    :return None:
+    """
+
+    gone = [
+        file["index"] for file in manifest
+        if file["action"] == "upload" and not os.path.exists(session_file_path(session_id, file["index"]))
+    ]
+    reopen_upload_session(session, session_id, gone)
+
+
+async def stored_session_files(session_id: str, manifest: list[dict]):
+    """
+    Hash the complete files of a session, the way the folder upload parser leaves them.
+    Linked files are stored already and only carry their declared digest.
+
+    :param session_id:
+    :param manifest: files as returned by start_finalizing
+    :return list[StoredFile]:
+    """
+
+    async def stored(file: dict):
+        filename = os.path.basename(file["path"])
+        if file["action"] == "link":
+            return StoredFile(filename=filename, file_path=None, size=file["size"], digest=file["digest"])
+
+        file_path = session_file_path(session_id, file["index"])
+        if file["size"] == 0:
+            await run_write(touch, file_path)
+        digest, size = await run_blocking(hash_file, file_path)
+        return StoredFile(filename=filename, file_path=file_path, size=size, digest=digest)
+
+    return list(await asyncio.gather(*[stored(file) for file in manifest]))
+
+
+def remove_upload_session(session, session_id: str):
+    """
+    Remove a session's rows and whatever is left of its files.
+
+    :param session:
+    :param session_id:
+    :return None:
+    """
+
+    session.execute(delete(UploadChunk).where(UploadChunk.session_id == session_id))
+    session.execute(delete(UploadSessionFile).where(UploadSessionFile.session_id == session_id))
+    session.execute(delete(UploadSession).where(UploadSession.id == session_id))
+    session.commit()
+    shutil.rmtree(os.path.join(SESSION_DIR, session_id), ignore_errors=True)
+
+
+def purge_expired_upload_sessions(session):
+    """
+    Remove sessions past their expiry, giving their disk space back. Finalizing sessions
+    are removed FINALIZING_GRACE later, a finalize that stopped without reopening its
+    session would keep it forever.
+
+    :param session:
+    :return int: number of sessions removed
+    """
+
+    now = utcnow()
+    expired = session.exec(select(UploadSession.id).where(or_(
+        and_(UploadSession.status != "finalizing", UploadSession.expires_at < now),
+        UploadSession.expires_at < now - timedelta(seconds=FINALIZING_GRACE)
+    ))).all()
+    for session_id in expired:
+        remove_upload_session(session, session_id)
+    return len(expired)
@@ -1,24 +1,46 @@
-from fastapi import FastAPI
-from .db import create_db_and_tables
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from .db import create_db_and_tables, engine, read_engine, POOL_RETRY_AFTER
+from .internals.blob_reaper import blob_reaper
+from .internals.ingest_jobs import ingest_queue
+from .internals.metrics import metrics, MetricsMiddleware, METRICS_ENABLED
 from .models.database.folder_and_files import Folder, Document
 from fastapi.middleware.cors import CORSMiddleware
 
-from .routers import folder_and_files
+from .routers import folder_and_files, upload_sessions, ingest_jobs, batch, metrics as metrics_router
 
 
 # Lifespan function
+@asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Run application startup logics
     """
 
-    # create tables
+    # create tables and bring older databases up to date
     await create_db_and_tables()
 
+    # remove unreferenced blobs in the background, starting with leftovers of earlier runs
+    blob_reaper.start()
+
+    # run background folder uploads, resuming those an earlier run left unfinished
+    await ingest_queue.start()
+
     # Yield control back to FastAPI
     yield
 
-app = FastAPI()
+    await ingest_queue.stop()
+    blob_reaper.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Request, query and upload timings for /metrics, a flag check per request when disabled
+if METRICS_ENABLED:
+    metrics.enable(engine, read_engine)
+app.add_middleware(MetricsMiddleware)
 
 # Cors config
 origins = [
@@ -34,8 +56,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(PoolTimeoutError)
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    """
+    No database connection freed up in time, the request can be retried as it is.
+    """
+
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Database is busy, try again later"},
+        headers={"Retry-After": str(POOL_RETRY_AFTER)}
+    )
+
+
 # Router configs
 app.include_router(folder_and_files.router)
+app.include_router(upload_sessions.router)
+app.include_router(ingest_jobs.router)
+app.include_router(batch.router)
+app.include_router(metrics_router.router)
 
 
 @app.get('/', tags=['root'])
@@ -1,18 +1,38 @@
 from typing import Optional
-from sqlmodel import Field, Relationship
-from ..public.folder_and_files import FolderBase, DocumentBase
+from sqlalchemy import Index, String
+from sqlmodel import SQLModel, Field, Relationship
+from ..public.folder_and_files import FolderBase, DocumentBase, BlobBase
+
+# Names and paths compare byte-wise like SQLite does, on Postgres too. Path ranges and the
+# "name (n)" collision range rely on it, locale collations ignore punctuation.
+BinaryString = String().with_variant(String(collation="C"), "postgresql")
 
 
 class Folder(FolderBase, table=True):
     __tablename__ = "folder"
-    
+
+    # Children of a folder in id order, for keyset pagination of listings, see
+    # listing_name_index for the name order
+    __table_args__ = (
+        Index("ix_folder_parent_id_id", "parent_id", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
+    name: str | None = Field(default=None, sa_type=BinaryString)
     parent_id: int | None = Field(
         default=None,
         foreign_key="folder.id",
         nullable=True
     )
 
+    # Materialized path of ancestor ids including the folder itself, e.g. "/1/5/9/", so
+    # subtree and ancestor lookups are indexed range scans.
+    path: str | None = Field(default=None, index=True, sa_type=BinaryString)
+
+    # Changes whenever the folder is renamed or moved, or an ancestor moves. Moves are
+    # conditional on it, so concurrent moves can't build a cycle.
+    version: int = Field(default=1)
+
     # For self-referential relationships
     _remote_side = []
 
@@ -28,7 +48,61 @@ class Folder(FolderBase, table=True):
 
 class Document(DocumentBase, table=True):
     __tablename__ = "documents"
-    
+
+    __table_args__ = (
+        Index("ix_documents_folder_id_id", "folder_id", "id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
+    name: str = Field(sa_type=BinaryString)
     folder_id: int | None = Field(default=None, foreign_key="folder.id", nullable=True)
-    folder: Folder | None = Relationship(back_populates="documents")
\ No newline at end of file
+    folder: Folder | None = Relationship(back_populates="documents")
+
+    # Content addressed blob holding the file, None for files stored before blobs existed
+    blob_digest: str | None = Field(default=None, foreign_key="blobs.digest", nullable=True, index=True)
+
+
+def _not_postgresql(ddl, target, bind, dialect=None, **kwargs):
+    return dialect.name != "postgresql"
+
+
+def listing_name_index(name: str, parent_column, name_column, id_column):
+    """
+    Index of the children of a folder in the order listings are paginated by name, NULL
+    names first. SQLite sorts NULLs first and doesn't accept NULLS FIRST in an index, its
+    rowid ends every index already. Postgres sorts NULLs last unless told otherwise.
+
+    :param name:
+    :param parent_column:
+    :param name_column:
+    :param id_column:
+    :return None:
+    """
+
+    Index(name, parent_column, name_column).ddl_if(callable_=_not_postgresql)
+    Index(f"{name}_nulls_first", parent_column, name_column.asc().nulls_first(), id_column).ddl_if(dialect="postgresql")
+
+
+listing_name_index("ix_folder_parent_id_name", Folder.parent_id, Folder.name, Folder.id)
+listing_name_index("ix_documents_folder_id_name", Document.folder_id, Document.name, Document.id)
+
+
+class Blob(BlobBase, table=True):
+    __tablename__ = "blobs"
+
+    digest: str = Field(primary_key=True)
+
+    # Number of documents pointing at the blob, the file is removed once it drops to 0
+    ref_count: int = Field(default=0)
+
+
+class DiscardedFile(SQLModel, table=True):
+    """
+    File of a deleted document stored before blobs existed, queued in the transaction
+    deleting the document, so the blob reaper removes it even after a restart.
+    """
+
+    __tablename__ = "discarded_files"
+
+    id: int | None = Field(default=None, primary_key=True)
+    path: str
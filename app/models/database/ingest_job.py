@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from sqlmodel import SQLModel, Field
+
+
+class IngestJob(SQLModel, table=True):
+    """
+    Folder upload materialized in the background. The job is marked complete in the same
+    transaction as its documents, so a job still queued or running after a restart has
+    committed nothing and is run again from its stored files.
+    """
+
+    __tablename__ = "ingest_jobs"
+
+    id: str = Field(primary_key=True)
+
+    # No foreign key, finished jobs are kept for JOB_RETENTION and must not block deleting
+    # the folder, a job still queued for a deleted folder fails on the missing parent
+    folder_id: int | None = Field(default=None, nullable=True)
+
+    # queued -> running -> complete | failed
+    status: str = Field(default="queued", index=True)
+    stage: str | None = None
+    message: str | None = None
+    total_files: int = Field(default=0)
+    attempts: int = Field(default=0)
+
+    # Process that queued or runs the job and until when, renewed while it runs. Other
+    # processes only take the job over once the lease expired.
+    owner: str | None = None
+    lease_expires_at: datetime | None = None
+    progress_every: int | None = None
+    progress_rate: float | None = None
+
+    # Last event of a finished job, as JSON
+    result: str | None = None
+    created_at: datetime
+    updated_at: datetime = Field(index=True)
+
+
+class IngestJobFile(SQLModel, table=True):
+    """
+    File of a job, streamed to its temporary location before the job was queued.
+    """
+
+    __tablename__ = "ingest_job_files"
+
+    job_id: str = Field(foreign_key="ingest_jobs.id", primary_key=True)
+    index: int = Field(primary_key=True)
+    path: str
+    filename: str
+    file_path: str | None = None
+    size: int = Field(default=0)
+    digest: str | None = None
+    error: str | None = None
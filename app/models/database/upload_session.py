@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field
+
+
+class UploadSession(SQLModel, table=True):
+    __tablename__ = "upload_sessions"
+
+    id: str = Field(primary_key=True)
+
+    # No foreign key, so deleting the folder isn't blocked by a session, finalizing then
+    # reports the missing parent folder
+    folder_id: int | None = Field(default=None, nullable=True)
+
+    # open -> finalizing, the rows are removed once the upload is materialized
+    status: str = Field(default="open")
+    total_size: int = Field(default=0)
+
+    # Reuse folders that already exist at the planned paths instead of renaming
+    merge: bool = Field(default=False)
+    created_at: datetime
+    expires_at: datetime = Field(index=True)
+
+
+class UploadSessionFile(SQLModel, table=True):
+    __tablename__ = "upload_session_files"
+
+    session_id: str = Field(foreign_key="upload_sessions.id", primary_key=True)
+    index: int = Field(primary_key=True)
+    path: str
+    size: int
+
+    # upload: bytes are sent, link: the content is stored already, skip: the document exists
+    action: str = Field(default="upload")
+    digest: str | None = None
+
+    # Existing document of the same path whose content the file replaces, no foreign key
+    # so deleting the document meanwhile isn't blocked by an open session
+    document_id: int | None = None
+
+
+class UploadChunk(SQLModel, table=True):
+    """
+    Byte range [start, end) of a session file that is on disk. Chunks are only ever
+    inserted, so parallel PUTs to the same file never overwrite each other's records.
+    """
+
+    __tablename__ = "upload_chunks"
+    __table_args__ = (
+        Index("ix_upload_chunks_session_id_file_index", "session_id", "file_index"),
+    )
+
+    id: int | None = Field(default=None, primary_key=True)
+    session_id: str = Field(foreign_key="upload_sessions.id")
+    file_index: int
+    start: int
+    end: int
@@ -0,0 +1,33 @@
+from typing import Literal
+
+from sqlmodel import SQLModel, Field
+
+# Operations accepted in one batch
+MAX_BATCH_OPERATIONS = 10000
+
+
+class BatchOperation(SQLModel):
+    op: Literal["move", "rename", "delete"]
+    type: Literal["folder", "file"]
+    id: int
+
+    # move: target folder, None for the root. rename: new name.
+    parent_id: int | None = None
+    name: str | None = None
+
+
+class BatchRequest(SQLModel):
+    operations: list[BatchOperation] = Field(min_length=1, max_length=MAX_BATCH_OPERATIONS)
+
+
+class BatchItemResult(SQLModel):
+    index: int
+    ok: bool
+    error: str | None = None
+
+
+class BatchResultPublic(SQLModel):
+    applied: bool
+    results: list[BatchItemResult]
+    folders_deleted: int = 0
+    documents_deleted: int = 0
@@ -11,12 +11,16 @@ class FolderBase(SQLModel):
 class FolderPublic(FolderBase):
     id: int
     parent_id: int | None = None
+    version: int | None = None
 
 
 class FolderUpdate(FolderBase):
     parent_id: int | None = None
     name: str | None = None
 
+    # Version the client read, the update fails with 409 when the folder changed since
+    version: int | None = None
+
 
 class FolderCreate(FolderBase):
     parent_id: int | None = None
@@ -32,6 +36,7 @@ class DocumentBase(SQLModel):
 class DocumentPublic(DocumentBase):
     id: int
     folder_id: int | None = None
+    blob_digest: str | None = None
     
 
 class DocumentCreate(SQLModel):
@@ -41,3 +46,42 @@ class DocumentCreate(SQLModel):
 class DocumentUpdate(SQLModel):
     name: str | None = None
     folder_id: int | None = None
+
+
+class DocumentLink(SQLModel):
+    name: str
+    digest: str
+    folder_id: int | None = None
+
+
+# Listing classes
+
+class FolderListingPublic(SQLModel):
+    folders: list[FolderPublic]
+    documents: list[DocumentPublic]
+    next_cursor: str | None = None
+
+
+# Tree classes
+
+class FolderTreePublic(SQLModel):
+    folders: list[FolderPublic]
+    documents: list[DocumentPublic]
+    next_offset: int | None = None
+
+
+class SearchPublic(SQLModel):
+    folders: list[FolderPublic]
+    documents: list[DocumentPublic]
+    next_offset: int | None = None
+
+
+# Blob classes
+
+class BlobBase(SQLModel):
+    size: int
+    file_url: str
+
+
+class BlobLookup(SQLModel):
+    digests: list[str]
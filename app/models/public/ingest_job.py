@@ -0,0 +1,16 @@
+from datetime import datetime
+
+from sqlmodel import SQLModel
+
+
+class IngestJobPublic(SQLModel):
+    id: str
+    folder_id: int | None = None
+    status: str
+    stage: str | None = None
+    message: str | None = None
+    total_files: int
+    attempts: int
+    created_at: datetime
+    updated_at: datetime
+    last_event: dict | None = None
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+from sqlmodel import SQLModel, Field
+
+
+class UploadManifestEntry(SQLModel):
+    path: str = Field(min_length=1)
+    size: int = Field(ge=0)
+    digest: str | None = None
+
+
+class UploadSessionCreate(SQLModel):
+    files: list[UploadManifestEntry] = Field(min_length=1)
+
+
+class UploadFileStatus(SQLModel):
+    index: int
+    path: str
+    size: int
+    received: list[tuple[int, int]]
+    complete: bool
+    action: str = "upload"
+    document_id: int | None = None
+
+
+class UploadSessionPublic(SQLModel):
+    id: str
+    folder_id: int | None = None
+    status: str
+    total_size: int
+    received_size: int
+    chunk_size: int
+    expires_at: datetime
+    merge: bool = False
+    files: list[UploadFileStatus]
+
+
+class UploadChunkPublic(SQLModel):
+    index: int
+    received: list[tuple[int, int]]
+    complete: bool
+
+
+class PlannedFolder(SQLModel):
+    path: str
+    name: str
+    id: int | None = None
+
+
+class UploadPlanPublic(SQLModel):
+    session: UploadSessionPublic
+    folders: list[PlannedFolder]
+    renamed_folders: list[dict]
+    upload_files: int
+    upload_size: int
+    linked_files: int
+    unchanged_files: int
+    replaced_files: int
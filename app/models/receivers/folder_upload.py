@@ -1,3 +1,32 @@
 from pydantic import BaseModel
 from fastapi import UploadFile, Form, File
 
+
+# OpenAPI description of the folder upload form. The endpoint parses the multipart body
+# itself to stream files to disk, so FastAPI can't derive this from the signature.
+folder_upload_request_body = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["paths", "files"],
+                    "properties": {
+                        "paths": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Relative paths of the files, ordered same as files."
+                        },
+                        "files": {
+                            "type": "array",
+                            "items": {"type": "string", "format": "binary"},
+                            "description": "Upload a folder and use javascript to list out all the files inside "
+                                           "that folder."
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
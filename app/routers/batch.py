@@ -0,0 +1,66 @@
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Query
+from sqlalchemy.exc import OperationalError
+
+from ..db import SessionDep
+from ..models.public.batch import BatchRequest, BatchResultPublic
+from ..internals.batch import plan_batch, apply_batch
+from ..internals.blob_reaper import blob_reaper
+from ..internals.blob_store import discard_files
+from ..internals.listing_cache import listing_cache
+
+router = APIRouter(
+    tags=['batch']
+)
+
+
+@router.post('/batch', response_model=BatchResultPublic)
+def batch_operations(
+    batch: BatchRequest,
+    session: SessionDep,
+    atomic: Annotated[bool, Query(description="Apply nothing when any operation is invalid.")] = True
+):
+    """
+    Endpoint for moving, renaming and deleting many folders and files in one transaction.
+    Every operation is validated against the tree the whole batch produces, so moves can
+    swap places but never put a folder below itself.
+
+    When an operation is invalid, nothing is applied unless `atomic` is off, then the
+    valid operations are. Either way the result has the outcome of every operation.
+
+    :param batch:
+    :param session:
+    :param atomic:
+    :return BatchResultPublic:
+    """
+
+    plan, errors = plan_batch(session, batch.operations)
+    results = [{"index": index, "ok": index not in errors, "error": errors.get(index)} for index in range(len(batch.operations))]
+    if errors and atomic:
+        return {"applied": False, "results": results}
+
+    # Subtrees whose pages are cached under their old paths
+    old_paths = [plan.folders[folder_id][1] for folder_id in set(plan.folder_moves) | plan.folder_deletes]
+    touched = plan.touched_folder_ids()
+
+    try:
+        folders_deleted, documents_deleted, legacy_files = apply_batch(session, plan)
+        discard_files(session, legacy_files)
+        session.commit()
+    except OperationalError:
+        # Concurrent moves locking the same rows in opposite order
+        session.rollback()
+        raise HTTPException(409, "Folders of the batch are being changed concurrently, try again")
+
+    listing_cache.invalidate(*touched)
+    for path in old_paths:
+        if path:
+            listing_cache.invalidate_subtree(path)
+    if documents_deleted:
+        blob_reaper.wake()
+
+    return {
+        "applied": True, "results": results,
+        "folders_deleted": folders_deleted, "documents_deleted": documents_deleted
+    }
@@ -1,64 +1,89 @@
 import os
-import shutil
-import uuid
-from io import BytesIO
-from typing import Annotated
-
-from fastapi import APIRouter, UploadFile, Form, File, HTTPException
-from fastapi.responses import StreamingResponse
+from contextlib import suppress
+from typing import Annotated, Literal
+from urllib.parse import quote
+
+from fastapi import APIRouter, UploadFile, File, HTTPException, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from sqlalchemy.exc import OperationalError
 from sqlmodel import select
 
-from ..db import SessionDep
-from ..models.database.folder_and_files import Folder, Document
+from ..db import SessionDep, ReadSessionDep
+from ..models.database.folder_and_files import Folder, Document, Blob
 from ..models.public.folder_and_files import FolderPublic, FolderCreate, FolderUpdate, DocumentCreate, DocumentPublic, \
-    DocumentUpdate
-from ..internals.folder_and_files import stream_progress
+    DocumentUpdate, DocumentLink, BlobLookup, FolderTreePublic, SearchPublic, FolderListingPublic
+from ..models.receivers.folder_upload import folder_upload_request_body
+from ..internals.folder_and_files import stream_progress, discard_on_disconnect, ProgressThrottle, STAGES
+from ..internals.folder_upload import receive_folder_upload
+from ..internals.file_writer import discard_stored_files
+from ..internals.concurrency import run_blocking
+from ..internals.ingest_jobs import create_ingest_job, ingest_queue, job_public
+from ..internals.hierarchy import get_subtree, fill_folder_paths, move_folder_paths, is_ancestor, \
+    get_ancestor_folders, delete_subtree, claim_folders, check_folder_paths
+from ..internals.blob_store import store_temp_file, blob_path, acquire_blobs, release_blobs, place_blob, \
+    blob_file_exists, discard_files
+from ..internals.blob_reaper import blob_reaper
+from ..internals.search import search_names
+from ..internals.listing import list_folder
+from ..internals.listing_cache import listing_cache
+from ..internals.metrics import stage_span
+from ..internals.downloads import file_download_response
+from ..internals.archive import plan_archive, stream_zip, safe_name
 
 router = APIRouter(
     tags=['folder_upload']
 )
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-
-@router.post('/folder-upload')
-@router.post('/folder-upload/{folder_id}')
+@router.post('/folder-upload', openapi_extra=folder_upload_request_body)
+@router.post('/folder-upload/{folder_id}', openapi_extra=folder_upload_request_body)
 async def folder_upload(
-    paths: Annotated[list[str], Form(description="Relative paths of the files, ordered same as files.")],
-    files: Annotated[list[UploadFile], File(description="Upload a folder and use javascript to list out all the files "
-                                                        "inside that folder.")],
+    request: Request,
     session: SessionDep,
-    folder_id: int | None = None
+    folder_id: int | None = None,
+    progress_every: Annotated[int | None, Query(ge=1, description="Send a progress event every N files.")] = None,
+    progress_rate: Annotated[float | None, Query(gt=0, description="Send at most N progress events per second.")] = None,
+    background: Annotated[bool, Query(description="Return a job id right away instead of streaming progress.")] = False
 ):
     """
     Endpoint for uploading a folder and its contents preserving hierarchy and folder structure.
 
-    :param paths:
-    :param files:
+    The multipart body (`paths` and `files`) is parsed by hand so every file is streamed to
+    disk in chunks while it arrives, instead of being buffered in memory.
+
+    With `background`, the received upload is handed to a job and 202 is returned with its
+    id, progress is then polled from /jobs/{id} or followed on /jobs/{id}/events. The job
+    survives the client disconnecting and is resumed if the server restarts.
+
+    :param request:
     :param session:
     :param folder_id:
-    :return StreamingResponse:
+    :param progress_every:
+    :param progress_rate:
+    :param background:
+    :return StreamingResponse | JSONResponse:
     """
 
-    # Read each file's content and creating in memory copies.
-    files_copies = []
-    for file in files:
-        content = await file.read() 
-        # A new BytesIO object to act as a file-like object.
-        file_copy = UploadFile(filename=file.filename, file=BytesIO(content))
-        files_copies.append(file_copy)
+    # Stream files to disk
+    with stage_span(STAGES['VALIDATION']):
+        paths, files = await receive_folder_upload(request)
 
-    # Streaming part
-    return StreamingResponse(
-        stream_progress(paths, files_copies, session, folder_id),
-        media_type="text/event-stream"
-    )
+    if background:
+        if folder_id and not await run_blocking(session.get, Folder, folder_id):
+            await run_blocking(discard_stored_files, files)
+            raise HTTPException(status_code=404, detail="Parent folder not found")
+        job = await run_blocking(create_ingest_job, session, folder_id, paths, files, progress_every, progress_rate)
+        ingest_queue.enqueue(job.id)
+        return JSONResponse(status_code=202, content=jsonable_encoder(job_public(job)))
+
+    # Streaming part, nothing is kept when the client goes away before the upload is committed
+    events = stream_progress(paths, files, session, folder_id, progress=ProgressThrottle(progress_every, progress_rate))
+    return StreamingResponse(discard_on_disconnect(events, session, files), media_type="text/event-stream")
 
 
 @router.post('/folder-create', response_model=FolderPublic)
 @router.post('/folder-create/{folder_id}', response_model=FolderPublic)
-async def folder_create(folder_data: FolderCreate, session: SessionDep, folder_id: int | None = None):
+def folder_create(folder_data: FolderCreate, session: SessionDep, folder_id: int | None = None):
     """
     Endpoint for creating folder.
 
@@ -70,20 +95,26 @@ async def folder_create(folder_data: FolderCreate, session: SessionDep, folder_i
     :return FolderPublic:
     """
 
+    if folder_id and not session.get(Folder, folder_id):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+
     # Validate and serialize data
     db_folder = Folder.model_validate(folder_data)
     db_folder.parent_id = folder_id
 
-    # Commit into db
+    # Commit into db, the path needs the new id
     session.add(db_folder)
+    session.flush()
+    fill_folder_paths(session, [db_folder.id])
     session.commit()
+    listing_cache.invalidate(folder_id)
     session.refresh(db_folder)
 
     return db_folder
 
 
 @router.patch('/folder-update/{folder_id}', response_model=FolderPublic)
-async def folder_update(folder_id: int, folder_data: FolderUpdate, session: SessionDep):
+def folder_update(folder_id: int, folder_data: FolderUpdate, session: SessionDep):
     """
     Endpoint for updating folder, and/or renaming, moving to different folder.
 
@@ -91,6 +122,7 @@ async def folder_update(folder_id: int, folder_data: FolderUpdate, session: Sess
     :param folder_data:
         - name:
         - parent_id:
+        - version: optional, the version the client read
     :param session:
     :return FolderPublic:
     """
@@ -104,18 +136,68 @@ async def folder_update(folder_id: int, folder_data: FolderUpdate, session: Sess
 
     # Dump and serialize updated data
     update_data = folder_data.model_dump(exclude_unset=True)
-    folder_db.sqlmodel_update(update_data)
-
-    # Commit changes into db
-    session.add(folder_db)
-    session.commit()
+    expected_version = update_data.pop("version", None)
+    old_parent_id, old_path = folder_db.parent_id, folder_db.path
+
+    new_parent = None
+    moving = "parent_id" in update_data and update_data["parent_id"] != folder_db.parent_id
+    if moving:
+        new_parent = session.get(Folder, update_data["parent_id"]) if update_data["parent_id"] else None
+        if update_data["parent_id"] and not new_parent:
+            raise HTTPException(404, "Parent folder not found")
+        if new_parent and is_ancestor(folder_db, new_parent):
+            raise HTTPException(400, "Can't move folder into its own subfolder!")
+
+    # The checks above hold only if neither folder moved since they were read. Both are
+    # checked again under the write lock the version bump takes, so of two moves that
+    # would form a cycle together, the second fails.
+    try:
+        if not claim_folders(session, {folder_id: (old_path, expected_version)}):
+            raise HTTPException(409, "Folder was changed meanwhile, read it again")
+        if moving and new_parent and not check_folder_paths(session, {new_parent.id: new_parent.path}):
+            raise HTTPException(409, "Parent folder was moved meanwhile, read it again")
+
+        # Moving rewrites the paths of the whole subtree
+        if moving:
+            move_folder_paths(session, folder_db, new_parent)
+
+        folder_db.sqlmodel_update(update_data)
+
+        # Commit changes into db
+        session.add(folder_db)
+        session.commit()
+    except OperationalError:
+        # Concurrent moves locking the same rows in opposite order
+        session.rollback()
+        raise HTTPException(409, "Folder is being changed concurrently, try again")
     session.refresh(folder_db)
 
+    listing_cache.invalidate(old_parent_id, folder_db.parent_id)
+    if old_path and folder_db.path != old_path:
+        listing_cache.invalidate_subtree(old_path)
+
     return folder_db
 
 
+@router.get('/folder-ancestors/{folder_id}', response_model=list[FolderPublic])
+def folder_ancestors(folder_id: int, session: ReadSessionDep):
+    """
+    Endpoint for fetching the ancestors of a folder, root first, e.g. for breadcrumbs.
+
+    :param folder_id:
+    :param session:
+    :return list[FolderPublic]:
+    """
+
+    folder_db = session.get(Folder, folder_id)
+    if not folder_db:
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    return get_ancestor_folders(session, folder_db)
+
+
 @router.delete('/folder-delete/{folder_id}')
-async def folder_delete(folder_id: int, session: SessionDep):
+def folder_delete(folder_id: int, session: SessionDep):
     """
     Endpoint for deleting folder
 
@@ -128,15 +210,46 @@ async def folder_delete(folder_id: int, session: SessionDep):
     if not folder_db:
         raise HTTPException(status_code=404, detail="Folder not found")
 
-    # Delete & Commit changes into db
-    session.delete(folder_db)
+    # Delete the whole subtree in one transaction, files are removed in the background
+    parent_id, path = folder_db.parent_id, folder_db.path
+    folders, documents, legacy_files = delete_subtree(session, folder_db)
+    discard_files(session, legacy_files)
     session.commit()
-    return {"ok": True}
+    listing_cache.invalidate(parent_id, folder_id)
+    if path:
+        listing_cache.invalidate_subtree(path)
+    if documents:
+        blob_reaper.wake()
+    return {"ok": True, "folders": folders, "documents": documents}
+
+
+@router.get('/folder-download/{folder_id}')
+def folder_download(folder_id: int, session: ReadSessionDep):
+    """
+    Endpoint for downloading a folder with its whole subtree as a ZIP archive, built
+    while it's sent.
+
+    :param folder_id:
+    :param session:
+    :return StreamingResponse:
+    """
+
+    folder_db = session.get(Folder, folder_id)
+    if not folder_db:
+        raise HTTPException(status_code=404, detail="Folder not found")
+
+    entries = plan_archive(session, folder_db)
+    filename = quote(f"{safe_name(folder_db.name)}.zip")
+    return StreamingResponse(
+        stream_zip(entries),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{filename}"}
+    )
 
 
 @router.post('/file-create', response_model=DocumentPublic)
 @router.post('/file-create/{folder_id}', response_model=DocumentPublic)
-async def file_create(file: Annotated[UploadFile, File()], session: SessionDep, folder_id: int | None = None):
+def file_create(file: Annotated[UploadFile, File()], session: SessionDep, folder_id: int | None = None):
     """
     Endpoint for creating files
 
@@ -146,30 +259,99 @@ async def file_create(file: Annotated[UploadFile, File()], session: SessionDep,
     :return FilePublic:
     """
 
-    # Generate a unique filename to avoid conflicts
-    unique_filename = f"{uuid.uuid4()}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
+    if folder_id and not session.get(Folder, folder_id):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
 
-    # Save the uploaded file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Store the uploaded file under its content digest
+    temp_path, digest, size = store_temp_file(file.file)
 
     # Create file record in the database
     new_file = Document(
         name=file.filename,
-        file_url=file_path,
-        folder_id=folder_id
+        file_url=blob_path(digest),
+        folder_id=folder_id,
+        blob_digest=digest
     )
 
-    session.add(new_file)
-    session.commit()
+    try:
+        acquire_blobs(session, [(digest, size)])
+        session.add(new_file)
+        session.commit()
+    except Exception:
+        session.rollback()
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    listing_cache.invalidate(folder_id)
+    place_blob(temp_path, digest)
     session.refresh(new_file)
 
     return new_file
 
 
+@router.post('/blob-lookup')
+def blob_lookup(lookup: BlobLookup, session: ReadSessionDep):
+    """
+    Endpoint for checking which content digests the server already stores, so clients
+    can skip sending those bytes and link the blobs instead.
+
+    :param lookup:
+        - digests:
+    :param session:
+    :return dict:
+    """
+
+    statement = select(Blob.digest).where(Blob.digest.in_(lookup.digests), Blob.ref_count > 0)
+    return {"existing": session.exec(statement).all()}
+
+
+@router.post('/file-link', response_model=DocumentPublic)
+def file_link(link: DocumentLink, session: SessionDep):
+    """
+    Endpoint for creating a file from content the server already stores, by digest.
+
+    :param link:
+        - name:
+        - digest:
+        - folder_id:
+    :param session:
+    :return DocumentPublic:
+    """
+
+    if link.folder_id and not session.get(Folder, link.folder_id):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+
+    blob = session.get(Blob, link.digest)
+    if not blob or blob.ref_count <= 0:
+        raise HTTPException(404, "Blob not found")
+
+    new_file = Document(name=link.name, file_url=blob.file_url, folder_id=link.folder_id, blob_digest=blob.digest)
+
+    # Take the document's reference before the document exists, once it is committed the
+    # reaper keeps the file. The blob may have been purged since the lookup.
+    acquire_blobs(session, [(blob.digest, blob.size)])
+    session.commit()
+    if not blob_file_exists(link.digest):
+        release_blobs(session, [link.digest])
+        session.commit()
+        raise HTTPException(409, "Blob was removed, upload the content again")
+
+    try:
+        session.add(new_file)
+        session.commit()
+    except Exception:
+        session.rollback()
+        release_blobs(session, [link.digest])
+        session.commit()
+        raise
+    listing_cache.invalidate(link.folder_id)
+
+    session.refresh(new_file)
+    return new_file
+
+
 @router.post('/file-update/{file_id}', response_model=DocumentPublic)
-async def file_update(file_data: DocumentUpdate, session: SessionDep, file_id: int | None = None):
+def file_update(file_data: DocumentUpdate, session: SessionDep, file_id: int | None = None):
     """
     Endpoint for updating parent id of a file / changing its name.
 
@@ -185,18 +367,45 @@ async def file_update(file_data: DocumentUpdate, session: SessionDep, file_id: i
 
     # Dump and serialize updated data
     update_data = file_data.model_dump(exclude_unset=True)
+    if update_data.get("folder_id") and not session.get(Folder, update_data["folder_id"]):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+    old_folder_id = file_db.folder_id
     file_db.sqlmodel_update(update_data)
 
     # Commit changes into db
     session.add(file_db)
     session.commit()
     session.refresh(file_db)
+    listing_cache.invalidate(old_folder_id, file_db.folder_id)
 
     return file_db
 
 
+@router.get('/file/{file_id}/content')
+def file_content(file_id: int, request: Request, session: ReadSessionDep, download: bool = False):
+    """
+    Endpoint for downloading a file's content, supporting Range requests for partial and
+    resumed downloads, and ETag / Last-Modified revalidation.
+
+    :param file_id:
+    :param request:
+    :param session:
+    :param download: send as attachment instead of inline
+    :return FileResponse:
+    """
+
+    file_db = session.get(Document, file_id)
+    if not file_db:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    try:
+        return file_download_response(request.headers, file_db.file_url, file_db.name, file_db.blob_digest, download)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File content not found")
+
+
 @router.delete('/file-delete/{file_id}')
-async def file_delete(file_id: int, session: SessionDep):
+def file_delete(file_id: int, session: SessionDep):
     """
     Endpoint for deleting file
 
@@ -209,50 +418,133 @@ async def file_delete(file_id: int, session: SessionDep):
     if not file_db:
         raise HTTPException(status_code=404, detail="File not found")
 
-    # Delete & Commit changes into db
+    # Delete & Commit changes into db, the reaper drops the blob once nothing points at it
+    digest, file_url, folder_id = file_db.blob_digest, file_db.file_url, file_db.folder_id
+    release_blobs(session, [digest])
+    if not digest:
+        discard_files(session, [file_url])
     session.delete(file_db)
     session.commit()
+    listing_cache.invalidate(folder_id)
+    blob_reaper.wake()
     return {"ok": True}
 
 
-@router.get('/folder-details', response_model=dict[str, list[FolderPublic] | list[DocumentPublic]])
-@router.get('/folder-details/{folder_id}', response_model=dict[str, list[FolderPublic] | list[DocumentPublic]])
-async def folder_details(
-    session: SessionDep,
+@router.get('/folder-details', response_model=FolderListingPublic)
+@router.get('/folder-details/{folder_id}', response_model=FolderListingPublic)
+def folder_details(
+    session: ReadSessionDep,
     folder_id: int | None = None,
-    q: str | None = None
+    q: str | None = None,
+    order_by: Literal["name", "id"] = "name",
+    limit: Annotated[int, Query(ge=1, le=10000)] = 1000,
+    cursor: str | None = None
 ):
     """
-    Fetch folders and documents, with optional filtering by folder_id and search query.
+    Fetch one page of folders and documents, with optional filtering by folder_id and
+    search query. Folders come before documents, pass next_cursor back for the next page.
+    Pages are cached in memory until a write changes the folder or their TTL runs out.
 
     :param session:
     :param folder_id:
     :param q:
-    :return dict:
+    :param order_by:
+    :param limit:
+    :param cursor:
+    :return FolderListingPublic:
     """
     
+    # Hot listings are served from the cache, already serialized
+    key = (folder_id, q, order_by, limit, cursor)
+    cached = listing_cache.get(key)
+    if cached is not None:
+        return Response(cached, media_type="application/json")
+    read_started = listing_cache.begin_read()
+
     # Root folder check
+    path = None
     if folder_id:
         root_folder = session.get(Folder, folder_id)
         if not root_folder:
             raise HTTPException(404, "Folder not found!")
+        path = root_folder.path
 
-    # Base query
-    folder_query = select(Folder)
-    document_query = select(Document)
+    folders, documents, next_cursor = list_folder(session, folder_id, order_by, limit, cursor, q)
+    body = FolderListingPublic.model_validate(
+        {"folders": folders, "documents": documents, "next_cursor": next_cursor}
+    ).model_dump_json().encode()
+    listing_cache.put(key, body, len(folders) + len(documents), read_started, path)
+    return Response(body, media_type="application/json")
 
-    # Filter folders and files
-    folder_query = folder_query.where(Folder.parent_id == folder_id)
-    document_query = document_query.where(Document.folder_id == folder_id)
 
-    if q:  # Apply search filter
-        search_filter = f"%{q}%"
+@router.get('/listing-cache')
+def listing_cache_stats():
+    """
+    Endpoint for the hit and miss counters of the folder listing cache.
+
+    :return dict:
+    """
+
+    return listing_cache.stats()
 
-        folder_query = folder_query.where(Folder.name.ilike(search_filter))
-        document_query = document_query.where(Document.name.ilike(search_filter))
 
-    # Execute queries
-    matching_folders = session.exec(folder_query).all()
-    matching_documents = session.exec(document_query).all()
+@router.get('/folder-tree', response_model=FolderTreePublic)
+@router.get('/folder-tree/{folder_id}', response_model=FolderTreePublic)
+def folder_tree(
+    session: ReadSessionDep,
+    folder_id: int | None = None,
+    depth: Annotated[int | None, Query(ge=1, description="Levels below the folder to include.")] = None,
+    limit: Annotated[int, Query(ge=1, le=10000)] = 1000,
+    offset: Annotated[int, Query(ge=0)] = 0
+):
+    """
+    Fetch the whole subtree of a folder, folders and documents, as an adjacency list built
+    from a single recursive query.
+
+    :param session:
+    :param folder_id:
+    :param depth:
+    :param limit:
+    :param offset:
+    :return FolderTreePublic:
+    """
+
+    # Root folder check
+    if folder_id:
+        root_folder = session.get(Folder, folder_id)
+        if not root_folder:
+            raise HTTPException(404, "Folder not found!")
+
+    folders, documents, next_offset = get_subtree(session, folder_id, depth, limit, offset)
+    return {"folders": folders, "documents": documents, "next_offset": next_offset}
+
+
+@router.get('/search', response_model=SearchPublic)
+@router.get('/search/{folder_id}', response_model=SearchPublic)
+def search(
+    session: ReadSessionDep,
+    q: Annotated[str, Query(min_length=1)],
+    folder_id: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 50,
+    offset: Annotated[int, Query(ge=0)] = 0
+):
+    """
+    Search folder and document names everywhere, or below a folder, most relevant first.
+
+    :param session:
+    :param q:
+    :param folder_id:
+    :param limit:
+    :param offset:
+    :return SearchPublic:
+    """
+
+    # Root folder check
+    folder_db = None
+    if folder_id:
+        folder_db = session.get(Folder, folder_id)
+        if not folder_db:
+            raise HTTPException(404, "Folder not found!")
 
-    return {"folders": matching_folders, "documents": matching_documents}
+    folders, documents, next_offset = search_names(session, q, folder_db, limit, offset)
+    return {"folders": folders, "documents": documents, "next_offset": next_offset}
@@ -0,0 +1,47 @@
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import StreamingResponse
+
+from ..db import ReadSessionDep
+from ..models.public.ingest_job import IngestJobPublic
+from ..internals.ingest_jobs import read_job, job_public, job_event_stream
+
+router = APIRouter(
+    tags=['ingest_jobs']
+)
+
+
+@router.get('/jobs/{job_id}', response_model=IngestJobPublic)
+def job_details(job_id: str, session: ReadSessionDep):
+    """
+    Endpoint for polling a background folder upload, with its latest progress event.
+
+    :param job_id:
+    :param session:
+    :return IngestJobPublic:
+    """
+
+    job = read_job(session, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_public(job)
+
+
+@router.get('/jobs/{job_id}/events')
+async def job_events(
+    job_id: str,
+    session: ReadSessionDep,
+    last_event_id: Annotated[int, Header(ge=0, description="Last event received before reconnecting.")] = 0
+):
+    """
+    Endpoint streaming the progress events of a background folder upload as server-sent
+    events, ending with a "complete" or "failed" event.
+
+    :param job_id:
+    :param session:
+    :param last_event_id:
+    :return StreamingResponse:
+    """
+
+    return StreamingResponse(job_event_stream(session, job_id, last_event_id), media_type="text/event-stream")
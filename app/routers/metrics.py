@@ -0,0 +1,26 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..internals.listing_cache import listing_cache
+from ..internals.metrics import metrics
+
+router = APIRouter(
+    tags=['metrics']
+)
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+def metrics_export():
+    """
+    Endpoint for Prometheus: request, query, upload stage and disk write metrics when
+    METRICS_ENABLED is set, and the listing cache counters always.
+
+    :return PlainTextResponse:
+    """
+
+    stats = listing_cache.stats()
+    gauges = {
+        f"listing_cache_{name}": stats[name]
+        for name in ("hits", "misses", "hit_ratio", "evictions", "invalidations", "entries", "items")
+    }
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
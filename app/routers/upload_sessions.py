@@ -0,0 +1,279 @@
+import json
+from typing import Annotated
+
+import anyio
+from fastapi import APIRouter, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
+from sqlmodel import select
+
+from ..db import SessionDep
+from ..models.database.folder_and_files import Folder
+from ..models.database.upload_session import UploadSessionFile
+from ..models.public.upload_session import UploadSessionCreate, UploadSessionPublic, UploadChunkPublic, \
+    UploadPlanPublic
+from ..internals.concurrency import run_blocking
+from ..internals.blob_reaper import blob_reaper
+from ..internals.folder_and_files import stream_progress, ProgressThrottle, replace_document_contents, STAGES
+from ..internals.upload_plan import plan_upload, find_merge_folders, pin_blobs, unpin_blobs
+from ..internals.upload_sessions import create_upload_session, get_open_upload_session, get_received_ranges, \
+    record_chunk, receive_chunk, session_file_path, is_complete, start_finalizing, reopen_upload_session, \
+    release_upload_session, stored_session_files, remove_upload_session, purge_expired_upload_sessions, SESSION_CHUNK_SIZE, \
+    MAX_SESSION_CHUNK_SIZE
+
+router = APIRouter(
+    tags=['upload_sessions']
+)
+
+
+def session_status(session, upload):
+    """
+    Public view of a session with the received ranges of every file.
+    """
+
+    files = session.exec(
+        select(UploadSessionFile).where(UploadSessionFile.session_id == upload.id).order_by(UploadSessionFile.index)
+    ).all()
+    received = get_received_ranges(session, upload.id)
+
+    file_statuses = []
+    received_size = 0
+    for file in files:
+        ranges = received.get(file.index, [])
+        received_size += sum(end - start for start, end in ranges)
+        file_statuses.append({
+            "index": file.index, "path": file.path, "size": file.size,
+            "received": ranges, "complete": file.action != "upload" or is_complete(ranges, file.size),
+            "action": file.action, "document_id": file.document_id
+        })
+
+    return {
+        "id": upload.id, "folder_id": upload.folder_id, "status": upload.status, "total_size": upload.total_size,
+        "received_size": received_size, "chunk_size": SESSION_CHUNK_SIZE, "expires_at": upload.expires_at,
+        "merge": upload.merge, "files": file_statuses
+    }
+
+
+@router.post('/upload-sessions', response_model=UploadSessionPublic)
+@router.post('/upload-sessions/{folder_id}', response_model=UploadSessionPublic)
+def upload_session_create(manifest: UploadSessionCreate, session: SessionDep, folder_id: int | None = None):
+    """
+    Endpoint for starting a resumable folder upload from the manifest of relative paths
+    and sizes. Chunks of every file are then PUT separately, in any order and in parallel.
+
+    :param manifest:
+    :param session:
+    :param folder_id:
+    :return UploadSessionPublic:
+    """
+
+    if folder_id and not session.get(Folder, folder_id):
+        raise HTTPException(status_code=404, detail="Parent folder not found")
+
+    # Give the disk space of abandoned sessions back
+    purge_expired_upload_sessions(session)
+
+    upload = create_upload_session(session, folder_id, [{"path": file.path, "size": file.size} for file in manifest.files])
+    return session_status(session, upload)
+
+
+@router.post('/upload-plan', response_model=UploadPlanPublic)
+@router.post('/upload-plan/{folder_id}', response_model=UploadPlanPublic)
+def upload_plan(
+    manifest: UploadSessionCreate,
+    session: SessionDep,
+    folder_id: int | None = None,
+    merge: Annotated[bool, Query(description="Reuse existing folders and skip unchanged files.")] = False
+):
+    """
+    Endpoint for planning a folder upload from its manifest before sending any byte. The
+    folder tree and its names are worked out up front, and files whose digest the server
+    already stores need no upload. With `merge`, a re-sync only sends what changed:
+    folders at existing paths are reused, files matching the document at their path are
+    skipped and changed ones replace its content.
+
+    The plan is an upload session, only the files with the "upload" action are sent.
+
+    :param manifest:
+    :param session:
+    :param folder_id:
+    :param merge:
+    :return UploadPlanPublic:
+    """
+
+    purge_expired_upload_sessions(session)
+
+    files, folders, renamed_folders = plan_upload(session, folder_id, manifest.files, merge)
+    upload = create_upload_session(session, folder_id, files, merge)
+
+    uploaded = [file for file in files if file["action"] == "upload"]
+    return {
+        "session": session_status(session, upload),
+        "folders": folders,
+        "renamed_folders": renamed_folders,
+        "upload_files": len(uploaded),
+        "upload_size": sum(file["size"] for file in uploaded),
+        "linked_files": sum(file["action"] == "link" for file in files),
+        "unchanged_files": sum(file["action"] == "skip" for file in files),
+        "replaced_files": sum(file["action"] != "skip" and file["document_id"] is not None for file in files),
+    }
+
+
+@router.get('/upload-sessions/{session_id}', response_model=UploadSessionPublic)
+def upload_session_details(session_id: str, session: SessionDep):
+    """
+    Endpoint for the state of an upload session, the byte ranges received per file tell
+    a resuming client what is left to send.
+
+    :param session_id:
+    :param session:
+    :return UploadSessionPublic:
+    """
+
+    upload = get_open_upload_session(session, session_id)
+    return session_status(session, upload)
+
+
+@router.put('/upload-sessions/{session_id}/files/{index}', response_model=UploadChunkPublic)
+async def upload_session_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    session: SessionDep,
+    offset: Annotated[int, Query(ge=0, description="Position of the chunk in the file.")] = 0
+):
+    """
+    Endpoint for writing a chunk of a file at an offset, the raw request body being the
+    chunk. Chunks may overlap, be sent in any order and be retried.
+
+    :param session_id:
+    :param index: position of the file in the manifest
+    :param request:
+    :param session:
+    :param offset:
+    :return UploadChunkPublic:
+    """
+
+    await run_blocking(get_open_upload_session, session, session_id)
+    file = await run_blocking(session.get, UploadSessionFile, (session_id, index))
+    if not file:
+        raise HTTPException(status_code=404, detail="File not found in upload session")
+    if file.action != "upload":
+        raise HTTPException(status_code=409, detail="The content of this file is stored already")
+    size = file.size
+    if offset > size:
+        raise HTTPException(status_code=416, detail="Offset is past the end of the file")
+
+    max_length = min(size - offset, MAX_SESSION_CHUNK_SIZE)
+    written = await receive_chunk(request, session_file_path(session_id, index), offset, max_length)
+
+    if written:
+        received = await run_blocking(record_chunk, session, session_id, index, offset, offset + written)
+    else:
+        received = (await run_blocking(get_received_ranges, session, session_id, index)).get(index, [])
+
+    return {"index": index, "received": received, "complete": is_complete(received, size)}
+
+
+@router.post('/upload-sessions/{session_id}/finalize')
+async def upload_session_finalize(
+    session_id: str,
+    session: SessionDep,
+    progress_every: Annotated[int | None, Query(ge=1, description="Send a progress event every N files.")] = None,
+    progress_rate: Annotated[float | None, Query(gt=0, description="Send at most N progress events per second.")] = None
+):
+    """
+    Endpoint for materializing a complete upload session into folders and documents, with
+    the same progress stream as a folder upload. The session is removed once the upload
+    is complete, a failed finalize reopens it to be finalized again.
+
+    Files of a plan are linked to their stored blob or replace the content of their
+    document. When a linked blob is gone meanwhile, or an uploaded file doesn't match its
+    declared digest, the session is reopened with those files to be uploaded again.
+
+    :param session_id:
+    :param session:
+    :param progress_every:
+    :param progress_rate:
+    :return StreamingResponse:
+    """
+
+    folder_id, merge, manifest = await run_blocking(start_finalizing, session, session_id)
+    unchanged_count = sum(file["action"] == "skip" for file in manifest)
+    manifest = [file for file in manifest if file["action"] != "skip"]
+
+    # Keep linked blobs from being purged until the documents pointing at them are committed
+    pinned, missing = await run_blocking(
+        pin_blobs, session, [(file["digest"], file["size"]) for file in manifest if file["action"] == "link"]
+    )
+    if missing:
+        await run_blocking(unpin_blobs, session, pinned)
+        indexes = [file["index"] for file in manifest if file["action"] == "link" and file["digest"] in missing]
+        await run_blocking(reopen_upload_session, session, session_id, indexes)
+        raise HTTPException(409, {"message": "Stored content is gone, upload these files", "upload_files": indexes[:100]})
+
+    try:
+        stored_files = await stored_session_files(session_id, manifest)
+    except FileNotFoundError:
+        await run_blocking(unpin_blobs, session, pinned)
+        await run_blocking(remove_upload_session, session, session_id)
+        raise HTTPException(status_code=410, detail="Upload session data is gone, start a new session")
+
+    mismatched = [
+        file["index"] for file, stored in zip(manifest, stored_files)
+        if file["action"] == "upload" and file["digest"] and file["digest"] != stored.digest
+    ]
+    if mismatched:
+        await run_blocking(unpin_blobs, session, pinned)
+        await run_blocking(reopen_upload_session, session, session_id, mismatched)
+        raise HTTPException(409, {"message": "Content doesn't match the declared digest", "upload_files": mismatched[:100]})
+
+    replacements = [(file["document_id"], stored) for file, stored in zip(manifest, stored_files) if file["document_id"]]
+    new_files = [(file["path"], stored) for file, stored in zip(manifest, stored_files) if not file["document_id"]]
+
+    async def finalize():
+        complete = False
+        try:
+            if replacements or unchanged_count:
+                try:
+                    replaced_count, gone = await run_blocking(replace_document_contents, session, replacements)
+                except Exception as e:
+                    await run_blocking(session.rollback)
+                    yield json.dumps({"stage": STAGES['ERROR'], "message": str(e)}) + "\n"
+                    return
+                blob_reaper.wake()
+
+                # Documents deleted since the plan are created again
+                gone = set(gone)
+                new_files.extend(
+                    (file["path"], stored) for file, stored in zip(manifest, stored_files) if file["document_id"] in gone
+                )
+                yield json.dumps({
+                    "stage": STAGES['RELATION_UPDATE'],
+                    "message": "Replaced changed documents",
+                    "replaced_count": replaced_count,
+                    "unchanged_count": unchanged_count + len(replacements) - replaced_count - len(gone)
+                }) + "\n"
+
+            paths = [path for path, _ in new_files]
+            existing_folders = None
+            if merge:
+                try:
+                    existing_folders = await run_blocking(find_merge_folders, session, folder_id, paths)
+                except HTTPException:
+                    pass  # stream_progress reports the missing parent folder
+            async for event in stream_progress(
+                paths, [stored for _, stored in new_files], session, folder_id,
+                progress=ProgressThrottle(progress_every, progress_rate), existing_folders=existing_folders
+            ):
+                complete = json.loads(event)["stage"] == STAGES['COMPLETE']
+                yield event
+        finally:
+            # Also when the client went away and the stream is cancelled
+            with anyio.CancelScope(shield=True):
+                await run_blocking(unpin_blobs, session, pinned)
+                if complete:
+                    await run_blocking(remove_upload_session, session, session_id)
+                else:
+                    await run_blocking(release_upload_session, session, session_id, manifest)
+
+    return StreamingResponse(finalize(), media_type="text/event-stream")
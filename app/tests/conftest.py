@@ -0,0 +1,74 @@
+"""
+Database backend of the test suite, picked with the TEST_BACKEND environment variable.
+
+    pytest                          # SQLite, database.db in the working directory
+    TEST_BACKEND=postgres pytest    # TEST_POSTGRES_URL, or an embedded server (pip install pgserver)
+
+The Postgres database is emptied before the run. Without TEST_POSTGRES_URL and pgserver
+the Postgres run is skipped.
+"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+TEST_BACKEND = os.environ.get("TEST_BACKEND", "sqlite")
+
+_postgres_unavailable = None
+
+
+def embedded_postgres_url(config):
+    """
+    Start a throwaway Postgres server with pgserver, if it's installed.
+
+    :param config:
+    :return str | None:
+    """
+
+    try:
+        import pgserver
+    except ImportError:
+        return None
+
+    data_dir = tempfile.mkdtemp(prefix="headache-pg-")
+    config._embedded_postgres = pgserver.get_server(data_dir, cleanup_mode="delete")
+    return config._embedded_postgres.get_uri().replace("postgresql://", "postgresql+psycopg://", 1)
+
+
+def pytest_configure(config):
+    global _postgres_unavailable
+
+    if TEST_BACKEND != "postgres":
+        return
+
+    url = os.environ.get("TEST_POSTGRES_URL") or embedded_postgres_url(config)
+    if url is None:
+        _postgres_unavailable = "Set TEST_POSTGRES_URL or install pgserver to run against Postgres"
+        return
+
+    # Read by app.db when the tests import the app
+    os.environ["DATABASE_URL"] = url
+
+
+def pytest_collection_modifyitems(config, items):
+    if _postgres_unavailable:
+        skip = pytest.mark.skip(reason=_postgres_unavailable)
+        for item in items:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    """Create the tables once per run, starting from an empty database on Postgres"""
+    if _postgres_unavailable:
+        yield
+        return
+
+    from sqlmodel import SQLModel
+    from app.db import engine, create_db_and_tables
+
+    if engine.dialect.name == "postgresql":
+        SQLModel.metadata.drop_all(engine)
+    asyncio.run(create_db_and_tables())
+    yield
@@ -1,15 +1,40 @@
+import asyncio
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
+import zipfile
+from datetime import timedelta
 
 # Add the parent directory to PYTHONPATH
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from fastapi import UploadFile
 from io import BytesIO
 
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from sqlmodel import Session, select
+
 from app.main import app
+from app.db import engine, read_engine, create_engines, get_session
+from app.models.database.folder_and_files import Folder, Document, Blob, DiscardedFile
+from app.models.database.upload_session import UploadSession
+from app.models.database.ingest_job import IngestJob
+from app.internals.folder_and_files import get_unique_folder_name, ProgressThrottle, create_folder_level
+from app.internals.file_writer import StoredFile, ParallelFileWriter
+from app.internals.listing import list_folder
+from app.internals.hierarchy import backfill_folder_paths, claim_folders, check_folder_paths
+from app.internals.blob_reaper import blob_reaper
+from app.internals.blob_store import store_temp_file, TMP_DIR
+from app.internals.ingest_jobs import create_ingest_job, update_job, claim_job, run_ingest_job, JobProgress
+from app.internals.upload_sessions import purge_expired_upload_sessions, utcnow, UPLOAD_SESSION_TTL
+from app.internals.metrics import metrics
 
 client = TestClient(app)
 
@@ -162,6 +187,20 @@ def test_empty_folder_upload():
     assert response.status_code == 422  # Validation error
 
 
+def test_folder_upload_rejects_path_count_mismatch():
+    """Test files without a path are rejected and not left on disk"""
+    tmp_dir = os.path.join("uploads", "tmp")
+    before = set(os.listdir(tmp_dir)) if os.path.isdir(tmp_dir) else set()
+    files = [
+        ("files", ("one.txt", BytesIO(b"one"), "text/plain")),
+        ("files", ("two.txt", BytesIO(b"two"), "text/plain")),
+    ]
+    response = client.post("/folder-upload", files=files, data={"paths": ["a/one.txt"]})
+    assert response.status_code == 422
+    after = set(os.listdir(tmp_dir)) if os.path.isdir(tmp_dir) else set()
+    assert after <= before
+
+
 def test_folder_circular_reference(sample_folder):
     """Test preventing circular folder references"""
     update_data = {"parent_id": sample_folder}
@@ -169,3 +208,890 @@ def test_folder_circular_reference(sample_folder):
     assert response.status_code == 400  # Bad request
 
 
+
+
+def test_folder_upload_streams_files_to_disk():
+    """Test uploaded files are written to disk with their full content"""
+    large_content = os.urandom(3 * 1024 * 1024 + 17)  # spans several write chunks
+    files = [
+        ("files", ("big.bin", BytesIO(large_content), "application/octet-stream")),
+        ("files", ("empty.txt", BytesIO(b""), "text/plain"))
+    ]
+    data = {"paths": ["streamed/big.bin", "streamed/empty.txt"]}
+    response = client.post("/folder-upload", files=files, data=data)
+    assert response.status_code == 200
+
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1]["stage"] == "upload_complete"
+
+    folder = client.get("/folder-details", params={"q": "streamed"}).json()["folders"][-1]
+    documents = client.get(f"/folder-details/{folder['id']}").json()["documents"]
+    stored = {document["name"]: document["file_url"] for document in documents}
+    with open(stored["big.bin"], "rb") as f:
+        assert f.read() == large_content
+    assert os.path.getsize(stored["empty.txt"]) == 0
+
+
+def test_folder_upload_builds_nested_tree():
+    """Test a bulk folder upload creates every folder level and links documents to them"""
+    paths = ["tree/a/one.txt", "tree/a/b/two.txt", "tree/c/three.txt", "tree/root.txt"]
+    files = [("files", (os.path.basename(path), BytesIO(path.encode()), "text/plain")) for path in paths]
+    response = client.post("/folder-upload", files=files, data={"paths": paths})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1]["stage"] == "upload_complete"
+    assert events[-1]["total_folders"] == 4
+
+    tree = client.get("/folder-details", params={"q": "tree"}).json()["folders"][-1]
+    tree_details = client.get(f"/folder-details/{tree['id']}").json()
+    assert [document["name"] for document in tree_details["documents"]] == ["root.txt"]
+    subfolders = {folder["name"]: folder["id"] for folder in tree_details["folders"]}
+    assert set(subfolders) == {"a", "c"}
+
+    a_details = client.get(f"/folder-details/{subfolders['a']}").json()
+    assert [document["name"] for document in a_details["documents"]] == ["one.txt"]
+    assert [folder["name"] for folder in a_details["folders"]] == ["b"]
+
+
+def test_unique_folder_name_uses_single_query():
+    """Test resolving a name with hundreds of collisions costs one query"""
+    parent = client.post("/folder-create", json={"name": "Collisions"}).json()["id"]
+    with Session(engine) as session:
+        session.add_all([Folder(name="photos", parent_id=parent)] +
+                        [Folder(name=f"photos ({i})", parent_id=parent) for i in range(1, 300)])
+        session.commit()
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            name, was_renamed = asyncio.run(get_unique_folder_name(session, "photos", parent))
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+
+    assert (name, was_renamed) == ("photos (300)", True)
+    assert len([statement for statement in statements if not statement.startswith("BEGIN")]) == 1
+
+
+def test_folder_upload_resolves_colliding_names(sample_folder):
+    """Test uploaded folders never collide with existing or freshly created siblings"""
+    client.post(f"/folder-create/{sample_folder}", json={"name": "photos"})
+    paths = ["photos/a.txt", "photos (1)/b.txt"]
+    files = [("files", (os.path.basename(path), BytesIO(b"x"), "text/plain")) for path in paths]
+    response = client.post(f"/folder-upload/{sample_folder}", files=files, data={"paths": paths})
+    assert json.loads(response.text.splitlines()[-1])["stage"] == "upload_complete"
+
+    names = [folder["name"] for folder in client.get(f"/folder-details/{sample_folder}").json()["folders"]]
+    assert sorted(names) == ["photos", "photos (1)", "photos (1) (1)"]
+
+
+def test_folder_upload_coalesces_progress_events():
+    """Test per-file progress events are sent every N files plus the last one"""
+    paths = [f"progress/file{i}.txt" for i in range(10)]
+    files = [("files", (os.path.basename(path), BytesIO(b"x"), "text/plain")) for path in paths]
+    response = client.post("/folder-upload", files=files, data={"paths": paths}, params={"progress_every": 4})
+    events = [json.loads(line) for line in response.text.splitlines()]
+
+    counts = [event["created_count"] for event in events if "created_count" in event]
+    assert counts == [1, 5, 9, 10]
+    assert events[-1]["stage"] == "upload_complete"
+
+
+def test_progress_throttle_rate_limit():
+    """Test the time based policy only lets the first and last events through in a burst"""
+    throttle = ProgressThrottle(max_per_second=1)
+    emitted = [count for count in range(1, 1001) if throttle.should_emit(count, 1000)]
+    assert emitted == [1, 1000]
+
+
+def test_parallel_writer_keeps_chunk_order_and_isolates_failures(tmp_path):
+    """Test chunks written by several writers reassemble in order and a failing file doesn't stop the rest"""
+    chunks = [os.urandom(1000 + i) for i in range(50)]
+    good = StoredFile(filename="good.bin", file_path=str(tmp_path / "good.bin"))
+    bad = StoredFile(filename="bad.bin", file_path=str(tmp_path / "missing-dir" / "bad.bin"))
+
+    async def write_files():
+        async with ParallelFileWriter(workers=4, max_buffered=2) as writer:
+            for file in (bad, good):
+                handle = await writer.open(file)
+                for chunk in chunks:
+                    await writer.write(handle, chunk)
+                await writer.end(handle)
+
+    asyncio.run(write_files())
+    assert bad.error and not os.path.exists(bad.file_path)
+    assert good.error is None and good.size == sum(map(len, chunks))
+    with open(good.file_path, "rb") as f:
+        assert f.read() == b"".join(chunks)
+
+
+def test_identical_content_is_stored_once():
+    """Test files with the same content share one blob that lives until the last reference is gone"""
+    content = os.urandom(2048)
+    first = client.post("/file-create", files={"file": ("a.bin", BytesIO(content), "application/octet-stream")}).json()
+    second = client.post("/file-create", files={"file": ("b.bin", BytesIO(content), "application/octet-stream")}).json()
+
+    assert first["blob_digest"] == second["blob_digest"] == hashlib.sha256(content).hexdigest()
+    assert first["file_url"] == second["file_url"]
+
+    client.delete(f"/file-delete/{first['id']}")
+    blob_reaper.reap()
+    assert os.path.exists(second["file_url"])
+    client.delete(f"/file-delete/{second['id']}")
+    assert os.path.exists(second["file_url"])  # left to the reaper
+    blob_reaper.reap()
+    assert not os.path.exists(second["file_url"])
+
+
+def test_known_content_can_be_linked_without_upload():
+    """Test clients can look up digests and create files from stored blobs"""
+    content = os.urandom(2048)
+    digest = hashlib.sha256(content).hexdigest()
+    unknown = hashlib.sha256(b"never uploaded").hexdigest()
+    client.post("/file-create", files={"file": ("stored.bin", BytesIO(content), "application/octet-stream")})
+
+    response = client.post("/blob-lookup", json={"digests": [digest, unknown]})
+    assert response.json()["existing"] == [digest]
+
+    response = client.post("/file-link", json={"name": "linked.bin", "digest": digest})
+    assert response.status_code == 200
+    assert response.json()["blob_digest"] == digest
+
+    response = client.post("/file-link", json={"name": "missing.bin", "digest": unknown})
+    assert response.status_code == 404
+
+
+def test_link_to_purged_blob_is_never_visible(monkeypatch):
+    """Test a link whose blob file is gone is refused before its document is committed"""
+    content = os.urandom(1024)
+    digest = hashlib.sha256(content).hexdigest()
+    client.post("/file-create", files={"file": ("purged.bin", BytesIO(content), "application/octet-stream")})
+
+    visible = []
+
+    def purged(checked_digest):
+        with Session(engine) as session:
+            visible.append(session.exec(select(Document).where(Document.name == "dangling.bin")).first())
+        return False
+
+    monkeypatch.setattr("app.routers.folder_and_files.blob_file_exists", purged)
+    response = client.post("/file-link", json={"name": "dangling.bin", "digest": digest})
+    assert response.status_code == 409
+    assert visible == [None]
+    with Session(engine) as session:
+        assert session.get(Blob, digest).ref_count == 1
+
+
+def test_files_need_an_existing_folder(monkeypatch):
+    """Test files can't be created in missing folders, and failed inserts leave no temp file"""
+    content = os.urandom(1024)
+    digest = hashlib.sha256(content).hexdigest()
+    response = client.post(f"/file-create/{10 ** 9}", files={"file": ("lost.bin", BytesIO(content))})
+    assert response.status_code == 404
+    response = client.post("/file-link", json={"name": "lost.bin", "digest": digest, "folder_id": 10 ** 9})
+    assert response.status_code == 404
+
+    def failing_acquire(*args, **kwargs):
+        raise RuntimeError("insert failed")
+
+    tmp_dir = os.path.join("uploads", "tmp")
+    before = set(os.listdir(tmp_dir)) if os.path.isdir(tmp_dir) else set()
+    monkeypatch.setattr("app.routers.folder_and_files.acquire_blobs", failing_acquire)
+    with pytest.raises(RuntimeError):
+        client.post("/file-create", files={"file": ("failed.bin", BytesIO(content))})
+    assert set(os.listdir(tmp_dir)) <= before
+
+
+def upload_tree(paths: list[str], folder_id: int | None = None):
+    """Upload files with the given relative paths into a folder"""
+    files = [("files", (os.path.basename(path), BytesIO(path.encode()), "text/plain")) for path in paths]
+    url = f"/folder-upload/{folder_id}" if folder_id else "/folder-upload"
+    response = client.post(url, files=files, data={"paths": paths})
+    assert json.loads(response.text.splitlines()[-1])["stage"] == "upload_complete"
+
+
+def slow_create_folder_level(*args, **kwargs):
+    """create_folder_level taking long enough for a client to give up"""
+    time.sleep(0.5)
+    return create_folder_level(*args, **kwargs)
+
+
+def post_and_disconnect(url: str, **kwargs):
+    """Send a POST straight to the app and disconnect shortly after the body, return the messages sent back"""
+    request = httpx.Request("POST", f"http://test{url}", **kwargs)
+    body = request.read()
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "POST", "scheme": "http", "server": ("test", 80),
+        "path": url, "raw_path": url.encode(), "query_string": b"", "root_path": "", "client": ("test", 1234),
+        "headers": [(key.lower().encode(), value.encode()) for key, value in request.headers.items()],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    assert any(message.get("body") for message in sent)  # the stream had started
+    assert not any(message.get("more_body") is False for message in sent if message["type"] == "http.response.body")
+    return sent
+
+
+def test_folder_upload_disconnect_discards_files(sample_folder, monkeypatch):
+    """Test a client disconnecting while the progress streams leaves no files or rows behind"""
+    monkeypatch.setattr("app.internals.folder_and_files.create_folder_level", slow_create_folder_level)
+
+    paths = ["vanished/one.txt", "vanished/two.txt"]
+    temp_files = set(os.listdir(TMP_DIR))
+    post_and_disconnect(f"/folder-upload/{sample_folder}", data={"paths": paths},
+                        files=[("files", (os.path.basename(path), BytesIO(b"gone"), "text/plain")) for path in paths])
+
+    assert set(os.listdir(TMP_DIR)) <= temp_files
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    assert tree["folders"] == [] and tree["documents"] == []
+
+
+def test_folder_tree(sample_folder):
+    """Test fetching a whole subtree, with depth limit and pagination"""
+    upload_tree(["a/one.txt", "a/b/two.txt", "a/b/c/three.txt", "top.txt"], sample_folder)
+
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    assert sorted(folder["name"] for folder in tree["folders"]) == ["a", "b", "c"]
+    assert sorted(document["name"] for document in tree["documents"]) == ["one.txt", "three.txt", "top.txt", "two.txt"]
+    assert tree["next_offset"] is None
+
+    shallow = client.get(f"/folder-tree/{sample_folder}", params={"depth": 2}).json()
+    assert sorted(folder["name"] for folder in shallow["folders"]) == ["a", "b"]
+    assert sorted(document["name"] for document in shallow["documents"]) == ["one.txt", "top.txt"]
+
+    first_page = client.get(f"/folder-tree/{sample_folder}", params={"limit": 4}).json()
+    second_page = client.get(f"/folder-tree/{sample_folder}", params={"limit": 4, "offset": first_page["next_offset"]}).json()
+    assert len(first_page["folders"] + first_page["documents"]) == 4
+    assert len(second_page["folders"] + second_page["documents"]) == 3
+
+
+def test_folder_paths_follow_moves(sample_folder):
+    """Test materialized paths are kept for created, uploaded and moved folders"""
+    upload_tree(["x/y/z/file.txt"], sample_folder)
+    other = client.post("/folder-create", json={"name": "Other"}).json()["id"]
+    x = next(folder for folder in client.get(f"/folder-details/{sample_folder}").json()["folders"] if folder["name"] == "x")
+    z = next(folder for folder in client.get(f"/folder-tree/{x['id']}").json()["folders"] if folder["name"] == "z")
+
+    ancestors = client.get(f"/folder-ancestors/{z['id']}").json()
+    assert [folder["name"] for folder in ancestors] == ["Test Folder", "x", "y"]
+
+    response = client.patch(f"/folder-update/{x['id']}", json={"parent_id": z["id"]})
+    assert response.status_code == 400  # into its own subfolder
+
+    client.patch(f"/folder-update/{x['id']}", json={"parent_id": other})
+    ancestors = client.get(f"/folder-ancestors/{z['id']}").json()
+    assert [folder["name"] for folder in ancestors] == ["Other", "x", "y"]
+    with Session(engine) as session:
+        assert session.get(Folder, z["id"]).path == f"/{other}/{x['id']}/{ancestors[-1]['id']}/{z['id']}/"
+
+
+def test_legacy_files_are_queued_durably(sample_folder):
+    """Test files of documents without a blob stay queued until a sweep removes them"""
+    legacy_path = os.path.join("uploads", "legacy-file.txt")
+    with open(legacy_path, "wb") as file:
+        file.write(b"stored before blobs")
+    with Session(engine) as session:
+        document = Document(name="legacy-file.txt", file_url=legacy_path, folder_id=sample_folder)
+        session.add(document)
+        session.commit()
+        document_id = document.id
+
+    # The reaper doesn't run here, like a process stopping right after the delete
+    assert client.delete(f"/file-delete/{document_id}").status_code == 200
+    with Session(engine) as session:
+        assert session.exec(select(DiscardedFile).where(DiscardedFile.path == legacy_path)).first()
+    assert os.path.exists(legacy_path)
+
+    blob_reaper.reap()
+    assert not os.path.exists(legacy_path)
+    with Session(engine) as session:
+        assert session.exec(select(DiscardedFile).where(DiscardedFile.path == legacy_path)).first() is None
+
+
+def test_backfill_folder_paths():
+    """Test folders without paths get them from the hierarchy"""
+    with Session(engine) as session:
+        parent = Folder(name="legacy")
+        session.add(parent)
+        session.flush()
+        child = Folder(name="legacy child", parent_id=parent.id)
+        session.add(child)
+        session.commit()
+
+        backfill_folder_paths(session)
+        session.refresh(child)
+        assert child.path == f"/{parent.id}/{child.id}/"
+
+
+def test_delete_folder_removes_subtree(sample_folder):
+    """Test deleting a folder removes its subfolders and documents, and the reaper their blobs"""
+    upload_tree(["gone/one.txt", "gone/sub/two.txt", "gone.txt"], sample_folder)
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    kept = client.post("/file-create", files={"file": ("kept.txt", BytesIO(b"gone/one.txt"), "text/plain")}).json()
+
+    response = client.delete(f"/folder-delete/{sample_folder}")
+    assert response.json() == {"ok": True, "folders": 3, "documents": 3}
+    assert client.get(f"/folder-tree/{sample_folder}").status_code == 404
+    with Session(engine) as session:
+        assert all(session.get(Document, document["id"]) is None for document in tree["documents"])
+        assert all(session.get(Folder, folder["id"]) is None for folder in tree["folders"])
+
+    blob_reaper.reap()
+    files = {document["name"]: document["file_url"] for document in tree["documents"]}
+    assert not os.path.exists(files["two.txt"])
+    assert os.path.exists(files["one.txt"])  # still referenced by kept.txt
+    assert os.path.exists(kept["file_url"])
+
+
+def test_search_names(sample_folder):
+    """Test name search follows renames, moves and deletes, globally and within a subtree"""
+    upload_tree(["Quarterly/report-q1.pdf", "Quarterly/drafts/report-q2.pdf", "notes.txt"], sample_folder)
+    other = client.post("/folder-create", json={"name": "Quarterly archive"}).json()["id"]
+
+    results = client.get("/search", params={"q": "QUARTERLY"}).json()
+    assert {folder["name"] for folder in results["folders"]} >= {"Quarterly", "Quarterly archive"}
+
+    scoped = client.get(f"/search/{sample_folder}", params={"q": "report-q"}).json()
+    assert sorted(document["name"] for document in scoped["documents"]) == ["report-q1.pdf", "report-q2.pdf"]
+    assert scoped["folders"] == []
+
+    first_page = client.get(f"/search/{sample_folder}", params={"q": "report-q", "limit": 1}).json()
+    assert len(first_page["documents"]) == 1 and first_page["next_offset"] == 1
+
+    # Renamed, moved out of the subtree and deleted documents follow along
+    report = next(document for document in scoped["documents"] if document["name"] == "report-q1.pdf")
+    drafts = next(document for document in scoped["documents"] if document["name"] == "report-q2.pdf")
+    client.post(f"/file-update/{report['id']}", json={"name": "summary.pdf"})
+    client.delete(f"/file-delete/{drafts['id']}")
+    assert client.get(f"/search/{sample_folder}", params={"q": "report-q"}).json()["documents"] == []
+    assert [document["name"] for document in client.get(f"/search/{sample_folder}", params={"q": "summary"}).json()["documents"]] == ["summary.pdf"]
+
+    quarterly = client.get(f"/search/{sample_folder}", params={"q": "Quarterly"}).json()["folders"][0]
+    client.patch(f"/folder-update/{quarterly['id']}", json={"parent_id": other})
+    assert client.get(f"/search/{sample_folder}", params={"q": "summary"}).json()["documents"] == []
+    assert len(client.get(f"/search/{other}", params={"q": "summary"}).json()["documents"]) == 1
+
+
+def test_folder_details_keyset_pagination(sample_folder):
+    """Test paging through a listing with cursors, across the folder/document boundary"""
+    upload_tree(["d/x.txt", "b/x.txt", "c.txt", "a.txt", "e.txt"], sample_folder)
+
+    for order_by, expected in [("name", ["b", "d", "a.txt", "c.txt", "e.txt"]), ("id", ["d", "b", "c.txt", "a.txt", "e.txt"])]:
+        names, cursor = [], None
+        while True:
+            params = {"limit": 2, "order_by": order_by, **({"cursor": cursor} if cursor else {})}
+            page = client.get(f"/folder-details/{sample_folder}", params=params).json()
+            assert len(page["folders"] + page["documents"]) <= 2
+            names += [item["name"] for item in page["folders"] + page["documents"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert names == expected
+
+    response = client.get(f"/folder-details/{sample_folder}", params={"cursor": "not a cursor"})
+    assert response.status_code == 400
+
+
+@pytest.mark.skipif(engine.dialect.name != "postgresql", reason="Checks Postgres query plans")
+def test_name_pages_are_index_scans(sample_folder):
+    """Test name ordered pages are read in index order on Postgres, without sorting the folder"""
+    upload_tree(["b/x.txt", "a/x.txt", "b.txt", "a.txt"], sample_folder)
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(read_engine, "before_cursor_execute", capture)
+    try:
+        with Session(read_engine) as session:
+            _, _, cursor = list_folder(session, sample_folder, limit=1)
+            _, _, cursor = list_folder(session, sample_folder, limit=2, cursor=cursor)
+            list_folder(session, sample_folder, limit=1, cursor=cursor)
+    finally:
+        event.remove(read_engine, "before_cursor_execute", capture)
+
+    with read_engine.connect() as connection:
+        # Costs are meaningless on a tiny table, only ask whether the order can come from an index
+        connection.exec_driver_sql("SET enable_sort = off")
+        connection.exec_driver_sql("SET enable_seqscan = off")
+        plans = [
+            "\n".join(row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters))
+            for statement, parameters in statements
+        ]
+    assert len(plans) >= 3
+    for plan in plans:
+        assert "Sort" not in plan and "_name_nulls_first" in plan, plan
+
+
+def test_production_sqlite_profile(tmp_path):
+    """Test the production profile runs WAL with a separate read-only pool"""
+    writer, reader = create_engines(f"sqlite:///{tmp_path / 'profile.db'}", "production")
+
+    with writer.begin() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        connection.exec_driver_sql("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+
+    with reader.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA query_only").scalar() == 1
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql("INSERT INTO item DEFAULT VALUES")
+
+    with pytest.raises(ValueError):
+        create_engines(f"sqlite:///{tmp_path / 'profile.db'}", "unknown")
+
+
+def test_file_content_download(sample_file):
+    """Test downloading file content with ranges and conditional requests"""
+    response = client.get(f"/file/{sample_file}/content")
+    assert response.status_code == 200
+    assert response.content == test_file_content
+    assert response.headers["etag"] == f'"{hashlib.sha256(test_file_content).hexdigest()}"'
+    assert response.headers["accept-ranges"] == "bytes"
+
+    partial = client.get(f"/file/{sample_file}/content", headers={"Range": "bytes=7-10"})
+    assert partial.status_code == 206
+    assert partial.content == test_file_content[7:11]
+    assert partial.headers["content-range"] == f"bytes 7-10/{len(test_file_content)}"
+
+    cached = client.get(f"/file/{sample_file}/content", headers={"If-None-Match": response.headers["etag"]})
+    assert cached.status_code == 304
+    cached = client.get(f"/file/{sample_file}/content", headers={"If-Modified-Since": response.headers["last-modified"]})
+    assert cached.status_code == 304
+
+    download = client.get(f"/file/{sample_file}/content", params={"download": True})
+    assert download.headers["content-disposition"] == 'attachment; filename="test.txt"'
+    assert client.get("/file/99999/content").status_code == 404
+
+
+def test_inline_content_is_sandboxed():
+    """Test uploaded HTML is neither sniffed nor run with the app's origin when shown inline"""
+    files = {"file": ("page.html", BytesIO(b"<script>alert(1)</script>"), "text/html")}
+    file_id = client.post("/file-create", files=files).json()["id"]
+
+    response = client.get(f"/file/{file_id}/content")
+    assert response.status_code == 200
+    assert response.headers["content-disposition"].startswith("inline")
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert response.headers["content-security-policy"] == "sandbox"
+
+
+def test_folder_download_zip(sample_folder):
+    """Test downloading a folder rebuilds its hierarchy in a ZIP archive"""
+    upload_tree(["photos/beach.jpg", "photos/notes.txt", "photos/2024/trip.txt"], sample_folder)
+    client.post(f"/folder-create/{sample_folder}", json={"name": "empty"})
+
+    response = client.get(f"/folder-download/{sample_folder}")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+
+    with zipfile.ZipFile(BytesIO(response.content)) as archive:
+        assert archive.testzip() is None
+        names = set(archive.namelist())
+        assert {"Test Folder/", "Test Folder/empty/", "Test Folder/photos/2024/"} <= names
+        assert archive.read("Test Folder/photos/2024/trip.txt") == b"photos/2024/trip.txt"
+        assert archive.getinfo("Test Folder/photos/beach.jpg").compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("Test Folder/photos/notes.txt").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_resumable_upload_session(sample_folder):
+    """Test uploading a folder in out of order chunks through an upload session"""
+    big = os.urandom(300_000)
+    manifest = {"files": [{"path": "resumed/big.bin", "size": len(big)}, {"path": "resumed/sub/empty.txt", "size": 0}]}
+    upload = client.post(f"/upload-sessions/{sample_folder}", json=manifest).json()
+    assert [file["complete"] for file in upload["files"]] == [False, True]
+
+    url = f"/upload-sessions/{upload['id']}/files/0"
+    client.put(url, params={"offset": 200_000}, content=big[200_000:])
+    assert client.post(f"/upload-sessions/{upload['id']}/finalize").status_code == 409  # incomplete
+    client.put(url, params={"offset": 0}, content=big[:120_000])
+    assert client.put(url, params={"offset": 250_000}, content=big[250_000:] + b"extra").status_code == 413
+
+    status = client.get(f"/upload-sessions/{upload['id']}").json()
+    assert status["files"][0]["received"] == [[0, 120_000], [200_000, 300_000]]
+    chunk = client.put(url, params={"offset": 100_000}, content=big[100_000:200_000]).json()
+    assert chunk == {"index": 0, "received": [[0, 300_000]], "complete": True}
+
+    response = client.post(f"/upload-sessions/{upload['id']}/finalize")
+    assert json.loads(response.text.splitlines()[-1])["stage"] == "upload_complete"
+    assert client.get(f"/upload-sessions/{upload['id']}").status_code == 404
+
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    big_document = next(document for document in tree["documents"] if document["name"] == "big.bin")
+    assert client.get(f"/file/{big_document['id']}/content").content == big
+    assert {folder["name"] for folder in tree["folders"]} >= {"resumed", "sub"}
+
+
+def test_deleted_folder_with_upload_session(sample_folder):
+    """Test a folder with an upload session into it can be deleted and finalizing reports it"""
+    target = client.post(f"/folder-create/{sample_folder}", json={"name": "session target"}).json()["id"]
+    upload = client.post(f"/upload-sessions/{target}", json={"files": [{"path": "late/file.txt", "size": 4}]}).json()
+    client.put(f"/upload-sessions/{upload['id']}/files/0", content=b"late")
+
+    assert client.delete(f"/folder-delete/{sample_folder}").status_code == 200
+    response = client.post(f"/upload-sessions/{upload['id']}/finalize")
+    last_event = json.loads(response.text.splitlines()[-1])
+    assert last_event == {"stage": "error", "message": "Parent folder not found"}
+
+
+def test_failed_finalize_keeps_upload_session(sample_folder, monkeypatch):
+    """Test a failed finalize reopens the session for a retry and expired finalizing sessions are purged"""
+    upload = client.post(f"/upload-sessions/{sample_folder}", json={"files": [{"path": "retry/file.txt", "size": 5}]}).json()
+    client.put(f"/upload-sessions/{upload['id']}/files/0", content=b"retry")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr("app.internals.folder_and_files.insert_documents", fail)
+    response = client.post(f"/upload-sessions/{upload['id']}/finalize")
+    assert json.loads(response.text.splitlines()[-1]) == {"stage": "error", "message": "disk full"}
+    monkeypatch.undo()
+
+    # The failed run discarded the file, it is uploaded again
+    status = client.get(f"/upload-sessions/{upload['id']}").json()
+    assert status["status"] == "open" and not status["files"][0]["complete"]
+    client.put(f"/upload-sessions/{upload['id']}/files/0", content=b"retry")
+    response = client.post(f"/upload-sessions/{upload['id']}/finalize")
+    assert json.loads(response.text.splitlines()[-1])["stage"] == "upload_complete"
+    assert client.get(f"/upload-sessions/{upload['id']}").status_code == 404
+
+    # A finalize may still run on a session that just expired, only long stuck ones go
+    stuck = client.post(f"/upload-sessions/{sample_folder}", json={"files": [{"path": "stuck.txt", "size": 1}]}).json()
+    with Session(engine) as session:
+        upload_session = session.get(UploadSession, stuck["id"])
+        upload_session.status, upload_session.expires_at = "finalizing", utcnow() - timedelta(seconds=1)
+        session.commit()
+        purge_expired_upload_sessions(session)
+        assert session.get(UploadSession, stuck["id"]) is not None
+
+        upload_session = session.get(UploadSession, stuck["id"])
+        upload_session.expires_at = utcnow() - timedelta(seconds=UPLOAD_SESSION_TTL + 1)
+        session.commit()
+        purge_expired_upload_sessions(session)
+        assert session.get(UploadSession, stuck["id"]) is None
+
+
+def test_finalize_disconnect_reopens_upload_session(sample_folder, monkeypatch):
+    """Test a client disconnecting during finalize gets its session back, with no blob left pinned"""
+    content = os.urandom(100)
+    digest = hashlib.sha256(content).hexdigest()
+    client.post("/file-create", files={"file": ("pinned.bin", BytesIO(content), "application/octet-stream")})
+    files = [{"path": "dropped/linked.bin", "size": 100, "digest": digest}, {"path": "dropped/new.txt", "size": 3}]
+    plan = client.post(f"/upload-plan/{sample_folder}", json={"files": files}).json()
+    session_id = plan["session"]["id"]
+    client.put(f"/upload-sessions/{session_id}/files/1", content=b"new")
+
+    monkeypatch.setattr("app.internals.folder_and_files.create_folder_level", slow_create_folder_level)
+    post_and_disconnect(f"/upload-sessions/{session_id}/finalize")
+
+    assert client.get(f"/upload-sessions/{session_id}").json()["status"] == "open"
+    with Session(engine) as session:
+        assert session.get(Blob, digest).ref_count == 1
+
+
+def test_upload_plan_resync(sample_folder):
+    """Test that a merging re-sync only uploads changed files and links stored content"""
+    first, second, changed = os.urandom(1000), os.urandom(1000), os.urandom(1000)
+    digest = lambda content: hashlib.sha256(content).hexdigest()
+    files = [
+        {"path": "sync/a.txt", "size": 1000, "digest": digest(first)},
+        {"path": "sync/sub/b.txt", "size": 1000, "digest": digest(second)},
+    ]
+    plan = client.post(f"/upload-plan/{sample_folder}", params={"merge": True}, json={"files": files}).json()
+    assert plan["upload_files"] == 2 and plan["folders"][0] == {"path": "sync", "name": "sync", "id": None}
+    for index, content in enumerate([first, second]):
+        client.put(f"/upload-sessions/{plan['session']['id']}/files/{index}", content=content)
+    client.post(f"/upload-sessions/{plan['session']['id']}/finalize")
+
+    files[1]["digest"] = digest(changed)
+    files.append({"path": "sync/sub/copy.txt", "size": 1000, "digest": digest(first)})
+    plan = client.post(f"/upload-plan/{sample_folder}", params={"merge": True}, json={"files": files}).json()
+    assert [file["action"] for file in plan["session"]["files"]] == ["skip", "upload", "link"]
+    assert plan["upload_size"] == 1000 and plan["replaced_files"] == 1
+    assert all(folder["id"] for folder in plan["folders"])
+
+    session_id = plan["session"]["id"]
+    assert client.put(f"/upload-sessions/{session_id}/files/2", content=first).status_code == 409
+    client.put(f"/upload-sessions/{session_id}/files/1", content=changed)
+    events = [json.loads(line) for line in client.post(f"/upload-sessions/{session_id}/finalize").text.splitlines()]
+    assert events[0]["replaced_count"] == 1 and events[0]["unchanged_count"] == 1
+    assert events[-1]["stage"] == "upload_complete" and events[-1]["total_folders"] == 0
+
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    assert [folder["name"] for folder in tree["folders"]].count("sync") == 1
+    documents = {document["name"]: document for document in tree["documents"]}
+    assert client.get(f"/file/{documents['b.txt']['id']}/content").content == changed
+    assert client.get(f"/file/{documents['copy.txt']['id']}/content").content == first
+
+    # Without merge the tree is uploaded next to the existing one
+    plan = client.post(f"/upload-plan/{sample_folder}", json={"files": files}).json()
+    assert plan["renamed_folders"][0]["new_name"] == "sync (1)" and plan["linked_files"] == 3
+
+
+def test_background_folder_upload_job(sample_folder):
+    """Test that background uploads return a job id at once and that unfinished jobs resume on start"""
+    temp_path, digest, size = store_temp_file(BytesIO(b"resumed after a restart"))
+    with Session(engine) as session:
+        stalled = create_ingest_job(session, sample_folder, ["stalled/resumed.txt"], [
+            StoredFile(filename="resumed.txt", file_path=temp_path, size=size, digest=digest)
+        ])
+        update_job(session, stalled.id, status="running", attempts=1, owner="stopped process", lease_expires_at=utcnow())
+        session.commit()
+        stalled_id = stalled.id
+
+    with TestClient(app) as background_client:
+        files = [("files", ("background/job.txt", BytesIO(b"job"), "text/plain"))]
+        response = background_client.post(
+            f"/folder-upload/{sample_folder}", params={"background": True}, files=files, data={"paths": ["background/job.txt"]}
+        )
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+
+        stream = background_client.get(f"/jobs/{job_id}/events").text
+        assert "event: complete" in stream and "upload_complete" in stream
+        for finished_id in (job_id, stalled_id):
+            while (job := background_client.get(f"/jobs/{finished_id}").json())["status"] not in ("complete", "failed"):
+                time.sleep(0.05)
+            assert job["status"] == "complete" and job["last_event"]["stage"] == "upload_complete"
+        assert background_client.get("/jobs/unknown").status_code == 404
+
+    names = {document["name"] for document in client.get(f"/folder-tree/{sample_folder}").json()["documents"]}
+    assert {"job.txt", "resumed.txt"} <= names
+
+
+def test_ingest_job_run_that_lost_its_claim(sample_folder):
+    """Test two runs racing on a job: the one that lost the claim records nothing and keeps the files"""
+    temp_path, digest, size = store_temp_file(BytesIO(b"raced"))
+    with Session(engine) as session:
+        job = create_ingest_job(session, sample_folder, ["raced/file.txt"], [
+            StoredFile(filename="file.txt", file_path=temp_path, size=size, digest=digest)
+        ])
+        job_id = job.id
+        update_job(session, job_id, owner="live process", lease_expires_at=utcnow() + timedelta(seconds=60))
+        session.commit()
+        assert claim_job(session, job_id) is None  # the lease of a live process is respected
+        update_job(session, job_id, lease_expires_at=None)
+        session.commit()
+
+    second_claimed, second_may_go = threading.Event(), threading.Event()
+
+    class FirstRun(JobProgress):
+        def publish(self, job_id, event):
+            super().publish(job_id, event)
+            if second_claimed.is_set():
+                return
+            # The first run stalls long enough for its lease to expire and a second run to claim
+            with Session(engine) as session:
+                update_job(session, job_id, lease_expires_at=utcnow() - timedelta(seconds=1))
+                session.commit()
+            threading.Thread(target=asyncio.run, args=(run_ingest_job(job_id, SecondRun()),)).start()
+            assert second_claimed.wait(10)
+
+    class SecondRun(JobProgress):
+        def publish(self, job_id, event):
+            super().publish(job_id, event)
+            if not second_claimed.is_set():
+                second_claimed.set()
+                assert second_may_go.wait(10)
+
+    try:
+        asyncio.run(run_ingest_job(job_id, FirstRun()))
+        with Session(engine) as session:
+            assert session.get(IngestJob, job_id).status == "running"
+        assert os.path.exists(temp_path)
+    finally:
+        second_may_go.set()
+
+    for _ in range(200):
+        with Session(engine) as session:
+            if (job := session.get(IngestJob, job_id)).status != "running":
+                break
+        time.sleep(0.05)
+    assert job.status == "complete" and job.attempts == 2
+
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    assert [folder["name"] for folder in tree["folders"]] == ["raced"]
+    document = next(document for document in tree["documents"] if document["name"] == "file.txt")
+    assert client.get(f"/file/{document['id']}/content").content == b"raced"
+
+
+def test_delete_folder_after_background_upload(sample_folder):
+    """Test a folder can be deleted while jobs that uploaded into it are kept"""
+    with TestClient(app) as background_client:
+        files = [("files", ("done/job.txt", BytesIO(b"job"), "text/plain"))]
+        job_id = background_client.post(
+            f"/folder-upload/{sample_folder}", params={"background": True}, files=files, data={"paths": ["done/job.txt"]}
+        ).json()["id"]
+        while background_client.get(f"/jobs/{job_id}").json()["status"] not in ("complete", "failed"):
+            time.sleep(0.05)
+
+        assert background_client.delete(f"/folder-delete/{sample_folder}").status_code == 200
+        assert background_client.get(f"/jobs/{job_id}").json()["status"] == "complete"
+
+
+def test_folder_details_cache_invalidation(sample_folder):
+    """Test that repeated listings hit the cache and every write to the folder invalidates it"""
+    hits = client.get("/listing-cache").json()["hits"]
+    first = client.get(f"/folder-details/{sample_folder}").json()
+    assert client.get(f"/folder-details/{sample_folder}").json() == first
+    assert client.get("/listing-cache").json()["hits"] == hits + 1
+
+    file_id = client.post(f"/file-create/{sample_folder}", files={"file": ("cached.txt", b"cached")}).json()["id"]
+    names = [document["name"] for document in client.get(f"/folder-details/{sample_folder}").json()["documents"]]
+    assert "cached.txt" in names
+
+    client.post(f"/file-update/{file_id}", json={"name": "renamed.txt"})
+    names = [document["name"] for document in client.get(f"/folder-details/{sample_folder}").json()["documents"]]
+    assert "renamed.txt" in names and "cached.txt" not in names
+
+    child = client.post(f"/folder-create/{sample_folder}", json={"name": "cached child"}).json()["id"]
+    assert client.get(f"/folder-details/{child}").status_code == 200
+    client.delete(f"/folder-delete/{sample_folder}")
+    assert client.get(f"/folder-details/{child}").status_code == 404
+
+
+def test_batch_operations(sample_folder):
+    """Test a batch moves, renames and deletes in one transaction with set-based paths"""
+    upload_tree(["a/b/one.txt", "c/two.txt", "three.txt"], sample_folder)
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    folders = {folder["name"]: folder["id"] for folder in tree["folders"]}
+    documents = {document["name"]: document["id"] for document in tree["documents"]}
+
+    response = client.post("/batch", json={"operations": [
+        {"op": "move", "type": "folder", "id": folders["a"], "parent_id": folders["c"]},
+        {"op": "move", "type": "file", "id": documents["three.txt"], "parent_id": folders["b"]},
+        {"op": "rename", "type": "folder", "id": folders["b"], "name": "bee"},
+        {"op": "delete", "type": "file", "id": documents["two.txt"]},
+    ]}).json()
+    assert response["applied"] and all(result["ok"] for result in response["results"])
+
+    ancestors = client.get(f"/folder-ancestors/{folders['b']}").json()
+    assert [folder["name"] for folder in ancestors] == ["Test Folder", "c", "a"]
+    names = [document["name"] for document in client.get(f"/folder-details/{folders['b']}").json()["documents"]]
+    assert sorted(names) == ["one.txt", "three.txt"]
+    with Session(engine) as session:
+        assert session.get(Folder, folders["b"]).path == f"/{sample_folder}/{folders['c']}/{folders['a']}/{folders['b']}/"
+        assert session.get(Folder, folders["b"]).name == "bee"
+        assert session.get(Document, documents["two.txt"]) is None
+
+    response = client.post("/batch", json={"operations": [
+        {"op": "delete", "type": "folder", "id": folders["c"]},
+    ]}).json()
+    assert response["folders_deleted"] == 3 and response["documents_deleted"] == 2
+
+
+def test_batch_rejects_cycles_atomically(sample_folder):
+    """Test moves that only form a cycle together are rejected and nothing is applied"""
+    first = client.post(f"/folder-create/{sample_folder}", json={"name": "first"}).json()["id"]
+    second = client.post(f"/folder-create/{sample_folder}", json={"name": "second"}).json()["id"]
+
+    operations = [
+        {"op": "move", "type": "folder", "id": first, "parent_id": second},
+        {"op": "move", "type": "folder", "id": second, "parent_id": first},
+        {"op": "rename", "type": "folder", "id": first, "name": "renamed"},
+        {"op": "delete", "type": "file", "id": 10 ** 9},
+    ]
+    response = client.post("/batch", json={"operations": operations}).json()
+    assert not response["applied"]
+    assert [result["ok"] for result in response["results"]] == [False, False, True, False]
+    with Session(engine) as session:
+        assert session.get(Folder, first).name == "first"
+        assert session.get(Folder, second).parent_id == sample_folder
+
+    # Without atomic the valid operations go through
+    response = client.post("/batch?atomic=false", json={"operations": operations}).json()
+    assert response["applied"]
+    with Session(engine) as session:
+        assert session.get(Folder, first).name == "renamed"
+
+
+def test_folder_moves_are_versioned(sample_folder):
+    """Test a move checked against a stale tree fails instead of building a cycle"""
+    first = client.post(f"/folder-create/{sample_folder}", json={"name": "first"}).json()
+    second = client.post(f"/folder-create/{sample_folder}", json={"name": "second"}).json()
+
+    response = client.patch(f"/folder-update/{first['id']}", json={"name": "stale", "version": first["version"] + 1})
+    assert response.status_code == 409
+    renamed = client.patch(f"/folder-update/{first['id']}", json={"name": "renamed", "version": first["version"]}).json()
+    assert renamed["version"] > first["version"]
+
+    # A request read both folders, then another one moved second below first
+    with Session(engine) as session:
+        stale_first, stale_second = session.get(Folder, first["id"]), session.get(Folder, second["id"])
+        stale_paths = {stale_first.id: stale_first.path, stale_second.id: stale_second.path}
+    assert client.patch(f"/folder-update/{second['id']}", json={"parent_id": first["id"]}).status_code == 200
+
+    with Session(engine) as session:
+        assert claim_folders(session, {first["id"]: (stale_paths[first["id"]], None)})
+        assert not check_folder_paths(session, {second["id"]: stale_paths[second["id"]]})
+        session.rollback()
+
+    assert client.patch(f"/folder-update/{first['id']}", json={"parent_id": second["id"]}).status_code == 400
+
+
+def test_metrics_instrumentation(sample_folder):
+    """Test queries, upload stages and disk writes are counted per request when enabled"""
+    assert "x-query-count" not in client.get(f"/folder-details/{sample_folder}").headers
+
+    metrics.enable(engine, read_engine)
+    metrics.headers = True
+    try:
+        response = client.get(f"/folder-details/{sample_folder}", params={"q": "uncached"})
+        assert int(response.headers["x-query-count"]) >= 1
+        upload_tree(["measured/one.txt", "measured/two.txt"], sample_folder)
+        written = metrics._counters.get(("disk_write_bytes_total", ()), 0)
+        client.post(f"/file-create/{sample_folder}", files={"file": ("single.bin", b"x" * 1000)})
+        assert metrics._counters[("disk_write_bytes_total", ())] == written + 1000
+        text = client.get("/metrics").text
+    finally:
+        metrics.disable()
+        metrics.headers = False
+
+    assert 'headache_http_requests_total{method="POST",route="/folder-upload/{folder_id}",status="200"}' in text
+    assert 'headache_upload_stage_seconds_count{stage="file_folder_relation"}' in text
+    assert 'headache_upload_stage_seconds_count{stage="file_validation"}' in text
+    assert "headache_disk_write_bytes_total" in text
+    assert "headache_listing_cache_hits" in text
+    uploads = next(line for line in text.splitlines()
+                   if line.startswith('headache_http_request_queries_sum{method="POST",route="/folder-upload/{folder_id}"}'))
+    assert float(uploads.split()[-1]) > 0
+
+
+def test_folder_upload_dotted_folders_and_bare_files(sample_folder):
+    """Test the last path component is the file, so dotted folders and extensionless files are kept apart"""
+    upload_tree(["release/v1.2/notes", "release/v1.2/build.d/out.bin", "release/Makefile"], sample_folder)
+
+    tree = client.get(f"/folder-tree/{sample_folder}").json()
+    folders = {folder["name"]: folder for folder in tree["folders"]}
+    documents = {document["name"]: document for document in tree["documents"]}
+    assert set(folders) == {"release", "v1.2", "build.d"}
+    assert set(documents) == {"notes", "out.bin", "Makefile"}
+    assert documents["notes"]["folder_id"] == folders["v1.2"]["id"]
+    assert documents["Makefile"]["folder_id"] == folders["release"]["id"]
+    assert folders["build.d"]["parent_id"] == folders["v1.2"]["id"]
+
+
+def test_pool_timeout_is_retryable(sample_folder):
+    """Test a request that gets no database connection in time is answered with 503"""
+    def busy_session():
+        raise PoolTimeoutError("QueuePool limit of size 1 overflow 0 reached")
+        yield
+
+    app.dependency_overrides[get_session] = busy_session
+    try:
+        response = client.patch(f"/folder-update/{sample_folder}", json={"name": "busy"})
+    finally:
+        app.dependency_overrides.pop(get_session)
+    assert response.status_code == 503
+    assert response.headers["retry-after"].isdigit()